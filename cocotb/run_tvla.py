@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 import argparse
+import fcntl
+import json
 import os
 import random
+import shlex
 import subprocess
 import sys
+import time
 from cocotb.runner import (  # type: ignore
     VHDL,
     Simulator,
@@ -11,8 +15,10 @@ from cocotb.runner import (  # type: ignore
     Verilog,
     get_runner,
 )
+from contextlib import contextmanager
 from copy import deepcopy
 from dataclasses import dataclass
+from hashlib import sha256
 from joblib import Parallel, delayed  # type: ignore
 from logging import getLogger
 from pathlib import Path
@@ -99,6 +105,61 @@ def parse_results(results_xml_file) -> list[TestSuite]:
     return results
 
 
+def waves_from_env() -> bool:
+    return os.getenv("WAVES") in ("1", "true", "True", "TRUE", "on", "On", "ON")
+
+
+def verilator_flags(
+    waves: bool,
+    trace_ext: str = "fst",
+    trace_threads: int = 2,
+) -> list[str]:
+    cflags = "-march=native -mtune=native"
+    env_cflags = os.environ.get("CPPFLAGS")
+    if env_cflags:
+        cflags += f" {env_cflags}"
+    env_cflags = os.environ.get("CFLAGS")
+    if env_cflags:
+        cflags += f" {env_cflags}"
+    # os.environ["CFLAGS"] = cflags
+    # os.environ["CXXFLAGS"] = cflags
+    verilate_flags = [
+        "-Wno-fatal",
+        "-Wno-lint",
+        "-Wno-style",
+        "-Wno-UNOPTFLAT",
+        "-O3",
+        "--x-assign",
+        "fast",
+        "--x-initial",
+        "fast",
+        "-j",
+        "0",
+        # "--flatten",
+    ]
+    # verilate_flags += ["--assert"]
+    verilate_flags += ["-CFLAGS", f"{cflags}"]
+
+    if waves:
+        verilate_flags += [
+            "--trace-underscore",
+            "--trace-structs",
+            "--trace-max-array",
+            "16384",
+            "--trace-max-width",
+            "16384",
+        ]
+        if trace_threads > 0:
+            verilate_flags += ["--trace-threads", str(trace_threads)]
+        if trace_ext == "fst":
+            verilate_flags += ["--trace-fst"]
+        elif trace_ext == "vcd":
+            verilate_flags += ["--trace-vcd"]
+        elif trace_ext == "saif":
+            verilate_flags += ["--trace-saif"]
+    return verilate_flags
+
+
 def build_simulation(
     sources: list[str] | list[Path],
     top: str,
@@ -113,57 +174,10 @@ def build_simulation(
     build_args: list[str | VHDL | Verilog] = []
 
     if waves is None:
-        if os.getenv("WAVES") in ("1", "true", "True", "TRUE", "on", "On", "ON"):
-            waves = True
-        else:
-            waves = False
+        waves = waves_from_env()
 
     if sim == "verilator":
-        cflags = "-march=native -mtune=native"
-        env_cflags = os.environ.get("CPPFLAGS")
-        if env_cflags:
-            cflags += f" {env_cflags}"
-        env_cflags = os.environ.get("CFLAGS")
-        if env_cflags:
-            cflags += f" {env_cflags}"
-        # os.environ["CFLAGS"] = cflags
-        # os.environ["CXXFLAGS"] = cflags
-        verilate_flags = [
-            "-Wno-fatal",
-            "-Wno-lint",
-            "-Wno-style",
-            "-Wno-UNOPTFLAT",
-            "-O3",
-            "--x-assign",
-            "fast",
-            "--x-initial",
-            "fast",
-            "-j",
-            "0",
-            # "--flatten",
-        ]
-        # verilate_flags += ["--assert"]
-        verilate_flags += ["-CFLAGS", f"{cflags}"]
-
-        if waves:
-            verilate_flags += [
-                "--trace-underscore",
-                "--trace-structs",
-                "--trace-max-array",
-                "16384",
-                "--trace-max-width",
-                "16384",
-            ]
-            if trace_threads > 0:
-                verilate_flags += ["--trace-threads", str(trace_threads)]
-            if trace_ext == "fst":
-                verilate_flags += ["--trace-fst"]
-            elif trace_ext == "vcd":
-                verilate_flags += ["--trace-vcd"]
-            elif trace_ext == "saif":
-                verilate_flags += ["--trace-saif"]
-
-        for flag in verilate_flags:
+        for flag in verilator_flags(waves, trace_ext, trace_threads):
             build_args.append(Verilog(flag))
 
     runner = get_runner(sim)
@@ -185,6 +199,116 @@ def build_simulation(
     return runner
 
 
+BUILD_CACHE_MANIFEST = "manifest.json"
+BUILD_CACHE_LOCK = "manifest.lock"
+
+
+def build_cache_key(design_hash: str, top: str, sim: str, flags: list[str]) -> str:
+    """Content address of a simulation build: the design sources plus every option passed to the simulator."""
+    key_data = json.dumps(
+        {"design_hash": design_hash, "top": top, "sim": sim, "flags": flags},
+        sort_keys=True,
+    )
+    return sha256(key_data.encode("utf-8")).hexdigest()[:12]
+
+
+def load_build_manifest(cache_root: Path) -> dict:
+    manifest_file = cache_root / BUILD_CACHE_MANIFEST
+    if not manifest_file.exists():
+        return {}
+    try:
+        with open(manifest_file, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: ignoring unreadable build cache manifest {manifest_file}: {e}")
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+
+@contextmanager
+def build_cache_lock(cache_root: Path, lock_name: str):
+    """Hold an exclusive lock on `lock_name` in the build cache, shared by all the launches using the same cache."""
+    cache_root.mkdir(parents=True, exist_ok=True)
+    with open(cache_root / lock_name, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def save_build_manifest(cache_root: Path, manifest: dict):
+    cache_root.mkdir(parents=True, exist_ok=True)
+    manifest_file = cache_root / BUILD_CACHE_MANIFEST
+    # write to a temporary file first, so that concurrent launches never see a partial manifest
+    tmp_file = manifest_file.with_name(f"{manifest_file.name}.{os.getpid()}.tmp")
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+def cached_build_dir(
+    cache_root: Path,
+    design_hash: str,
+    top: str,
+    sim: str,
+    flags: list[str],
+    force: bool = False,
+) -> tuple[Path, bool]:
+    """Return the build directory for this design and flags, and whether a (re)build is needed."""
+    key = build_cache_key(design_hash, top, sim, flags)
+    build_dir = cache_root / key
+    entry = load_build_manifest(cache_root).get(key)
+    if force or entry is None:
+        return build_dir, True
+    sim_exe_path = build_dir / entry.get("executable", top)
+    if not sim_exe_path.exists():
+        print(f"Simulation executable {sim_exe_path} does not exist, forcing build.")
+        return build_dir, True
+    return build_dir, False
+
+
+@contextmanager
+def locked_build_dir(
+    cache_root: Path,
+    design_hash: str,
+    top: str,
+    sim: str,
+    flags: list[str],
+    force: bool = False,
+):
+    """Like `cached_build_dir`, but holding the lock of the build (`<key>.lock`) until the block exits.
+
+    The manifest is checked once the lock is held, so of the launches that miss the cache for the same build, one
+    builds it and records it while the others wait, and then use it.
+    """
+    key = build_cache_key(design_hash, top, sim, flags)
+    with build_cache_lock(cache_root, f"{key}.lock"):
+        yield cached_build_dir(cache_root, design_hash, top, sim, flags, force)
+
+
+def record_build(
+    cache_root: Path,
+    build_dir: Path,
+    design_hash: str,
+    top: str,
+    sim: str,
+    flags: list[str],
+):
+    # read-modify-write under the lock, so that concurrent launches do not drop each other's entries
+    with build_cache_lock(cache_root, BUILD_CACHE_LOCK):
+        manifest = load_build_manifest(cache_root)
+        manifest[build_dir.name] = {
+            "design_hash": design_hash,
+            "top": top,
+            "sim": sim,
+            "flags": flags,
+            "executable": top,
+            "built_at": time.time(),
+        }
+        save_build_manifest(cache_root, manifest)
+
+
 def run_test(
     runner: Simulator,
     top: str,
@@ -248,6 +372,96 @@ def run_test(
         exit(1)
 
 
+@dataclass
+class StoppingRule:
+    """Decides when a TVLA campaign has seen enough traces, based on the live max|t| trajectory."""
+
+    threshold: float = 4.5
+    # max|t| must stay below `quiet_fraction * threshold` ...
+    quiet_fraction: float = 0.5
+    # ... for at least this many traces ...
+    quiet_traces: int | None = None
+    # ... while not growing by more than this fraction over that span
+    trend_tolerance: float = 0.1
+
+    def check(self, num_traces: list[int], max_t: list[list[float]]) -> str | None:
+        """Return the reason to stop, or None to continue."""
+        if len(num_traces) < 2:
+            return None
+        for d, max_t_d in enumerate(max_t, start=1):
+            if max_t_d and max_t_d[-1] > self.threshold:
+                return f"max|t| for d={d} crossed {self.threshold} after {num_traces[-1]} traces ({max_t_d[-1]:.2f})"
+        if self.quiet_traces is None or num_traces[-1] < self.quiet_traces:
+            return None
+        # the first point of the trailing window spanning at least `quiet_traces` traces
+        window_start = max(i for i, n in enumerate(num_traces) if num_traces[-1] - n >= self.quiet_traces)
+        # the progress starts from (0 traces, 0.0), which is not a measurement: the window must start at a
+        # measured point and hold at least one more to show a trend
+        first_measured = 1 if num_traces[0] == 0 else 0
+        if window_start < first_measured or window_start >= len(num_traces) - 1:
+            return None
+        quiet_level = self.quiet_fraction * self.threshold
+        for max_t_d in max_t:
+            window = max_t_d[window_start:]
+            if max(window) >= quiet_level:
+                return None
+            if window[-1] > window[0] * (1 + self.trend_tolerance):
+                return None
+        return (
+            f"max|t| stayed below {quiet_level:.2f} with a stable trend for the last "
+            f"{num_traces[-1] - num_traces[window_start]} traces"
+        )
+
+
+def read_tvla_progress(progress_file: Path) -> tuple[list[int], list[list[float]]] | None:
+    try:
+        with open(progress_file, encoding="utf-8") as f:
+            progress = json.load(f)
+        return progress["num_traces"], progress["max_t"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def start_tvla_analysis(
+    tvla_bin: str,
+    output_dir: Path,
+    extra_args: list[str] | None = None,
+) -> subprocess.Popen:
+    """Start a `tvla` process that analyzes runs as soon as their metadata paths are written to its stdin."""
+    cmd = [
+        tvla_bin,
+        "--meta-stdin",
+        "--ttest-output-dir",
+        str(output_dir),
+        "--progress-file",
+        str(output_dir / "progress.json"),
+        *(extra_args or []),
+    ]
+    print(f"Starting streaming analysis: {' '.join(cmd)}")
+    return subprocess.Popen(cmd, stdin=subprocess.PIPE, text=True)
+
+
+def feed_tvla_analysis(analysis: subprocess.Popen, meta_file: Path):
+    assert analysis.stdin is not None
+    try:
+        analysis.stdin.write(f"{meta_file.absolute()}\n")
+        analysis.stdin.flush()
+    except BrokenPipeError:
+        print(f"Warning: analysis process exited early, {meta_file} was not analyzed")
+
+
+def finish_tvla_analysis(analysis: subprocess.Popen) -> int:
+    if analysis.stdin is not None:
+        try:
+            analysis.stdin.close()
+        except BrokenPipeError:
+            pass
+    returncode = analysis.wait()
+    if returncode != 0:
+        print(f"Error: streaming analysis failed with exit code {returncode}")
+    return returncode
+
+
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser()
     argparser.add_argument(
@@ -288,7 +502,7 @@ if __name__ == "__main__":
     argparser.add_argument(
         "--build",
         action="store_true",
-        help="whether to build the design before running tests (default: True)",
+        help="force a clean rebuild even if a cached build with the same sources and flags exists",
     )
     argparser.add_argument(
         "--test-root",
@@ -342,6 +556,41 @@ if __name__ == "__main__":
         default="multi",
         help="suffix for the directory where multiple runs will be stored (default: multi)",
     )
+    argparser.add_argument(
+        "--analyze",
+        action="store_true",
+        help="with --multi, run the TVLA analysis while simulating, feeding each run to `tvla` as soon as it finishes",
+    )
+    argparser.add_argument(
+        "--tvla-bin",
+        type=str,
+        default="tvla",
+        help="path to the `tvla` binary used by --analyze (default: tvla)",
+    )
+    argparser.add_argument(
+        "--tvla-args",
+        type=str,
+        default="",
+        help="extra arguments passed to the `tvla` binary used by --analyze, e.g. '-d 2 --plot'",
+    )
+    argparser.add_argument(
+        "--stop-threshold",
+        type=float,
+        default=None,
+        help="with --analyze, skip the remaining runs once max|t| of any order crosses this threshold (e.g. 4.5)",
+    )
+    argparser.add_argument(
+        "--stop-quiet-traces",
+        type=int,
+        default=None,
+        help="with --stop-threshold, also stop once max|t| has stayed far below the threshold with a stable trend for this many traces",
+    )
+    argparser.add_argument(
+        "--stop-quiet-fraction",
+        type=float,
+        default=0.5,
+        help="fraction of --stop-threshold under which max|t| is considered far below it (default: 0.5)",
+    )
 
     args = argparser.parse_args()
 
@@ -359,8 +608,6 @@ if __name__ == "__main__":
             sources_lines = [line.strip() for line in f.readlines()]
             sources = [sources_root / src for src in sources_lines if src]
     elif filelist.suffix == ".json":
-        import json
-
         with open(filelist, encoding="utf-8") as f:
             sources_data = json.load(f)
             if not isinstance(sources_data, dict):
@@ -388,34 +635,12 @@ if __name__ == "__main__":
             print(f"Error: source file {src} does not exist")
             exit(1)
 
-    from hashlib import sha256
-
     # from pathlib import Path
     source_hashes = [sha256(src.read_bytes()).hexdigest() for src in sources]
     source_hashes.sort()  # sort the hashes to ensure consistent ordering
     design_hash = sha256("".join(source_hashes).encode("utf-8")).hexdigest()[:8]
     design_dir_name = f"{args.top}_{design_hash}"
     test_root = args.test_root or Path.cwd() / "tvla_run" / design_dir_name
-    build_dir: Path = test_root / "sim_build"
-
-    if not build_dir.exists():
-        # build_dir.mkdir(parents=True, exist_ok=True)
-        args.build = True
-    else:
-        sim_exe_path = build_dir / args.top
-        if not sim_exe_path.exists():
-            print(f"Simulation executable {sim_exe_path} does not exist, forcing build.")
-            args.build = True
-        else:
-            sources_last_modified = max(src.stat().st_mtime for src in sources)
-            build_files = list(build_dir.glob("**/*"))  # get all files in the build directory
-            if not build_files:
-                args.build = True
-            else:
-                build_dir_last_modified = max(f.stat().st_mtime for f in build_files)
-                if sources_last_modified > build_dir_last_modified:
-                    print("Sources have been modified since the last build. Forcing clean+build.")
-                    args.build = True
 
     trace_filename = args.trace_filename
 
@@ -424,20 +649,37 @@ if __name__ == "__main__":
     else:
         trace_ext = "vcd"
 
-    if args.build:
-        runner = build_simulation(
-            sources=sources,
-            top=args.top,
-            build_dir=build_dir,
-            sim="verilator",
-            waves=True,
-            trace_ext=trace_ext,
-            trace_threads=args.trace_threads,
-            verbose=args.verbose,
-        )
-    else:
-        runner = get_runner("verilator")
-        runner.hdl_toplevel_lang = "verilog"
+    # Each distinct combination of design sources and simulator flags gets its own build directory,
+    # so a cache hit skips Verilator entirely and a flag change never clobbers another configuration.
+    build_cache_root: Path = test_root / "sim_build"
+    # the runs need the traces; the build and its cache key must agree on it
+    waves = True
+    build_flags = verilator_flags(waves, trace_ext, args.trace_threads)
+    with locked_build_dir(
+        build_cache_root,
+        design_hash,
+        args.top,
+        "verilator",
+        build_flags,
+        force=args.build,
+    ) as (build_dir, needs_build):
+        if needs_build:
+            print(f"Building the simulation in {build_dir}")
+            runner = build_simulation(
+                sources=sources,
+                top=args.top,
+                build_dir=build_dir,
+                sim="verilator",
+                waves=waves,
+                trace_ext=trace_ext,
+                trace_threads=args.trace_threads,
+                verbose=args.verbose,
+            )
+            record_build(build_cache_root, build_dir, design_hash, args.top, "verilator", build_flags)
+        else:
+            print(f"Using cached simulation build in {build_dir}")
+            runner = get_runner("verilator")
+            runner.hdl_toplevel_lang = "verilog"
 
     meta_filename = "meta.json.gz"
 
@@ -486,7 +728,7 @@ if __name__ == "__main__":
             test_cases=test_cases,
             build_dir=build_dir,
             test_dir=test_dir,
-            waves=True,
+            waves=waves,
             trace_filename=trace_filename,
             verbose=args.verbose,
             seed=seed,
@@ -519,7 +761,7 @@ if __name__ == "__main__":
             test_cases=test_cases,
             build_dir=build_dir,
             test_dir=test_dir,
-            waves=True,
+            waves=waves,
             trace_filename=trace_filename,
             verbose=args.verbose,
             seed=seed,
@@ -558,22 +800,61 @@ if __name__ == "__main__":
             f"Running {num_runs} multi tests in {multi_test_top_dir} with parallel jobs: {args.parallel_jobs}"
         )
         n_jobs = min(num_runs, args.parallel_jobs)
-        meta_files = Parallel(n_jobs=n_jobs)(
+        analysis = None
+        analysis_dir = multi_test_top_dir / "ttest"
+        stopping_rule = None
+        if args.stop_threshold is not None:
+            if not args.analyze:
+                print("Error: --stop-threshold requires --analyze")
+                exit(1)
+            stopping_rule = StoppingRule(
+                threshold=args.stop_threshold,
+                quiet_fraction=args.stop_quiet_fraction,
+                quiet_traces=args.stop_quiet_traces,
+            )
+        if args.analyze:
+            analysis_dir.mkdir(parents=True, exist_ok=True)
+            (analysis_dir / "progress.json").unlink(missing_ok=True)
+            analysis = start_tvla_analysis(
+                args.tvla_bin,
+                analysis_dir,
+                shlex.split(args.tvla_args),
+            )
+        meta_list_file = multi_test_top_dir / "meta.list"
+        meta_files = []
+        num_missing = 0
+        # runs are yielded as soon as each one finishes, so that analysis overlaps with the remaining simulations
+        runs = Parallel(n_jobs=n_jobs, return_as="generator_unordered")(
             delayed(run_multi)(i, multi_test_top_dir, extra_env) for i in range(num_runs)
         )
-        if any(f is None for f in meta_files):
+        for meta_file in runs:
+            if meta_file is None:
+                num_missing += 1
+                continue
+            # convert paths to relative to multi_test_top_dir
+            meta_files.append(meta_file.relative_to(multi_test_top_dir))
+            # append the meta file to the meta.list file in multi_test_top_dir
+            with open(meta_list_file, "a", encoding="utf-8") as f:
+                f.write(f"{meta_files[-1]}\n")
+            if analysis is not None:
+                feed_tvla_analysis(analysis, meta_file)
+            if stopping_rule is not None:
+                progress = read_tvla_progress(analysis_dir / "progress.json")
+                stop_reason = progress and stopping_rule.check(*progress)
+                if stop_reason:
+                    print(f"Stopping the campaign early: {stop_reason}")
+                    # closing the generator cancels the runs that have not finished yet
+                    runs.close()
+                    break
+        if num_missing:
             print("Warning: Some meta files were not created during the multi test runs")
-        # convert paths to relative to multi_test_top_dir
-        meta_files = [f.relative_to(multi_test_top_dir) for f in meta_files if f is not None]
+        analysis_failed = analysis is not None and finish_tvla_analysis(analysis) != 0
         if not meta_files:
             print("No meta files were created during the multi test runs")
             exit(1)
         print(f"Meta files:\n{"\n".join(str(f) for f in meta_files)}\n")
-        # append all meta files to a meta.list file in multi_test_top_dir
-        meta_list_file = multi_test_top_dir / "meta.list"
-        with open(meta_list_file, "a", encoding="utf-8") as f:
-            for meta_file in meta_files:
-                f.write(f"{meta_file}\n")
+        if analysis_failed:
+            exit(1)
     else:
         if args.seed is None:
             seed = random.randint(0, 2**31 - 1)
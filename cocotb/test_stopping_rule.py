@@ -0,0 +1,38 @@
+from run_tvla import StoppingRule
+
+
+def test_continues_before_the_first_run():
+    assert StoppingRule(4.5, quiet_traces=1000).check([0], [[0.0]]) is None
+
+
+def test_stops_when_max_t_crosses_the_threshold():
+    reason = StoppingRule(4.5).check([0, 500, 1000], [[0.0, 2.0, 5.1]])
+    assert reason is not None and "crossed 4.5 after 1000 traces" in reason
+
+
+def test_checks_every_order():
+    reason = StoppingRule(4.5).check([0, 500], [[0.0, 1.0], [0.0, 4.6]])
+    assert reason is not None and "d=2" in reason
+
+
+def test_continues_without_quiet_traces():
+    assert StoppingRule(4.5).check([0, 500, 100_000], [[0.0, 0.1, 0.1]]) is None
+
+
+def test_ignores_the_initial_point():
+    # a single run is no trend, even if it spans the quiet traces from the initial (0 traces, 0.0) point
+    assert StoppingRule(4.5, quiet_traces=1000).check([0, 1500], [[0.0, 1.0]]) is None
+    assert StoppingRule(4.5, quiet_traces=1000).check([0, 500, 1200], [[0.0, 1.0, 1.0]]) is None
+
+
+def test_stops_when_quiet_with_a_stable_trend():
+    reason = StoppingRule(4.5, quiet_traces=1000).check([0, 500, 1000, 1500], [[0.0, 1.0, 1.0, 1.05]])
+    assert reason == "max|t| stayed below 2.25 with a stable trend for the last 1000 traces"
+
+
+def test_continues_when_not_quiet():
+    assert StoppingRule(4.5, quiet_traces=1000).check([0, 500, 1000, 1500], [[0.0, 1.0, 2.3, 1.0]]) is None
+
+
+def test_continues_while_max_t_grows():
+    assert StoppingRule(4.5, quiet_traces=1000).check([0, 500, 1000, 1500], [[0.0, 1.0, 1.1, 1.2]]) is None
@@ -0,0 +1,537 @@
+//! Attribution of the leakage at flagged samples to the signals, or scopes, whose power causes it.
+//!
+//! For each unit (a signal, or the scope enclosing it) and flagged sample, the attribution keeps the sum and the sum
+//! of squares of the power of the unit in the traces of each class. Only the units that ever change at a flagged
+//! sample have an entry, so memory grows with the number of units times the number of flagged samples at most,
+//! whatever the number of traces. Units are ranked by their first-order (Welch) t-statistic at their most leaking
+//! flagged sample. Like the t-test moments, the attributions of several runs can be merged in any order.
+
+use std::fs::File;
+use std::path::Path;
+use std::str::FromStr;
+
+use itertools::Itertools;
+use miette::{Context, IntoDiagnostic, miette};
+use ndarray::{Array1, Array2, Array3, ArrayView2};
+use ndarray_npz::{NpzReader, NpzWriter};
+use rayon::prelude::*;
+use rustc_hash::FxHashMap;
+
+use crate::markers_to_time_indices;
+use crate::partition::Partition;
+use crate::ttest::NUM_CLASSES;
+
+pub const ATTRIBUTION_CSV: &str = "attribution.csv";
+
+/// What the power of a flagged sample is attributed to.
+#[derive(Clone, Copy, Debug, Default, PartialEq, Eq)]
+pub enum AttributionUnit {
+    /// Each signal, named after its first selected variable.
+    #[default]
+    Signal,
+    /// The scope enclosing each signal, adding up the power of its signals.
+    Scope,
+}
+
+impl FromStr for AttributionUnit {
+    type Err = String;
+
+    /// Parse `signal` or `scope`.
+    fn from_str(s: &str) -> Result<Self, Self::Err> {
+        match s.trim().to_ascii_lowercase().as_str() {
+            "signal" => Ok(AttributionUnit::Signal),
+            "scope" => Ok(AttributionUnit::Scope),
+            s => Err(format!("expected signal or scope, found '{s}'")),
+        }
+    }
+}
+
+impl std::fmt::Display for AttributionUnit {
+    fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
+        match self {
+            AttributionUnit::Signal => write!(f, "signal"),
+            AttributionUnit::Scope => write!(f, "scope"),
+        }
+    }
+}
+
+impl AttributionUnit {
+    /// The name of the unit of the variable with the given full hierarchical name.
+    pub fn name_of<'a>(&self, full_name: &'a str) -> &'a str {
+        match self {
+            AttributionUnit::Signal => full_name,
+            AttributionUnit::Scope => full_name.rsplit_once('.').map_or("", |(scope, _)| scope),
+        }
+    }
+}
+
+/// The samples whose `|t|` exceeds `threshold` at any order of `t_values` (one row per order), keeping the
+/// `max_samples` with the largest `|t|`, in sample order.
+pub fn flagged_samples(
+    t_values: ArrayView2<f64>,
+    threshold: f64,
+    max_samples: usize,
+) -> Vec<usize> {
+    t_values
+        .columns()
+        .into_iter()
+        .map(|t_column| {
+            t_column
+                .iter()
+                .filter(|t| t.is_finite())
+                .fold(0f64, |max_t, t| max_t.max(t.abs()))
+        })
+        .enumerate()
+        .filter(|&(_, max_t)| max_t > threshold)
+        .sorted_by(|a, b| b.1.total_cmp(&a.1))
+        .take(max_samples)
+        .map(|(sample, _)| sample)
+        .sorted()
+        .collect_vec()
+}
+
+/// The flagged samples of the traces of a run: which traces, and which flagged sample of each, a time of its power
+/// trace falls into.
+#[derive(Clone, Debug)]
+pub struct FlaggedSamples {
+    /// the (trace, flagged sample position) pairs at the start time of each flagged sample
+    by_time: FxHashMap<u64, Vec<(u32, u32)>>,
+    /// class of each trace, or `None` if it is left out
+    classes: Vec<Option<usize>>,
+    /// width of the bins of the power trace, if it is binned
+    bin_width: Option<u64>,
+}
+
+impl FlaggedSamples {
+    /// Flag the `samples` of the traces that [`markers_to_time_indices`] cuts from a power trace with the given
+    /// `time_table` (the bin start times if it is binned by `bin_width`). The traces are split into the classes of
+    /// `maybe_partition`, as for the t-test, or else by their labels 0 and 1.
+    pub fn new(
+        samples: &[usize],
+        time_table: &[u64],
+        meta_markers: &[(u64, u64, u16)],
+        bin_width: Option<u64>,
+        maybe_partition: Option<&Partition>,
+    ) -> Self {
+        let trace_ranges = markers_to_time_indices(meta_markers, time_table);
+        let classes = trace_ranges
+            .iter()
+            .map(|&(_, _, label)| match maybe_partition {
+                Some(partition) => partition.class_of(label),
+                None => {
+                    assert!(
+                        (label as usize) < NUM_CLASSES,
+                        "Trace labels must be 0 or 1"
+                    );
+                    Some(label as usize)
+                }
+            })
+            .collect_vec();
+        let mut by_time = FxHashMap::<u64, Vec<(u32, u32)>>::default();
+        for (trace, &(start_idx, end_idx, _)) in trace_ranges.iter().enumerate() {
+            if classes[trace].is_none() {
+                continue;
+            }
+            for (position, &sample) in samples.iter().enumerate() {
+                if start_idx + sample < end_idx {
+                    by_time
+                        .entry(time_table[start_idx + sample])
+                        .or_default()
+                        .push((trace as u32, position as u32));
+                }
+            }
+        }
+        FlaggedSamples {
+            by_time,
+            classes,
+            bin_width,
+        }
+    }
+
+    /// The (trace, flagged sample position) pairs whose power includes the value changes at `time`.
+    #[inline]
+    fn at(&self, time: u64) -> Option<&[(u32, u32)]> {
+        let time = match self.bin_width {
+            Some(bin_width) => time - time % bin_width,
+            None => time,
+        };
+        self.by_time.get(&time).map(Vec::as_slice)
+    }
+}
+
+/// The leakage of a unit at its most leaking flagged sample.
+#[derive(Clone, Debug, PartialEq)]
+pub struct UnitLeakage<'a> {
+    pub unit: &'a str,
+    /// index of the sample within a trace
+    pub sample: usize,
+    pub t: f64,
+    /// mean power of the unit at the sample, in each class
+    pub mean: [f64; NUM_CLASSES],
+}
+
+#[derive(Clone, Debug, Default)]
+pub struct Attribution {
+    unit: AttributionUnit,
+    /// flagged samples, sorted
+    samples: Vec<usize>,
+    units: Vec<String>,
+    unit_ids: FxHashMap<String, u32>,
+    /// number of traces of each class
+    n: [u64; NUM_CLASSES],
+    /// sum and sum of squares of the power of each (unit, flagged sample position) in each class, if ever non-zero
+    sums: FxHashMap<(u32, u32), [[f64; 2]; NUM_CLASSES]>,
+}
+
+impl Attribution {
+    pub fn new(unit: AttributionUnit, samples: Vec<usize>) -> Self {
+        Attribution {
+            unit,
+            samples,
+            ..Default::default()
+        }
+    }
+
+    /// An empty attribution of the same units and samples.
+    pub fn empty_like(&self) -> Self {
+        Self::new(self.unit, self.samples.clone())
+    }
+
+    pub fn unit(&self) -> AttributionUnit {
+        self.unit
+    }
+
+    pub fn samples(&self) -> &[usize] {
+        &self.samples
+    }
+
+    /// Number of traces accumulated in each class.
+    pub fn num_traces(&self) -> [u64; NUM_CLASSES] {
+        self.n
+    }
+
+    fn unit_id(&mut self, name: &str) -> u32 {
+        if let Some(&id) = self.unit_ids.get(name) {
+            return id;
+        }
+        let id = self.units.len() as u32;
+        self.units.push(name.to_string());
+        self.unit_ids.insert(name.to_string(), id);
+        id
+    }
+
+    /// Accumulate the traces of a run, given its `sources` of power: each one belongs to the unit `unit_of(source)`,
+    /// and `power_of(source, on_power)` calls `on_power(time, power)` for each of its value changes.
+    /// The units are processed in parallel.
+    pub fn add_run<S, U, P>(
+        &mut self,
+        flagged: &FlaggedSamples,
+        sources: &[S],
+        unit_of: U,
+        power_of: P,
+    ) where
+        S: Sync,
+        U: Fn(&S) -> &str,
+        P: Fn(&S, &mut dyn FnMut(u64, f32)) + Sync,
+    {
+        let mut group_of_unit = FxHashMap::default();
+        let mut groups: Vec<(u32, Vec<&S>)> = Vec::new();
+        for source in sources {
+            let unit_id = self.unit_id(unit_of(source));
+            let group = *group_of_unit.entry(unit_id).or_insert_with(|| {
+                groups.push((unit_id, Vec::new()));
+                groups.len() - 1
+            });
+            groups[group].1.push(source);
+        }
+        let unit_sums = groups
+            .par_iter()
+            .map(|(unit_id, group)| {
+                // power of the unit in each (trace, flagged sample position)
+                let mut values = FxHashMap::<(u32, u32), f64>::default();
+                for &source in group {
+                    power_of(source, &mut |time: u64, power: f32| {
+                        for &key in flagged.at(time).unwrap_or_default() {
+                            *values.entry(key).or_default() += power as f64;
+                        }
+                    });
+                }
+                let mut sums = FxHashMap::<u32, [[f64; 2]; NUM_CLASSES]>::default();
+                for ((trace, position), value) in values {
+                    // only the traces of a class are flagged
+                    let class = flagged.classes[trace as usize].unwrap();
+                    let sum = &mut sums.entry(position).or_default()[class];
+                    sum[0] += value;
+                    sum[1] += value * value;
+                }
+                (*unit_id, sums)
+            })
+            .collect::<Vec<_>>();
+        for (unit_id, sums) in unit_sums {
+            for (position, class_sums) in sums {
+                self.add_sums((unit_id, position), &class_sums);
+            }
+        }
+        for &class in flagged.classes.iter().flatten() {
+            self.n[class] += 1;
+        }
+    }
+
+    fn add_sums(&mut self, key: (u32, u32), class_sums: &[[f64; 2]; NUM_CLASSES]) {
+        let sums = self.sums.entry(key).or_default();
+        for (sum, other) in sums.iter_mut().zip(class_sums) {
+            sum[0] += other[0];
+            sum[1] += other[1];
+        }
+    }
+
+    /// Merge the traces accumulated by `other` into `self`.
+    pub fn merge(&mut self, other: &Attribution) {
+        assert!(
+            self.unit == other.unit && self.samples == other.samples,
+            "Cannot merge attributions of different units or samples"
+        );
+        let unit_ids = other
+            .units
+            .iter()
+            .map(|name| self.unit_id(name))
+            .collect_vec();
+        for (&(unit_id, position), class_sums) in &other.sums {
+            self.add_sums((unit_ids[unit_id as usize], position), class_sums);
+        }
+        for (n, other_n) in self.n.iter_mut().zip(other.n) {
+            *n += other_n;
+        }
+    }
+
+    /// The units, ranked by decreasing `|t|` at their most leaking flagged sample. Units whose t-statistic is not
+    /// defined (e.g. that never change) are left out.
+    pub fn ranking(&self) -> Vec<UnitLeakage<'_>> {
+        let mut best = FxHashMap::<u32, UnitLeakage>::default();
+        for (&(unit_id, position), class_sums) in &self.sums {
+            let mut mean = [0f64; NUM_CLASSES];
+            let mut var = [0f64; NUM_CLASSES];
+            for class in 0..NUM_CLASSES {
+                let n = self.n[class] as f64;
+                mean[class] = class_sums[class][0] / n;
+                var[class] = (class_sums[class][1] / n - mean[class].powi(2)).max(0.0);
+            }
+            let t = (mean[0] - mean[1])
+                / (var[0] / self.n[0] as f64 + var[1] / self.n[1] as f64).sqrt();
+            if !t.is_finite() {
+                continue;
+            }
+            let leakage = UnitLeakage {
+                unit: &self.units[unit_id as usize],
+                sample: self.samples[position as usize],
+                t,
+                mean,
+            };
+            match best.get(&unit_id) {
+                Some(other) if other.t.abs() >= t.abs() => {}
+                _ => {
+                    best.insert(unit_id, leakage);
+                }
+            }
+        }
+        best.into_values()
+            .sorted_by(|a, b| b.t.abs().total_cmp(&a.t.abs()).then(a.unit.cmp(b.unit)))
+            .collect_vec()
+    }
+
+    /// Write the ranking as CSV, under a temporary name that is then renamed.
+    pub fn write_csv<P: AsRef<Path>>(&self, path: P) -> miette::Result<()> {
+        let path = path.as_ref();
+        let tmp_path = path.with_extension("csv.tmp");
+        let mut csv = format!("rank,{},sample,t,mean_0,mean_1\n", self.unit);
+        for (rank, leakage) in self.ranking().iter().enumerate() {
+            csv += &format!(
+                "{},{},{},{:.4},{:.6},{:.6}\n",
+                rank + 1,
+                leakage.unit,
+                leakage.sample,
+                leakage.t,
+                leakage.mean[0],
+                leakage.mean[1]
+            );
+        }
+        std::fs::write(&tmp_path, csv)
+            .into_diagnostic()
+            .wrap_err_with(|| format!("Failed to write {}", tmp_path.display()))?;
+        std::fs::rename(&tmp_path, path).into_diagnostic()
+    }
+
+    /// Save the accumulated sums to an NPZ file, so that the attribution can be resumed with [`Attribution::load`].
+    /// The file is written under a temporary name and then renamed, so readers never see partial files.
+    pub fn save<P: AsRef<Path>>(&self, path: P) -> miette::Result<()> {
+        let path = path.as_ref();
+        let tmp_path = path.with_extension("npz.tmp");
+        let file = File::create(&tmp_path)
+            .into_diagnostic()
+            .wrap_err_with(|| format!("Failed to create {}", tmp_path.display()))?;
+        let entries = self
+            .sums
+            .iter()
+            .sorted_by_key(|&(&key, _)| key)
+            .collect_vec();
+        let mut keys = Array2::<u32>::zeros((entries.len(), 2));
+        let mut sums = Array3::<f64>::zeros((entries.len(), NUM_CLASSES, 2));
+        for (i, (&(unit_id, position), class_sums)) in entries.into_iter().enumerate() {
+            keys[[i, 0]] = unit_id;
+            keys[[i, 1]] = position;
+            for (class, sum) in class_sums.iter().enumerate() {
+                sums[[i, class, 0]] = sum[0];
+                sums[[i, class, 1]] = sum[1];
+            }
+        }
+        let mut npz = NpzWriter::new_compressed(file);
+        npz.add_array(
+            "unit",
+            &Array1::from_vec(self.unit.to_string().into_bytes()),
+        )
+        .into_diagnostic()?;
+        npz.add_array(
+            "samples",
+            &Array1::from_iter(self.samples.iter().map(|&sample| sample as u64)),
+        )
+        .into_diagnostic()?;
+        // each name is terminated by a newline, as the name of the scope of top-level signals is empty
+        npz.add_array(
+            "units",
+            &Array1::from_vec(
+                self.units
+                    .iter()
+                    .map(|name| format!("{name}\n"))
+                    .collect::<String>()
+                    .into_bytes(),
+            ),
+        )
+        .into_diagnostic()?;
+        npz.add_array("num_traces", &Array1::from_iter(self.n))
+            .into_diagnostic()?;
+        npz.add_array("keys", &keys).into_diagnostic()?;
+        npz.add_array("sums", &sums).into_diagnostic()?;
+        npz.finish()
+            .into_diagnostic()
+            .wrap_err_with(|| format!("Failed to write {}", tmp_path.display()))?;
+        std::fs::rename(&tmp_path, path).into_diagnostic()
+    }
+
+    /// Load an attribution saved with [`Attribution::save`].
+    pub fn load<P: AsRef<Path>>(path: P) -> miette::Result<Self> {
+        let path = path.as_ref();
+        let file = File::open(path)
+            .into_diagnostic()
+            .wrap_err_with(|| format!("Failed to open {}", path.display()))?;
+        let mut npz = NpzReader::new(std::io::BufReader::new(file)).into_diagnostic()?;
+        let unit: Array1<u8> = npz
+            .by_name("unit")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'unit' in NPZ file")?;
+        let samples: Array1<u64> = npz
+            .by_name("samples")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'samples' in NPZ file")?;
+        let units: Array1<u8> = npz
+            .by_name("units")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'units' in NPZ file")?;
+        let n: Array1<u64> = npz
+            .by_name("num_traces")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'num_traces' in NPZ file")?;
+        let keys: Array2<u32> = npz
+            .by_name("keys")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'keys' in NPZ file")?;
+        let sums: Array3<f64> = npz
+            .by_name("sums")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'sums' in NPZ file")?;
+
+        let unit = String::from_utf8(unit.to_vec())
+            .into_diagnostic()
+            .wrap_err("Invalid attribution unit")?
+            .parse::<AttributionUnit>()
+            .map_err(|e| miette!("Invalid attribution unit in {}: {e}", path.display()))?;
+        let units = String::from_utf8(units.to_vec())
+            .into_diagnostic()
+            .wrap_err("Invalid unit names")?
+            .split_terminator('\n')
+            .map(str::to_string)
+            .collect_vec();
+        let mut attribution = Attribution::new(unit, samples.iter().map(|&s| s as usize).collect());
+        if n.len() != NUM_CLASSES
+            || keys.ncols() != 2
+            || sums.dim() != (keys.nrows(), NUM_CLASSES, 2)
+            || keys.rows().into_iter().any(|key| {
+                key[0] as usize >= units.len() || key[1] as usize >= attribution.samples.len()
+            })
+        {
+            return Err(miette!(
+                "Inconsistent attribution in {}: {} units, {} samples, keys of shape {:?}, sums of shape {:?}",
+                path.display(),
+                units.len(),
+                attribution.samples.len(),
+                keys.dim(),
+                sums.dim()
+            ));
+        }
+        for name in &units {
+            attribution.unit_id(name);
+        }
+        for (key, entry_sums) in keys.rows().into_iter().zip(sums.outer_iter()) {
+            let class_sums: [[f64; 2]; NUM_CLASSES] =
+                std::array::from_fn(|class| [entry_sums[[class, 0]], entry_sums[[class, 1]]]);
+            attribution.sums.insert((key[0], key[1]), class_sums);
+        }
+        attribution.n = [n[0], n[1]];
+        Ok(attribution)
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn flagged_samples_follow_the_partition() {
+        let time_table = (0..50).collect_vec();
+        let labels = [0u16, 1, 2, 3, 2];
+        let meta_markers = labels
+            .iter()
+            .enumerate()
+            .map(|(trace, &label)| (10 * trace as u64, 10 * trace as u64 + 10, label))
+            .collect_vec();
+        // as with `--attribute --partition 2:*`
+        let partition: Partition = "2:*".parse().unwrap();
+        let flagged = FlaggedSamples::new(&[3], &time_table, &meta_markers, None, Some(&partition));
+        assert_eq!(
+            flagged.classes,
+            [Some(1), Some(1), Some(0), Some(1), Some(0)]
+        );
+        // the power of trace k at the flagged sample is k + 1
+        let mut attribution = Attribution::new(AttributionUnit::Signal, vec![3]);
+        attribution.add_run(
+            &flagged,
+            &["tb.a"],
+            |name| name,
+            |_, on_power| {
+                for trace in 0..labels.len() {
+                    on_power(10 * trace as u64 + 3, trace as f32 + 1.0);
+                }
+            },
+        );
+        assert_eq!(attribution.num_traces(), [2, 3]);
+        assert_eq!(
+            attribution.sums[&(0, 0)],
+            [[3.0 + 5.0, 9.0 + 25.0], [1.0 + 2.0 + 4.0, 1.0 + 4.0 + 16.0]]
+        );
+
+        // traces in neither group are left out
+        let partition: Partition = "0:1".parse().unwrap();
+        let flagged = FlaggedSamples::new(&[3], &time_table, &meta_markers, None, Some(&partition));
+        assert_eq!(flagged.classes, [Some(0), Some(1), None, None, None]);
+        assert!(flagged.at(23).is_none());
+    }
+}
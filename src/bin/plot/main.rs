@@ -1,13 +1,15 @@
 use clap::{Parser, Subcommand};
 use itertools::Itertools;
 use log::info;
-use ndarray::{Array1, Array2};
+use ndarray::Array1;
 use plotly::common::Mode;
 use plotly::{Plot, Scatter, plotly_static};
-use scalib::ttest;
 use scasim::plot::{plot_max_t_values, plot_t_traces};
-use std::fs::File;
+use scasim::trace_store::RunTraces;
+use scasim::ttest;
+use scasim::zarr_store::{CampaignStore, TRACES_PER_CHUNK};
 use std::path::{Path, PathBuf};
+use std::rc::Rc;
 
 #[derive(Parser, Debug)]
 #[clap(version)]
@@ -31,18 +33,21 @@ struct Args {
 
 #[derive(Subcommand, Debug)]
 enum Commands {
-    #[clap(name = "plot-traces", about = "Plot traces from a NPZ file")]
+    #[clap(
+        name = "plot-traces",
+        about = "Plot traces from a run directory, a traces.npy file or a legacy NPZ file"
+    )]
     PlotTraces {
         /// Indices of the traces to plot
         #[arg(value_name = "INDICES", index = 1)]
         trace_indices: Vec<usize>,
 
-        #[arg(value_name = "NPZ_FILE", index = 2)]
+        #[arg(value_name = "TRACES_PATH", index = 2)]
         filename: String,
     },
     #[clap(
         name = "ttest",
-        about = "Perform t-test on traces from accumulated NPZ files"
+        about = "Perform t-test on traces from stored runs (run directories, traces.npy or legacy NPZ files)"
     )]
     TTest {
         /// The highest order of t-test to perform
@@ -53,6 +58,9 @@ enum Commands {
         maybe_filenames: Option<Vec<String>>,
         #[arg(long = "npz-list", value_name = "NPZ_LIST_PATH")]
         maybe_npz_list_path: Option<String>,
+        /// Read the traces from a campaign-level Zarr store, one chunk of traces at a time
+        #[arg(long = "zarr", value_name = "ZARR_STORE")]
+        maybe_zarr_path: Option<String>,
     },
 }
 
@@ -83,22 +91,21 @@ fn main() -> miette::Result<()> {
                 panic!("No trace indices provided. Please specify at least one trace index.");
             }
 
-            // Load the NPZ file using a bufferred reader
-            let file = File::open(&filename).expect("Failed to open NPZ file");
-            let reader = std::io::BufReader::new(file);
-
-            // Parse the NPZ file
-            let mut npz = ndarray_npz::NpzReader::new(reader).expect("Failed to parse NPZ file");
-            let labels: Array1<u16> = npz
-                .by_name("labels")
-                .expect("Failed to find 'labels' in NPZ file");
+            let run_traces = RunTraces::open_path(&filename)?;
+            let traces = run_traces.traces();
+            let labels = run_traces.labels();
             // Create a plot and add the trace
             let mut plot = Plot::new();
             for index in &trace_indices {
-                let trace_name = format!("trace_{}", index);
-                let trace_data: Array1<f32> = npz
-                    .by_name(&trace_name)
-                    .expect(&format!("Failed to find '{}' in NPZ file", trace_name));
+                if *index >= traces.nrows() {
+                    panic!(
+                        "Trace index {} is out of range, {} has {} traces",
+                        index,
+                        filename,
+                        traces.nrows()
+                    );
+                }
+                let trace_data: Array1<f32> = traces.row(*index).to_owned();
 
                 let label = labels
                     .get(*index)
@@ -127,39 +134,74 @@ fn main() -> miette::Result<()> {
             order,
             maybe_filenames,
             maybe_npz_list_path: maybe_meta_list_path,
+            maybe_zarr_path,
         } => {
             assert!(order > 0, "Order must be greater than 0");
 
-            let filenames: Vec<PathBuf> = if let Some(meta_list_path) = maybe_meta_list_path {
-                let meta_root_path = PathBuf::from(&meta_list_path)
-                    .parent()
-                    .unwrap_or_else(|| {
-                        panic!(
-                            "Meta list path '{}' does not have a parent directory",
-                            meta_list_path
-                        )
-                    })
-                    .to_owned();
-                // Read the meta list file and collect filenames
-                std::fs::read_to_string(meta_list_path)
-                    .expect("Failed to read meta list file")
-                    .lines()
-                    .map(|line| {
-                        let trimmed = line.trim();
-                        if trimmed.is_empty() {
-                            panic!("Empty line in meta list file");
-                        }
-                        let mut p = PathBuf::from(trimmed);
-                        if !p.is_absolute() {
-                            p = meta_root_path.join(p);
-                        }
-                        p
+            // Each source of traces is loaded lazily, one at a time.
+            let sources: Vec<Box<dyn Fn() -> RunTraces>> = if let Some(zarr_path) = maybe_zarr_path
+            {
+                let campaign_store = Rc::new(CampaignStore::open(&zarr_path)?);
+                let (num_traces, samples_per_trace) = (
+                    campaign_store.num_traces(),
+                    campaign_store.samples_per_trace() as u64,
+                );
+                (0..num_traces)
+                    .step_by(TRACES_PER_CHUNK as usize)
+                    .map(|start| {
+                        let campaign_store = campaign_store.clone();
+                        let zarr_path = zarr_path.clone();
+                        Box::new(move || {
+                            let end = (start + TRACES_PER_CHUNK).min(num_traces);
+                            info!("Processing traces {}..{} of {}", start, end, zarr_path);
+                            let (traces, labels) = campaign_store
+                                .read_block(start..end, 0..samples_per_trace)
+                                .expect("Failed to read traces from the campaign store");
+                            RunTraces::Owned { traces, labels }
+                        }) as Box<dyn Fn() -> RunTraces>
                     })
                     .collect_vec()
-            } else if let Some(filenames) = maybe_filenames {
-                filenames.into_iter().map(PathBuf::from).collect_vec()
             } else {
-                panic!("No NPZ files provided. Please specify at least one NPZ file.");
+                let filenames: Vec<PathBuf> = if let Some(meta_list_path) = maybe_meta_list_path {
+                    let meta_root_path = PathBuf::from(&meta_list_path)
+                        .parent()
+                        .unwrap_or_else(|| {
+                            panic!(
+                                "Meta list path '{}' does not have a parent directory",
+                                meta_list_path
+                            )
+                        })
+                        .to_owned();
+                    // Read the meta list file and collect filenames
+                    std::fs::read_to_string(meta_list_path)
+                        .expect("Failed to read meta list file")
+                        .lines()
+                        .map(|line| {
+                            let trimmed = line.trim();
+                            if trimmed.is_empty() {
+                                panic!("Empty line in meta list file");
+                            }
+                            let mut p = PathBuf::from(trimmed);
+                            if !p.is_absolute() {
+                                p = meta_root_path.join(p);
+                            }
+                            p
+                        })
+                        .collect_vec()
+                } else if let Some(filenames) = maybe_filenames {
+                    filenames.into_iter().map(PathBuf::from).collect_vec()
+                } else {
+                    panic!("No NPZ files provided. Please specify at least one NPZ file.");
+                };
+                filenames
+                    .into_iter()
+                    .map(|filename| {
+                        Box::new(move || {
+                            info!("Processing file: {}", filename.display());
+                            RunTraces::open_path(&filename).expect("Failed to load traces")
+                        }) as Box<dyn Fn() -> RunTraces>
+                    })
+                    .collect_vec()
             };
 
             let mut samples_per_trace = 0;
@@ -168,49 +210,22 @@ fn main() -> miette::Result<()> {
 
             let mut maybe_ttacc: Option<ttest::Ttest> = None;
 
-            if filenames.is_empty() {
+            if sources.is_empty() {
                 panic!("No NPZ files provided. Please specify at least one NPZ file.");
             }
 
             let mut total_num_traces = 0;
 
-            let t_values = filenames
+            let t_values = sources
                 .iter()
-                .fold(None, |_, filename| {
-                    // Load the NPZ file using a bufferred reader
-                    let file = File::open(filename).expect("Failed to open NPZ file");
-                    let reader = std::io::BufReader::new(file);
-
-                    // Parse the NPZ file
-                    info!("Processing file: {}", filename.display());
-                    let mut npz_reader =
-                        ndarray_npz::NpzReader::new(reader).expect("Failed to parse NPZ file");
-                    let labels: Array1<u16> = npz_reader
-                        .by_name("labels")
-                        .expect("Failed to find 'labels' in NPZ file");
-
-                    let traces: Vec<Array1<f32>> = npz_reader
-                        .names()
-                        .expect("Failed to get names from NPZ file")
-                        .iter()
-                        .filter_map(|name| {
-                            name.starts_with("trace_").then(|| {
-                                npz_reader
-                                    .by_name(name.as_str())
-                                    .expect(&format!("Failed to find '{}' in NPZ file", name))
-                            })
-                        })
-                        .collect();
-                    let num_traces = traces.len();
+                .fold(None, |_, load_traces| {
+                    let run_traces = load_traces();
+                    let traces_array = run_traces.traces();
+                    let labels = run_traces.labels();
+                    let num_traces = traces_array.nrows();
 
                     total_num_traces += num_traces;
 
-                    let traces_array: Array2<f32> = Array2::from_shape_vec(
-                        (num_traces, traces[0].len()),
-                        traces.into_iter().flatten().collect(),
-                    )
-                    .expect("Failed to create traces array");
-
                     num_traces_so_far.push(
                         num_traces_so_far
                             .last()
@@ -233,7 +248,7 @@ fn main() -> miette::Result<()> {
                     }
 
                     if let Some(ref mut ttacc) = maybe_ttacc {
-                        ttacc.update(traces_array.view(), labels.view());
+                        ttacc.update(traces_array, labels);
 
                         let t_values = ttacc.get_ttest();
                         max_t_values
@@ -1,16 +1,20 @@
-use clap::Parser;
+use bytesize::ByteSize;
+use clap::{Parser, Subcommand};
 use itertools::Itertools;
 use log::*;
-use ndarray::{Array1, Array2, s};
+use miette::{Context, IntoDiagnostic, miette};
+use ndarray::{Array1, Array2, ArrayView1, ArrayView2, CowArray, Ix2, s};
 use ndarray_npz::{NpzReader, NpzWriter};
 use plotly::plotly_static;
-use rayon::prelude::{IntoParallelIterator, ParallelIterator};
-use scalib::ttest;
+use scasim::bivariate;
 use scasim::plot::*;
+use scasim::ttest;
 use scasim::*;
+use std::collections::HashSet;
 use std::fs::File;
-use std::io::Read;
+use std::io::{BufRead, BufReader, Read, Seek};
 use std::path::{Path, PathBuf};
+use std::sync::{Mutex, mpsc};
 
 #[derive(Parser, Debug)]
 #[command(name = "scasim-tvla")]
@@ -18,10 +22,19 @@ use std::path::{Path, PathBuf};
 #[command(version)]
 #[command(about = "Test-Vector Leakage Analysis", long_about = None)]
 struct Args {
+    #[command(subcommand)]
+    maybe_cmd: Option<Commands>,
+
     #[arg(long = "meta-json", value_name = "META_JSON")]
     maybe_metadata: Option<String>,
     #[arg(long = "meta-list", value_name = "META_LIST_PATH")]
     maybe_meta_list_path: Option<String>,
+    #[arg(
+        long = "meta-stdin",
+        help = "Read metadata file paths from standard input, one per line, and analyze each run as soon as its path arrives",
+        default_value_t = false
+    )]
+    meta_stdin: bool,
     #[arg(
         long,
         help = "disable multi-threaded loading of the waveform and signals",
@@ -40,6 +53,132 @@ struct Args {
         default_value_t = true
     )]
     show_progress: bool,
+    #[arg(
+        long,
+        help = "Generate the traces of FST waveforms in a single streaming pass over the file, instead of loading all signals into memory",
+        default_value_t = false
+    )]
+    fst_direct: bool,
+    #[arg(
+        long,
+        value_name = "SIZE",
+        help = "Load the signals of each waveform in batches, so that the time table, the power table and one batch of signals fit in SIZE (e.g. 8GiB)"
+    )]
+    max_memory: Option<ByteSize>,
+    #[arg(
+        long,
+        help = "Generate the power traces from a cache of the value changes of each run (toggles.npz next to its waveform), built on first use, so that other power models and signal selections do not decode the waveform again",
+        default_value_t = false
+    )]
+    toggle_cache: bool,
+    #[arg(
+        long,
+        help = "Accumulate the t-test moments of newly generated runs straight from their power trace, cutting one small batch of traces at a time, without building or saving the trace matrix",
+        default_value_t = false
+    )]
+    fused: bool,
+    #[arg(
+        long = "include",
+        value_name = "PATTERN",
+        help = "Only use the signals whose full hierarchical name, or an enclosing scope, matches the glob PATTERN (e.g. 'tb.dut.core'). Can be repeated."
+    )]
+    include_signals: Vec<String>,
+    #[arg(
+        long = "exclude",
+        value_name = "PATTERN",
+        help = "Skip the signals whose full hierarchical name, or an enclosing scope, matches the glob PATTERN (e.g. '*clk*'). Can be repeated."
+    )]
+    exclude_signals: Vec<String>,
+    #[arg(
+        long,
+        help = "Keep the signals that never change, instead of dropping them after loading",
+        default_value_t = false
+    )]
+    keep_constant_signals: bool,
+    #[arg(
+        long,
+        value_name = "MODEL",
+        help = "Power model of a value change: hd (Hamming distance), hw (Hamming weight of the new value), hd+hw, or mixed:HD_COEF,HW_COEF. Overrides the power_model of the metadata, defaults to hd."
+    )]
+    power_model: Option<PowerModelKind>,
+    #[arg(
+        long,
+        value_name = "POLICY",
+        help = "How bit transitions from or to an unknown level (x, z, ...) are counted: ignore, toggle (as a full toggle) or half (as half a toggle). Overrides the xz_policy of the metadata, defaults to half."
+    )]
+    xz_policy: Option<XzPolicy>,
+    #[arg(
+        long = "signal-weight",
+        value_name = "PATTERN=WEIGHT",
+        value_parser = parse_signal_weight,
+        help = "Scale the power of the signals whose full hierarchical name, or an enclosing scope, matches the glob PATTERN by WEIGHT. Can be repeated; overrides the signal weights of the metadata."
+    )]
+    signal_weights: Vec<(String, f32)>,
+    #[arg(
+        long,
+        help = "Only use the signals declared as registers",
+        default_value_t = false
+    )]
+    registers_only: bool,
+    #[arg(
+        long,
+        value_name = "START:END",
+        value_parser = parse_roi,
+        help = "Only analyze the region of interest [START, END) of each marker, in simulation time units relative to the start of the marker"
+    )]
+    roi: Option<(u64, u64)>,
+    #[arg(
+        long,
+        value_name = "TIME",
+        help = "Skip the value changes in gaps between markers that are at least TIME long (in simulation time units), defaults to the length of the longest marker"
+    )]
+    min_gap: Option<u64>,
+    #[arg(
+        long,
+        help = "Sample the power once per clock cycle, adding the power of all the value changes within each cycle, instead of only those at clock edges. Needs the clock period in the metadata.",
+        default_value_t = false
+    )]
+    bin_cycles: bool,
+    #[arg(
+        long,
+        value_name = "N",
+        help = "With --bin-cycles, split each clock cycle into N samples (phases)",
+        default_value_t = 1
+    )]
+    phases: u64,
+    #[arg(
+        long,
+        value_name = "UNIT",
+        help = "Attribute the leakage at the flagged samples to each signal or scope (signal, scope), ranked by t-statistic in attribution.csv. The power traces are generated from the toggle cache."
+    )]
+    attribute: Option<AttributionUnit>,
+    #[arg(
+        long = "attribute-samples",
+        value_name = "START:END",
+        value_parser = parse_roi,
+        help = "Samples [START, END) of each trace to attribute. Can be repeated; defaults to the samples above the t-test threshold in the t_values.npz of a previous analysis in the output directory."
+    )]
+    attribute_samples: Vec<(u64, u64)>,
+    #[arg(
+        long,
+        value_name = "N",
+        help = "Attribute at most the N flagged samples of the previous analysis with the largest |t|",
+        default_value_t = 64
+    )]
+    attribute_max_samples: usize,
+    #[arg(
+        long,
+        value_name = "START:END",
+        value_parser = parse_roi,
+        help = "Also run a bivariate second-order t-test on the centred products of all the pairs of samples in [START, END) of each trace, saved to bivariate_t_values.npz. Needs the traces of every run, so stored moments are not reused and --fused is ignored."
+    )]
+    bivariate: Option<(u64, u64)>,
+    #[arg(
+        long = "partition",
+        value_name = "GROUP:GROUP",
+        help = "Test the traces whose label is in the first group (comma-separated labels, or * for all others) against those in the second one, e.g. 0:1, 2:* or 0,1:2,3. Can be repeated: all the partitions are tested on the same traces, and the first one is plotted. Defaults to the labels 0 and 1."
+    )]
+    partitions: Vec<Partition>,
     /// The highest order of t-test to perform
     #[arg(short = 'd', default_value_t = 2)]
     order: usize,
@@ -58,8 +197,13 @@ struct Args {
     plot: bool,
     #[arg(
         long = "use-existing",
-        help = "Skip generation of power trace data if the NPZ file already exists and is not older than the corresponding trace file. Use their stored data instead.",
-        default_value_t = true
+        value_name = "BOOL",
+        help = "Use the stored traces (traces.npy) and moments (moments.npz) of a run instead of generating them, if they are not older than its trace file and were generated with the same parameters (power model, X/Z policy, signal selection and weights, ROI, gaps and binning). --use-existing=false always regenerates them.",
+        num_args = 0..=1,
+        require_equals = true,
+        default_value_t = true,
+        default_missing_value = "true",
+        action = clap::ArgAction::Set
     )]
     use_existing: bool,
     #[arg(
@@ -69,6 +213,138 @@ struct Args {
         default_value = ""
     )]
     ttest_output_dir: String,
+    #[arg(
+        long,
+        value_name = "PROGRESS_JSON",
+        help = "Rewrite this JSON file with the max |t| trajectory after each ingested run"
+    )]
+    progress_file: Option<PathBuf>,
+    #[arg(
+        long,
+        value_name = "ZARR_STORE",
+        help = "Append the traces of each run to this campaign-level Zarr store, instead of saving traces.npy in each run directory"
+    )]
+    zarr_store: Option<PathBuf>,
+    #[arg(
+        long,
+        value_name = "K",
+        help = "Maximum number of runs whose traces are held in memory at once, defaults to the number of threads"
+    )]
+    queue_depth: Option<usize>,
+    #[arg(
+        long,
+        help = "Keep running and ingest the runs appended to the meta list as they arrive, periodically rewriting the results. The accumulated state is saved to the output directory and restored on restart.",
+        requires = "maybe_meta_list_path",
+        default_value_t = false
+    )]
+    watch: bool,
+    #[arg(
+        long,
+        value_name = "SECONDS",
+        help = "Interval between polls of the meta list, and between rewrites of the results, in watch mode",
+        default_value_t = 30
+    )]
+    watch_interval: u64,
+}
+
+#[derive(Subcommand, Debug)]
+enum Commands {
+    #[clap(
+        name = "merge",
+        about = "Merge the t-test moments of runs and campaign shards into the final t-test results, without reading their traces"
+    )]
+    Merge {
+        /// Moments files (moments.npz or campaign_moments.npz), or directories to search for per-run moments.npz files
+        #[arg(value_name = "MOMENTS_PATH", num_args = 1.., required = true)]
+        paths: Vec<PathBuf>,
+    },
+}
+
+/// Parse a region of interest `START:END`, relative to the start of each marker.
+fn parse_roi(roi: &str) -> Result<(u64, u64), String> {
+    let (start, end) = roi
+        .split_once(':')
+        .ok_or_else(|| format!("expected START:END, found '{roi}'"))?;
+    let start = start.trim().parse::<u64>().map_err(|e| e.to_string())?;
+    let end = end.trim().parse::<u64>().map_err(|e| e.to_string())?;
+    if end <= start {
+        return Err(format!("END ({end}) must be greater than START ({start})"));
+    }
+    Ok((start, end))
+}
+
+/// Parse a signal weight `PATTERN=WEIGHT`.
+fn parse_signal_weight(signal_weight: &str) -> Result<(String, f32), String> {
+    let (pattern, weight) = signal_weight
+        .rsplit_once('=')
+        .ok_or_else(|| format!("expected PATTERN=WEIGHT, found '{signal_weight}'"))?;
+    let weight = weight.trim().parse::<f32>().map_err(|e| e.to_string())?;
+    Ok((pattern.to_string(), weight))
+}
+
+/// The power model of a run, and whether the metadata restricts it to registers.
+/// The command-line options take precedence over the `power_model` entry of the metadata, which is either the name
+/// of a model (as for `--power-model`) or an object with optional `model`, `signal_weights` (an object mapping
+/// patterns to weights), `xz_policy` and `registers_only` entries.
+fn run_power_model(
+    args: &Args,
+    metadata_json: &serde_json::Value,
+) -> miette::Result<(PowerModel, bool)> {
+    let maybe_meta_model = metadata_json.get("power_model");
+    let kind = match args.power_model {
+        Some(kind) => kind,
+        None => match maybe_meta_model.and_then(|v| {
+            v.as_str()
+                .or_else(|| v.get("model").and_then(|v| v.as_str()))
+        }) {
+            Some(name) => name
+                .parse::<PowerModelKind>()
+                .map_err(|e| miette!("Invalid power model in the metadata: {e}"))?,
+            None => PowerModelKind::default(),
+        },
+    };
+    let xz_policy = match args.xz_policy {
+        Some(xz_policy) => xz_policy,
+        None => match maybe_meta_model
+            .and_then(|v| v.get("xz_policy"))
+            .and_then(|v| v.as_str())
+        {
+            Some(name) => name
+                .parse::<XzPolicy>()
+                .map_err(|e| miette!("Invalid X/Z policy in the metadata: {e}"))?,
+            None => XzPolicy::default(),
+        },
+    };
+    let signal_weights = run_signal_weights(args, metadata_json);
+    let registers_only = maybe_meta_model
+        .and_then(|v| v.get("registers_only"))
+        .and_then(|v| v.as_bool())
+        .unwrap_or(false);
+    Ok((
+        PowerModel::new(kind, xz_policy, &signal_weights)?,
+        registers_only,
+    ))
+}
+
+/// The signal weights of a run: those of the command line, or else those of the power model of its metadata.
+fn run_signal_weights(args: &Args, metadata_json: &serde_json::Value) -> Vec<(String, f32)> {
+    if args.signal_weights.is_empty() {
+        metadata_json
+            .get("power_model")
+            .and_then(|v| v.get("signal_weights"))
+            .and_then(|v| v.as_object())
+            .map(|weights| {
+                weights
+                    .iter()
+                    .filter_map(|(pattern, weight)| {
+                        Some((pattern.clone(), weight.as_f64()? as f32))
+                    })
+                    .collect_vec()
+            })
+            .unwrap_or_default()
+    } else {
+        args.signal_weights.clone()
+    }
 }
 
 fn get_metadata<P: AsRef<Path>>(
@@ -120,214 +396,779 @@ fn cut_trace(
     (all_traces, trace_labels)
 }
 
-fn main() -> miette::Result<()> {
-    let args = Args::parse();
+/// |t| above which a sample is considered to leak.
+const T_THRESHOLD: f64 = 4.5;
 
-    // set default log level to info
-    env_logger::Builder::from_env(env_logger::Env::default().default_filter_or("info"))
-        .format_timestamp(None)
-        .init();
+/// Number of traces cut into the reusable buffer of [`ttest_from_power_table`] at a time.
+const FUSED_BATCH_TRACES: usize = 1024;
 
-    let filenames: Vec<PathBuf> = if let Some(meta_list_path) = args.maybe_meta_list_path {
-        let meta_root_path = PathBuf::from(&meta_list_path)
-            .parent()
-            .unwrap_or_else(|| {
-                panic!(
-                    "Meta list path '{}' does not have a parent directory",
-                    meta_list_path
-                )
-            })
-            .to_owned();
-        // Read the meta list file and collect filenames
-        std::fs::read_to_string(meta_list_path)
-            .expect("Failed to read meta list file")
-            .lines()
-            .filter_map(|line| {
-                let trimmed = line.trim();
-                if trimmed.is_empty() {
-                    return None; // Skip empty lines
-                }
-                let mut p = PathBuf::from(trimmed);
-                if !p.is_absolute() {
-                    p = meta_root_path.join(p);
-                }
-                Some(p)
-            })
-            .collect_vec()
-    } else if let Some(filename) = args.maybe_metadata {
-        vec![PathBuf::from(filename)]
+/// Accumulate a batch of traces into the t-test of each partition, or of the labels 0 and 1 if there are none.
+fn update_ttaccs(
+    ttaccs: &mut [ttest::Ttest],
+    partitions: &[Partition],
+    traces: ArrayView2<f32>,
+    labels: ArrayView1<u16>,
+) {
+    if partitions.is_empty() {
+        ttaccs[0].update(traces, labels);
     } else {
-        panic!("No meta files provided. Please specify at least one NPZ file.");
-    };
-    let order = args.order;
+        for (ttacc, partition) in ttaccs.iter_mut().zip(partitions) {
+            partition.update(ttacc, traces, labels);
+        }
+    }
+}
 
-    let mut samples_per_trace = 0;
-    let mut max_t_values = vec![Vec::<f64>::new(); order];
-    let mut num_traces_so_far = vec![];
-    // Initial max |t| is 0.0 for each order corresponding to 0 traces
-    max_t_values.iter_mut().for_each(|v| {
-        v.push(0.0);
-    });
-    num_traces_so_far.push(0);
+/// Accumulate the traces delimited by the markers straight from the power table, without building the full
+/// trace matrix: each batch of traces is cut into a small reusable buffer, zero-padded as in [`cut_trace`].
+/// Returns the t-test of each partition (see [`update_ttaccs`]).
+fn ttest_from_power_table(
+    power_table: &[f32],
+    time_table: &[u64],
+    meta_markers: &[(u64, u64, u16)],
+    order: usize,
+    partitions: &[Partition],
+) -> Vec<ttest::Ttest> {
+    let time_indices_and_labels = markers_to_time_indices(meta_markers, time_table);
+    let max_len = time_indices_and_labels
+        .iter()
+        .map(|(lo, hi, _)| hi - lo)
+        .max()
+        .unwrap_or(0);
 
-    let mut maybe_ttacc: Option<ttest::Ttest> = None;
+    let mut ttaccs = vec![ttest::Ttest::new(max_len, order); partitions.len().max(1)];
+    let batch_size = FUSED_BATCH_TRACES.min(time_indices_and_labels.len());
+    let mut batch_traces = Array2::<f32>::zeros((batch_size, max_len));
+    let mut batch_labels = Array1::<u16>::zeros(batch_size);
+    for batch in time_indices_and_labels.chunks(FUSED_BATCH_TRACES) {
+        for (i, &(start_idx, end_idx, label)) in batch.iter().enumerate() {
+            batch_labels[i] = label;
+            let len = end_idx - start_idx;
+            let mut row = batch_traces.row_mut(i);
+            row.slice_mut(s![..len])
+                .assign(&ArrayView1::from(&power_table[start_idx..end_idx]));
+            row.slice_mut(s![len..]).fill(0.0);
+        }
+        update_ttaccs(
+            &mut ttaccs,
+            partitions,
+            batch_traces.slice(s![..batch.len(), ..]),
+            batch_labels.slice(s![..batch.len()]),
+        );
+    }
+    ttaccs
+}
+
+fn meta_list_root(meta_list_path: &Path) -> PathBuf {
+    meta_list_path
+        .parent()
+        .unwrap_or_else(|| {
+            panic!(
+                "Meta list path '{}' does not have a parent directory",
+                meta_list_path.display()
+            )
+        })
+        .to_owned()
+}
 
-    if filenames.is_empty() {
-        panic!("No meta files provided. Please specify at least one NPZ file.");
+/// The metadata path of a line of a meta list, relative to the directory of the list.
+fn meta_list_entry(meta_root_path: &Path, line: &str) -> Option<PathBuf> {
+    let trimmed = line.trim();
+    if trimmed.is_empty() {
+        return None; // Skip empty lines
+    }
+    let mut p = PathBuf::from(trimmed);
+    if !p.is_absolute() {
+        p = meta_root_path.join(p);
     }
+    Some(p)
+}
 
-    let npz_filename = "traces.npz";
+fn read_meta_list<P: AsRef<Path>>(meta_list_path: P) -> Vec<PathBuf> {
+    let meta_list_path = meta_list_path.as_ref();
+    let meta_root_path = meta_list_root(meta_list_path);
+    // Read the meta list file and collect filenames
+    std::fs::read_to_string(meta_list_path)
+        .expect("Failed to read meta list file")
+        .lines()
+        .filter_map(|line| meta_list_entry(&meta_root_path, line))
+        .collect_vec()
+}
 
-    args.num_threads.iter().for_each(|&n| {
-        rayon::ThreadPoolBuilder::new()
-            .num_threads(n)
-            .build_global()
-            .unwrap()
-    });
+/// Follows a meta list that is appended to by running simulations, yielding each new entry once.
+/// Only complete lines are consumed, and `next` blocks until a new entry arrives.
+struct MetaListTail {
+    meta_list_path: PathBuf,
+    meta_root_path: PathBuf,
+    poll_interval: std::time::Duration,
+    /// length of the consumed part of the meta list
+    offset: u64,
+    pending: std::collections::VecDeque<PathBuf>,
+    seen: HashSet<PathBuf>,
+}
 
-    let default_num_threads = rayon::current_num_threads();
+impl MetaListTail {
+    fn new(
+        meta_list_path: PathBuf,
+        poll_interval: std::time::Duration,
+        seen: HashSet<PathBuf>,
+    ) -> Self {
+        MetaListTail {
+            meta_root_path: meta_list_root(&meta_list_path),
+            meta_list_path,
+            poll_interval,
+            offset: 0,
+            pending: Default::default(),
+            seen,
+        }
+    }
 
+    fn poll(&mut self) -> std::io::Result<()> {
+        let mut file = match File::open(&self.meta_list_path) {
+            Ok(file) => file,
+            // the list is created by the first finished run
+            Err(e) if e.kind() == std::io::ErrorKind::NotFound => return Ok(()),
+            Err(e) => return Err(e),
+        };
+        if file.metadata()?.len() < self.offset {
+            warn!(
+                "Meta list {} was truncated, reading it again",
+                self.meta_list_path.display()
+            );
+            self.offset = 0;
+        }
+        file.seek(std::io::SeekFrom::Start(self.offset))?;
+        let mut appended = String::new();
+        file.read_to_string(&mut appended)?;
+        let complete_len = appended.rfind('\n').map_or(0, |i| i + 1);
+        self.offset += complete_len as u64;
+        for line in appended[..complete_len].lines() {
+            if let Some(metadata_path) = meta_list_entry(&self.meta_root_path, line) {
+                if self.seen.insert(metadata_path.clone()) {
+                    self.pending.push_back(metadata_path);
+                }
+            }
+        }
+        Ok(())
+    }
+}
+
+impl Iterator for MetaListTail {
+    type Item = PathBuf;
+
+    fn next(&mut self) -> Option<PathBuf> {
+        loop {
+            if let Some(metadata_path) = self.pending.pop_front() {
+                return Some(metadata_path);
+            }
+            if let Err(e) = self.poll() {
+                error!(
+                    "Failed to read meta list {}: {}",
+                    self.meta_list_path.display(),
+                    e
+                );
+            }
+            if self.pending.is_empty() {
+                std::thread::sleep(self.poll_interval);
+            }
+        }
+    }
+}
+
+/// Whether the file `derived` exists and is newer than its `source`, which may have been deleted since.
+fn is_up_to_date(derived: &Path, source: &Path) -> bool {
+    if !derived.exists() {
+        return false;
+    }
+    if !source.exists() {
+        return true;
+    }
+    let derived_modified = std::fs::metadata(derived).and_then(|m| m.modified());
+    let source_modified = std::fs::metadata(source).and_then(|m| m.modified());
+    if let (Ok(derived_modified), Ok(source_modified)) = (derived_modified, source_modified) {
+        derived_modified > source_modified
+    } else {
+        false
+    }
+}
+
+/// The toggle cache of a run, loaded from `run_dir` if it is newer than the waveform, or else built from the waveform
+/// and saved there.
+fn load_toggle_cache(run_dir: &Path, trace_file_path: &Path, args: &Args) -> ToggleCache {
+    let cache_path = run_dir.join(TOGGLES_NPZ);
+    if is_up_to_date(&cache_path, trace_file_path) {
+        match ToggleCache::load(&cache_path) {
+            Ok(toggle_cache) => {
+                println!("Using the toggle cache {}", cache_path.display());
+                return toggle_cache;
+            }
+            Err(e) => warn!("Rebuilding the toggle cache: {:?}", e),
+        }
+    }
     println!(
-        "Using {} threads for parallel processing",
-        default_num_threads
+        "Building the toggle cache of {}...",
+        trace_file_path.display()
     );
+    let start_time = std::time::Instant::now();
+    let toggle_cache =
+        ToggleCache::from_waveform(trace_file_path, !args.single_thread, args.show_progress)
+            .expect("Failed to load waveform!");
+    println!(
+        "It took {:.2}s to cache {} changes of {} signals",
+        start_time.elapsed().as_secs_f32(),
+        toggle_cache.num_changes(),
+        toggle_cache.num_signals()
+    );
+    if let Err(e) = toggle_cache.save(&cache_path) {
+        error!("Failed to save the toggle cache: {:?}", e);
+    }
+    toggle_cache
+}
+
+/// Path of the trace file of a run, relative to the directory of its metadata file.
+fn trace_file_path(metadata_path: &Path, metadata_json: &serde_json::Value) -> PathBuf {
+    let trace_filename = metadata_json
+        .get("trace_filename")
+        .and_then(|v| v.as_str())
+        .expect("trace_filename not found in metadata");
+    metadata_path
+        .parent()
+        .expect("Failed to get parent folder of metadata file")
+        .join(trace_filename)
+}
+
+/// Parameters of the stored traces and moments of each run, by sidecar file name, saved in its run directory.
+const SIDECAR_PARAMS_JSON: &str = "sidecar_params.json";
 
+/// The parameters that the power traces of a run are generated with. The stored traces and moments of a run are only
+/// used if they were generated with the same parameters.
+fn generation_params(
+    args: &Args,
+    metadata_json: &serde_json::Value,
+) -> miette::Result<serde_json::Value> {
+    let (power_model, registers_only) = run_power_model(args, metadata_json)?;
+    Ok(serde_json::json!({
+        "power_model": power_model.kind.to_string(),
+        "xz_policy": power_model.xz_policy.to_string(),
+        // as text, so that the weights compare equal after a round trip
+        "signal_weights": run_signal_weights(args, metadata_json)
+            .iter()
+            .map(|(pattern, weight)| format!("{pattern}={weight}"))
+            .collect_vec(),
+        "include": args.include_signals,
+        "exclude": args.exclude_signals,
+        "keep_constant_signals": args.keep_constant_signals,
+        "registers_only": args.registers_only || registers_only,
+        "roi": args.roi,
+        "min_gap": args.min_gap,
+        "bin_phases": args.bin_cycles.then_some(args.phases),
+    }))
+}
+
+/// Whether the sidecar `name` of the run in `run_dir` was generated with `params`. Sidecars without recorded
+/// parameters, saved by earlier versions, are not.
+fn sidecar_matches(run_dir: &Path, name: &str, params: &serde_json::Value) -> bool {
+    std::fs::read(run_dir.join(SIDECAR_PARAMS_JSON))
+        .ok()
+        .and_then(|json| serde_json::from_slice::<serde_json::Value>(&json).ok())
+        .is_some_and(|recorded| recorded.get(name) == Some(params))
+}
+
+/// Record that the sidecar `name` of the run in `run_dir` was generated with `maybe_params`, or forget its parameters
+/// if `None`, before the sidecar is rewritten.
+fn record_sidecar_params(
+    run_dir: &Path,
+    name: &str,
+    maybe_params: Option<&serde_json::Value>,
+) -> std::io::Result<()> {
+    let params_path = run_dir.join(SIDECAR_PARAMS_JSON);
+    let mut recorded = std::fs::read(&params_path)
+        .ok()
+        .and_then(|json| serde_json::from_slice::<serde_json::Value>(&json).ok())
+        .filter(|recorded| recorded.is_object())
+        .unwrap_or_else(|| serde_json::json!({}));
+    match maybe_params {
+        Some(params) => recorded[name] = params.clone(),
+        None => {
+            recorded.as_object_mut().unwrap().remove(name);
+        }
+    }
+    write_json_atomic(&params_path, &recorded)
+}
 
-    let collected_traces = filenames.into_par_iter().filter_map(|metadata_path| {
-        if !metadata_path.exists() {
-            log::error!(
-                "Metadata file '{}' does not exist!",
-                metadata_path.display()
+/// Load the t-test accumulator of a run from its moments sidecar, if it is up to date, generated with the same
+/// parameters and of a high enough order, or compute it from the traces of the run and save the sidecar.
+/// The traces are also returned if `keep_traces` is set, and the sidecar is then not used.
+/// Otherwise, with `--fused`, the moments of newly generated runs are accumulated without building their traces.
+/// With `--bivariate`, the co-moments of the pairs of the window are also accumulated, from the traces.
+/// With `--partition`, the moments of each partition are accumulated, and the sidecar is neither used nor saved.
+fn load_run_ttest(
+    metadata_path: &Path,
+    args: &Args,
+    selection: &SignalSelection,
+    keep_traces: bool,
+    maybe_attribution: Option<&Mutex<Attribution>>,
+) -> Option<RunAccumulators> {
+    let run_dir = metadata_path.parent()?;
+    let moments_path = run_dir.join(ttest::MOMENTS_NPZ);
+    if !metadata_path.exists() {
+        log::error!(
+            "Metadata file '{}' does not exist!",
+            metadata_path.display()
+        );
+        return None;
+    }
+    let metadata_json = get_metadata(
+        metadata_path,
+        metadata_path.extension().is_some_and(|ext| ext == "gz"),
+    )
+    .expect("Failed to load metadata!");
+    let params = generation_params(args, &metadata_json).expect("Invalid power model");
+    // the attribution needs the value changes of every run, and the bivariate test their traces
+    let needs_traces = args.bivariate.is_some();
+    // the sidecar holds the moments of the labels 0 and 1 only
+    let uses_sidecar = args.partitions.is_empty();
+    if args.use_existing
+        && !keep_traces
+        && !needs_traces
+        && uses_sidecar
+        && maybe_attribution.is_none()
+        && moments_path.exists()
+    {
+        if !sidecar_matches(run_dir, ttest::MOMENTS_NPZ, &params) {
+            info!(
+                "Moments in {} were generated with other parameters, recomputing them",
+                moments_path.display()
             );
-            return None;
+        } else if is_up_to_date(
+            &moments_path,
+            &trace_file_path(metadata_path, &metadata_json),
+        ) {
+            match ttest::Ttest::load(&moments_path) {
+                Ok(run_ttacc) if run_ttacc.order() >= args.order => {
+                    println!("Using existing moments from {}", moments_path.display());
+                    return Some(RunAccumulators {
+                        ttacc: run_ttacc.with_order(args.order),
+                        partition_ttaccs: Vec::new(),
+                        maybe_bivariate: None,
+                        maybe_attribution: None,
+                        maybe_traces: None,
+                    });
+                }
+                Ok(run_ttacc) => info!(
+                    "Moments in {} are of order {} < {}, recomputing them",
+                    moments_path.display(),
+                    run_ttacc.order(),
+                    args.order
+                ),
+                Err(e) => warn!("Failed to load {}: {:?}", moments_path.display(), e),
+            }
         }
+    }
 
-        let metadata_json = get_metadata(
-            &metadata_path,
-            metadata_path.extension().map_or(false, |ext| ext == "gz"),
-        )
-        .expect("Failed to load metadata!");
+    let (run_data, maybe_run_attribution) = load_run_traces(
+        metadata_path,
+        args,
+        selection,
+        args.fused && !keep_traces && !needs_traces,
+        maybe_attribution,
+    )?;
+    let (mut run_ttaccs, maybe_run_bivariate, maybe_run_traces) = match run_data {
+        RunData::Traces(run_traces) => {
+            let traces = run_traces.traces();
+            let mut run_ttaccs =
+                vec![ttest::Ttest::new(traces.ncols(), args.order); args.partitions.len().max(1)];
+            update_ttaccs(
+                &mut run_ttaccs,
+                &args.partitions,
+                traces,
+                run_traces.labels(),
+            );
+            let maybe_run_bivariate = args.bivariate.map(|(start, end)| {
+                let start_time = std::time::Instant::now();
+                let mut run_bivariate =
+                    bivariate::BivariateTtest::new(start as usize, (end - start) as usize);
+                // the bivariate test is of the first partition
+                match args.partitions.first() {
+                    Some(partition) => run_bivariate
+                        .update_rows(traces, &partition.class_rows(run_traces.labels())),
+                    None => run_bivariate.update(traces, run_traces.labels()),
+                }
+                println!(
+                    "Accumulated the co-moments of {} sample pairs in {:.2}s",
+                    bivariate::num_pairs((end - start) as usize),
+                    start_time.elapsed().as_secs_f32()
+                );
+                run_bivariate
+            });
+            (
+                run_ttaccs,
+                maybe_run_bivariate,
+                keep_traces.then_some(run_traces),
+            )
+        }
+        RunData::Moments(run_ttaccs) => (run_ttaccs, None, None),
+    };
+    let run_ttacc = run_ttaccs.remove(0);
+    if uses_sidecar {
+        if let Err(e) = record_sidecar_params(run_dir, ttest::MOMENTS_NPZ, None) {
+            error!("Failed to record the parameters of the moments: {:?}", e);
+        } else if let Err(e) = run_ttacc.save(&moments_path) {
+            error!(
+                "Failed to save moments to {}: {:?}",
+                moments_path.display(),
+                e
+            );
+        } else if let Err(e) = record_sidecar_params(run_dir, ttest::MOMENTS_NPZ, Some(&params)) {
+            error!("Failed to record the parameters of the moments: {:?}", e);
+        }
+    }
+    Some(RunAccumulators {
+        ttacc: run_ttacc,
+        partition_ttaccs: run_ttaccs,
+        maybe_bivariate: maybe_run_bivariate,
+        maybe_attribution: maybe_run_attribution,
+        maybe_traces: maybe_run_traces,
+    })
+}
 
-        let parent_folder_path = metadata_path
-            .parent()
-            .expect("Failed to get parent folder of metadata file")
-            .to_path_buf();
+/// The traces of a run, or only their t-test moments (of each partition) if they were accumulated without building
+/// the traces.
+enum RunData {
+    Traces(RunTraces),
+    Moments(Vec<ttest::Ttest>),
+}
 
-        let trace_filename = metadata_json
-            .get("trace_filename")
-            .and_then(|v| v.as_str())
-            .expect("trace_filename not found in metadata");
+/// The accumulators of a run, and its traces if they are kept.
+struct RunAccumulators {
+    /// t-test of the labels, or of the first partition
+    ttacc: ttest::Ttest,
+    /// t-tests of the other partitions
+    partition_ttaccs: Vec<ttest::Ttest>,
+    maybe_bivariate: Option<bivariate::BivariateTtest>,
+    /// attribution of the run, with `--attribute`
+    maybe_attribution: Option<Attribution>,
+    maybe_traces: Option<RunTraces>,
+}
+
+/// Load (or generate) the traces and labels of a single simulation run, given the path to its metadata file.
+/// If `fused` is set, newly generated traces are neither saved nor, when generated from a power trace, built:
+/// their moments are accumulated with [`ttest_from_power_table`] instead.
+/// If `maybe_attribution` is set, the traces are generated from the toggle cache, and the power of their signals at
+/// its flagged samples is accumulated into an attribution of the run, returned along with the traces. It is merged
+/// into the campaign once the run is ingested.
+fn load_run_traces(
+    metadata_path: &Path,
+    args: &Args,
+    selection: &SignalSelection,
+    fused: bool,
+    maybe_attribution: Option<&Mutex<Attribution>>,
+) -> Option<(RunData, Option<Attribution>)> {
+    if !metadata_path.exists() {
+        log::error!(
+            "Metadata file '{}' does not exist!",
+            metadata_path.display()
+        );
+        return None;
+    }
+
+    let metadata_json = get_metadata(
+        metadata_path,
+        metadata_path.extension().is_some_and(|ext| ext == "gz"),
+    )
+    .expect("Failed to load metadata!");
 
-        let trace_file_path = parent_folder_path.join(trace_filename);
+    let parent_folder_path = metadata_path
+        .parent()
+        .expect("Failed to get parent folder of metadata file")
+        .to_path_buf();
 
-        let npz_path = parent_folder_path.join(npz_filename);
+    let trace_file_path = trace_file_path(metadata_path, &metadata_json);
 
-        let use_existing = if args.use_existing && npz_path.exists() {
-            if !trace_file_path.exists() {
-                true
+    let maybe_stored_path = stored_traces_path(&parent_folder_path);
+
+    let params = generation_params(args, &metadata_json).expect("Invalid power model");
+
+    let use_existing = match &maybe_stored_path {
+        Some(stored_path) if args.use_existing && maybe_attribution.is_none() => {
+            is_up_to_date(stored_path, &trace_file_path)
+                && sidecar_matches(&parent_folder_path, TRACES_NPY, &params)
+        }
+        _ => false,
+    };
+
+    if use_existing {
+        println!(
+            "Using existing traces and labels from {}",
+            maybe_stored_path.unwrap().display()
+        );
+        let run_traces =
+            RunTraces::open(&parent_folder_path).expect("Failed to load the stored traces");
+        Some((RunData::Traces(run_traces), None))
+    } else {
+        let clock_period = metadata_json.get("clock_period").and_then(|v| v.as_u64());
+        let cp = clock_period.unwrap_or_default();
+        let (power_model, registers_only) =
+            run_power_model(args, &metadata_json).expect("Invalid power model");
+        let selection = &selection.with_registers_only(selection.registers_only || registers_only);
+        info!(
+            "Power model: {}, X/Z policy: {}{}{}",
+            power_model.kind,
+            power_model.xz_policy,
+            if power_model.has_weights() {
+                ", weighted signals"
             } else {
-                // Check if the npz file is older than the trace file
-                let npz_modified = std::fs::metadata(&npz_path).and_then(|m| m.modified());
-                let trace_modified = std::fs::metadata(&trace_file_path).and_then(|m| m.modified());
-                if let (Ok(npz_modified), Ok(trace_modified)) = (npz_modified, trace_modified) {
-                    // Use existing if npz file is newer than trace file
-                    npz_modified > trace_modified
-                } else {
-                    false
-                }
+                ""
+            },
+            if selection.registers_only {
+                ", registers only"
+            } else {
+                ""
             }
-        } else {
-            false
+        );
+        // .expect("clock_period not found in the metadata"); // FIXME optional
+        let meta_markers = metadata_json
+            .get("markers")
+            .map(|v| {
+                v.as_array()
+                    .unwrap()
+                    .into_iter()
+                    .map(|e| {
+                        let (start_time, end_time, label) = e
+                            .as_array()
+                            .unwrap()
+                            .into_iter()
+                            .map(|i| i.as_u64().unwrap())
+                            .collect_tuple()
+                            .unwrap();
+                        (start_time, end_time, label as u16)
+                    })
+                    .collect_vec()
+            })
+            .expect("markers not found in metadata");
+        let meta_markers = match args.roi {
+            Some(roi) => apply_roi(&meta_markers, roi),
+            None => meta_markers,
         };
-
-        if use_existing {
-            println!(
-                "Using existing traces and labels from {}",
-                npz_path.display()
-            );
-            let mut npz_reader =
-                NpzReader::new(File::open(&npz_path).expect("Failed to open npz file"))
-                    .expect("Failed to read npz file");
-            let labels_array: Array1<u16> = npz_reader
-                .by_name("labels")
-                .expect("Failed to find 'labels' in NPZ file");
-
-            let traces: Vec<Array1<f32>> = npz_reader
-                .names()
-                .expect("Failed to get names from NPZ file")
+        // only the value changes within the markers are decoded (FST) or turned into power
+        let min_gap = args.min_gap.unwrap_or_else(|| {
+            meta_markers
                 .iter()
-                .filter_map(|name| {
-                    name.starts_with("trace_").then(|| {
-                        npz_reader
-                            .by_name(name.as_str())
-                            .expect(&format!("Failed to find '{}' in NPZ file", name))
-                    })
-                })
-                .collect_vec();
-            let num_traces = traces.len();
-            let traces_array: Array2<f32> = Array2::from_shape_vec(
-                (num_traces, traces[0].len()),
-                traces.into_iter().flatten().collect(),
-            )
-            .expect("Failed to create traces array");
-            Some((traces_array, labels_array))
-        } else {
-            let clock_period = metadata_json.get("clock_period").and_then(|v| v.as_u64());
-            let cp = clock_period.unwrap_or_default();
-            // .expect("clock_period not found in the metadata"); // FIXME optional
-            let meta_markers = metadata_json
-                .get("markers")
-                .map(|v| {
-                    v.as_array()
-                        .unwrap()
-                        .into_iter()
-                        .map(|e| {
-                            let (start_time, end_time, label) =  e.as_array()
-                                .unwrap()
-                                .into_iter()
-                                .map(|i| i.as_u64().unwrap())
-                                .collect_tuple().unwrap();
-                            (start_time, end_time, label as u16)
-                        })
-                        .collect_vec()
-                })
-                .expect("markers not found in metadata");
+                .map(|&(start_time, end_time, _)| end_time.saturating_sub(start_time))
+                .max()
+                .unwrap_or(0)
+        });
+        let time_spans = marker_spans(&meta_markers, min_gap);
+        debug!(
+            "{} markers in {} time spans",
+            meta_markers.len(),
+            time_spans.len()
+        );
 
-            if false {
-                let (traces_array, labels_array, _) = traces_from_fst(
-                    &trace_file_path,
-                    &meta_markers,
-                    |t| clock_period.map(|cp| t % cp == 0).unwrap_or(true),
-                ).expect("Failed to load traces from FST file");
-                Some((traces_array, labels_array))
-            } else {
-            println!("Loading signals from the waveform...");
-            let start_time = std::time::Instant::now();
-            let (signals, time_table) =
-                load_waveform(&trace_file_path, !args.single_thread, args.show_progress)
-                    .expect("Failed to load waveform!");
-            println!(
-                "It took {:.2}s to load {} signals with {} time points",
-                start_time.elapsed().as_secs_f32(),
-                signals.len(),
-                time_table.len()
-            );
+        let is_fst = trace_file_path
+            .extension()
+            .is_some_and(|ext| ext.eq_ignore_ascii_case("fst"));
+
+        let maybe_bin_width = match clock_period {
+            Some(cp) if args.bin_cycles => {
+                if cp % args.phases != 0 {
+                    warn!(
+                        "Clock period {} is not a multiple of {} phases",
+                        cp, args.phases
+                    );
+                }
+                Some((cp / args.phases).max(1))
+            }
+            None if args.bin_cycles => {
+                warn!(
+                    "No clock period in the metadata, sampling every time point instead of binning cycles"
+                );
+                None
+            }
+            _ => None,
+        };
+
+        let use_toggle_cache = args.toggle_cache || maybe_attribution.is_some();
+        let mut maybe_run_attribution = None;
 
-            println!("Generating power trace...");
+        let (traces_array, labels_array) = if args.fst_direct && is_fst && !use_toggle_cache {
+            println!("Generating traces directly from the FST file...");
             let start_time = std::time::Instant::now();
-            let (time_table, power_table) = generate_power_trace(
-                &signals,
-                &time_table,
-                |(t, _)| *t % cp == 0,
-                clock_period.is_some(),
+            let (traces_array, labels_array, _) = traces_from_fst(
+                &trace_file_path,
+                &meta_markers,
+                |t| clock_period.map(|cp| t % cp == 0).unwrap_or(true),
+                maybe_bin_width,
+                selection,
+                &power_model,
+                Some(&time_spans),
             )
-            .expect("Failed to convert waveform to power trace!");
+            .expect("Failed to load traces from FST file");
             println!(
-                "It took {:.2}s to generate the power trace",
+                "Generated {} traces with a maximum of {} samples each in {:.2}s",
+                traces_array.nrows(),
+                traces_array.ncols(),
                 start_time.elapsed().as_secs_f32()
             );
+            (traces_array, labels_array)
+        } else {
+            let (time_table, power_table) = if use_toggle_cache {
+                let toggle_cache = load_toggle_cache(&parent_folder_path, &trace_file_path, args);
+                println!("Generating power trace from the toggle cache...");
+                let start_time = std::time::Instant::now();
+                let (time_table, power_table) = toggle_cache.power_table(
+                    selection,
+                    &power_model,
+                    Some(&time_spans),
+                    maybe_bin_width,
+                );
+                println!(
+                    "It took {:.2}s to generate the power trace with {} time points",
+                    start_time.elapsed().as_secs_f32(),
+                    time_table.len()
+                );
+                let (time_table, power_table) = if maybe_bin_width.is_some() {
+                    // the power is already sampled per bin
+                    (time_table, power_table)
+                } else {
+                    filter_power_trace(
+                        &time_table,
+                        power_table,
+                        |(t, _)| *t % cp == 0,
+                        clock_period.is_some(),
+                    )
+                };
+                if let Some(attribution) = maybe_attribution {
+                    println!("Attributing the flagged samples...");
+                    let start_time = std::time::Instant::now();
+                    let mut run_attribution = attribution.lock().unwrap().empty_like();
+                    let flagged = FlaggedSamples::new(
+                        run_attribution.samples(),
+                        &time_table,
+                        &meta_markers,
+                        maybe_bin_width,
+                        // the attribution is of the first partition, like t_values.npz
+                        args.partitions.first(),
+                    );
+                    toggle_cache.attribute(
+                        &mut run_attribution,
+                        &flagged,
+                        selection,
+                        &power_model,
+                        Some(&time_spans),
+                    );
+                    maybe_run_attribution = Some(run_attribution);
+                    println!(
+                        "It took {:.2}s to attribute the flagged samples",
+                        start_time.elapsed().as_secs_f32()
+                    );
+                }
+                (time_table, power_table)
+            } else if let Some(max_memory) = args.max_memory {
+                println!("Generating power trace from batches of signals...");
+                let start_time = std::time::Instant::now();
+                let (time_table, power_table) = load_power_table_batched(
+                    &trace_file_path,
+                    !args.single_thread,
+                    args.show_progress,
+                    max_memory.as_u64(),
+                    selection,
+                    &power_model,
+                    Some(&time_spans),
+                    maybe_bin_width,
+                )
+                .expect("Failed to load waveform!");
+                println!(
+                    "It took {:.2}s to generate the power trace with {} time points",
+                    start_time.elapsed().as_secs_f32(),
+                    time_table.len()
+                );
+                if maybe_bin_width.is_some() {
+                    // the power is already sampled per bin
+                    (time_table, power_table)
+                } else {
+                    filter_power_trace(
+                        &time_table,
+                        power_table,
+                        |(t, _)| *t % cp == 0,
+                        clock_period.is_some(),
+                    )
+                }
+            } else {
+                println!("Loading signals from the waveform...");
+                let start_time = std::time::Instant::now();
+                let (signals, time_table, signal_weights) = load_waveform(
+                    &trace_file_path,
+                    !args.single_thread,
+                    args.show_progress,
+                    selection,
+                    &power_model,
+                )
+                .expect("Failed to load waveform!");
+                println!(
+                    "It took {:.2}s to load {} signals with {} time points",
+                    start_time.elapsed().as_secs_f32(),
+                    signals.len(),
+                    time_table.len()
+                );
 
-            
+                println!("Generating power trace...");
+                let start_time = std::time::Instant::now();
+                let index_spans = spans_to_time_indices(&time_spans, &time_table);
+                let (time_table, power_table) = if let Some(bin_width) = maybe_bin_width {
+                    let (start_time, end_time) = time_extent(Some(&time_spans), &time_table);
+                    let (bin_times, slots) =
+                        time_bins(&time_table, bin_width, start_time, end_time);
+                    let mut bin_power = vec![0f32; bin_times.len()];
+                    accumulate_binned_power(
+                        &signals,
+                        &power_model,
+                        &signal_weights,
+                        &mut bin_power,
+                        &index_spans,
+                        &slots,
+                    );
+                    (bin_times, bin_power)
+                } else {
+                    let mut power_table = vec![0f32; time_table.len()];
+                    accumulate_power_in_spans(
+                        &signals,
+                        &power_model,
+                        &signal_weights,
+                        &mut power_table,
+                        &index_spans,
+                    );
+                    filter_power_trace(
+                        &time_table,
+                        power_table,
+                        |(t, _)| *t % cp == 0,
+                        clock_period.is_some(),
+                    )
+                };
+                println!(
+                    "It took {:.2}s to generate the power trace",
+                    start_time.elapsed().as_secs_f32()
+                );
+                (time_table, power_table)
+            };
+
+            if fused {
+                println!("Accumulating traces based on markers...");
+                let start_time = std::time::Instant::now();
+                let run_ttaccs = ttest_from_power_table(
+                    &power_table,
+                    &time_table,
+                    &meta_markers,
+                    args.order,
+                    &args.partitions,
+                );
+                println!(
+                    "Accumulated {} traces with a maximum of {} samples each in {:.2}s",
+                    markers_to_time_indices(&meta_markers, &time_table).len(),
+                    run_ttaccs[0].ns(),
+                    start_time.elapsed().as_secs_f32()
+                );
+                return Some((RunData::Moments(run_ttaccs), maybe_run_attribution));
+            }
 
             println!("Cutting traces based on markers...");
             let start_time = std::time::Instant::now();
@@ -340,116 +1181,773 @@ fn main() -> miette::Result<()> {
                 num_traces,
                 cur_samples_per_trace
             );
-            println!("Saving traces and labels to NPZ file...");
-            let start_time: std::time::Instant = std::time::Instant::now();
+            (traces_array, labels_array)
+        };
+
+        if args.zarr_store.is_some() || fused {
+            // the traces are appended to the campaign store by the accumulator, or only needed for their moments
+            return Some((
+                RunData::Traces(RunTraces::Owned {
+                    traces: traces_array,
+                    labels: labels_array,
+                }),
+                maybe_run_attribution,
+            ));
+        }
+
+        println!("Saving traces and labels...");
+        let start_time: std::time::Instant = std::time::Instant::now();
+        record_sidecar_params(&parent_folder_path, TRACES_NPY, None)
+            .expect("Failed to record the parameters of the traces");
+        save_traces(
+            &parent_folder_path,
+            traces_array.view(),
+            labels_array.view(),
+        )
+        .expect("Failed to save traces and labels");
+        if let Err(e) = record_sidecar_params(&parent_folder_path, TRACES_NPY, Some(&params)) {
+            error!("Failed to record the parameters of the traces: {:?}", e);
+        }
+        println!(
+            "Saved traces and labels to {} in {:.2}s\n",
+            parent_folder_path.join(TRACES_NPY).display(),
+            start_time.elapsed().as_secs_f32()
+        );
+
+        Some((
+            RunData::Traces(RunTraces::Owned {
+                traces: traces_array,
+                labels: labels_array,
+            }),
+            maybe_run_attribution,
+        ))
+    }
+}
+
+/// Running t-test state of a campaign, updated one run at a time in arrival order.
+struct TtestProgress {
+    order: usize,
+    samples_per_trace: usize,
+    maybe_ttacc: Option<ttest::Ttest>,
+    /// max |t| for each order, after each ingested run
+    max_t_values: Vec<Vec<f64>>,
+    num_traces_so_far: Vec<usize>,
+    maybe_t_values: Option<Array2<f64>>,
+    /// t-tests of the partitions after the first one, with `--partition`
+    partition_ttaccs: Vec<ttest::Ttest>,
+    /// bivariate t-test of the campaign, with `--bivariate`
+    maybe_bivariate: Option<bivariate::BivariateTtest>,
+}
 
-            let mut npz = NpzWriter::new_compressed(
-                File::create(&npz_path).expect("Failed to create npz file"),
+impl TtestProgress {
+    fn new(order: usize) -> Self {
+        // Initial max |t| is 0.0 for each order corresponding to 0 traces
+        TtestProgress {
+            order,
+            samples_per_trace: 0,
+            maybe_ttacc: None,
+            max_t_values: vec![vec![0.0]; order],
+            num_traces_so_far: vec![0],
+            maybe_t_values: None,
+            partition_ttaccs: Vec::new(),
+            maybe_bivariate: None,
+        }
+    }
+
+    fn total_traces(&self) -> usize {
+        self.num_traces_so_far.last().copied().unwrap_or(0)
+    }
+
+    /// Truncate or zero-pad the traces of a run to the number of samples per trace of the campaign,
+    /// which is set by the first run.
+    fn conform<'a>(&mut self, traces_array: ArrayView2<'a, f32>) -> CowArray<'a, f32, Ix2> {
+        let (num_traces, cur_samples_per_trace) = traces_array.dim();
+        let samples_per_trace = self.samples_per_trace;
+        if samples_per_trace == 0 {
+            // Initialize samples_per_trace with the length of the first trace
+            self.samples_per_trace = cur_samples_per_trace;
+            traces_array.into()
+        } else if samples_per_trace == cur_samples_per_trace {
+            traces_array.into()
+        } else {
+            error!(
+                "Inconsistent number of samples per trace: expected {}, found {}",
+                samples_per_trace, cur_samples_per_trace
             );
-            for (tidx, trace) in traces_array.outer_iter().enumerate() {
-                npz.add_array(format!("trace_{tidx}"), &trace)
-                    .expect("Failed to add array 'a' to npz");
+            if cur_samples_per_trace > samples_per_trace {
+                warn!(
+                    "Using the first {} samples of the longer trace",
+                    samples_per_trace
+                );
+                traces_array.slice_move(s![.., ..samples_per_trace]).into()
+            } else {
+                error!(
+                    "skipping trace with {} samples as expected {}",
+                    cur_samples_per_trace, samples_per_trace
+                );
+                // create a larger array with zeros
+                let mut t = Array2::<f32>::zeros((num_traces, samples_per_trace));
+                // fill in each row with the available samples
+                for (i, row) in traces_array.outer_iter().enumerate() {
+                    t.slice_mut(s![i, ..row.len()]).assign(&row);
+                }
+                t.into()
             }
-            npz.add_array("labels", &labels_array)
-                .expect("Failed to add array 'labels' to npz");
-            npz.finish().expect("Failed to finish writing npz file");
-            println!(
-                "Saved traces and labels to {} in {:.2}s\n",
-                npz_path.display(),
-                start_time.elapsed().as_secs_f32()
+        }
+    }
+
+    /// Merge the t-test accumulator of a run, zero-padding or truncating it to the number of samples per trace of
+    /// the campaign, which is set by the first run.
+    fn merge(&mut self, mut run_ttacc: ttest::Ttest) {
+        let num_traces = run_ttacc.num_traces().iter().sum::<u64>() as usize;
+        if num_traces == 0 {
+            // a run may have no trace with the labels of the tested partition
+            warn!("No traces to test in this run");
+            return;
+        }
+        // a run of a single trace is merged as well: only the t-values need traces of both classes
+        if self.samples_per_trace == 0 {
+            self.samples_per_trace = run_ttacc.ns();
+        } else if run_ttacc.ns() != self.samples_per_trace {
+            warn!(
+                "Inconsistent number of samples per trace: expected {}, found {}",
+                self.samples_per_trace,
+                run_ttacc.ns()
             );
+            run_ttacc.resize(self.samples_per_trace);
+        }
+        self.num_traces_so_far
+            .push(self.total_traces() + num_traces);
+
+        let ttacc = self
+            .maybe_ttacc
+            .get_or_insert_with(|| ttest::Ttest::new(self.samples_per_trace, self.order));
+        ttacc.merge(&run_ttacc);
+
+        let t_values = ttacc.get_ttest();
+        self.max_t_values
+            .iter_mut()
+            .zip(t_values.rows())
+            .for_each(|(max_t, t_row)| {
+                max_t.push(
+                    t_row
+                        .iter()
+                        .filter_map(|&x| x.is_finite().then_some(x.abs()))
+                        .max_by(|a, b| a.partial_cmp(b).unwrap())
+                        // no t-value is defined until each class has enough traces
+                        .unwrap_or(0.0),
+                );
+            });
+        info!(
+            "Ingested {} traces ({} in total), max |t|: {}",
+            num_traces,
+            self.total_traces(),
+            self.max_t_values
+                .iter()
+                .map(|v| format!("{:.3}", v.last().unwrap_or(&0.0)))
+                .join(", ")
+        );
+        self.maybe_t_values = Some(t_values);
+    }
 
-            Some((traces_array, labels_array))
+    /// Merge the t-test accumulators of the other partitions of a run, after [`TtestProgress::merge`] of its first
+    /// one, zero-padding or truncating them in the same way.
+    fn merge_partitions(&mut self, run_ttaccs: Vec<ttest::Ttest>) {
+        for (i, mut run_ttacc) in run_ttaccs.into_iter().enumerate() {
+            if self.samples_per_trace == 0 {
+                self.samples_per_trace = run_ttacc.ns();
+            }
+            run_ttacc.resize(self.samples_per_trace);
+            match self.partition_ttaccs.get_mut(i) {
+                Some(ttacc) => ttacc.merge(&run_ttacc),
+                None => self.partition_ttaccs.push(run_ttacc),
+            }
         }
+    }
+
+    /// Merge the bivariate t-test accumulator of a run.
+    fn merge_bivariate(&mut self, run_bivariate: bivariate::BivariateTtest) {
+        match &mut self.maybe_bivariate {
+            Some(campaign_bivariate) => campaign_bivariate.merge(&run_bivariate),
+            None => self.maybe_bivariate = Some(run_bivariate),
         }
-    }).collect_vec_list();
+    }
 
+    fn to_json(&self) -> serde_json::Value {
+        serde_json::json!({
+            "order": self.order,
+            "samples_per_trace": self.samples_per_trace,
+            "num_traces": self.num_traces_so_far,
+            "max_t": self.max_t_values,
+        })
+    }
 
-    let mut total_collected_traces: usize = 0;
-    // must be done sequentially
-    let t_values = collected_traces
-        .into_iter()
-        .flatten()
-        .fold(None, |_prev_tvalues, (traces_array, labels_array)| {
-            let (num_traces, cur_samples_per_trace) = traces_array.dim();
-            total_collected_traces += num_traces;
-            let traces_array = if samples_per_trace == 0 {
-                // Initialize samples_per_trace with the length of the first trace
-                samples_per_trace = cur_samples_per_trace;
-                traces_array
-            } else {
-                if samples_per_trace == cur_samples_per_trace {
-                    traces_array
-                } else {
-                error!(
-                    "Inconsistent number of samples per trace: expected {}, found {}",
-                    samples_per_trace, cur_samples_per_trace
+    /// Atomically (re)write the max |t| trajectory, so that an external driver can follow the campaign.
+    fn write_progress<P: AsRef<Path>>(&self, path: P) -> std::io::Result<()> {
+        write_json_atomic(path.as_ref(), &self.to_json())
+    }
+}
+
+fn write_json_atomic(path: &Path, value: &serde_json::Value) -> std::io::Result<()> {
+    let tmp_path = path.with_extension("tmp");
+    std::fs::write(&tmp_path, serde_json::to_vec(value)?)?;
+    std::fs::rename(&tmp_path, path)
+}
+
+/// State of a watched campaign, saved to the output directory next to the moments of the campaign.
+const WATCH_STATE_JSON: &str = "watch_state.json";
+/// Moments of the bivariate t-test of a watched campaign, with `--bivariate`.
+const WATCH_BIVARIATE_NPZ: &str = "watch_state_bivariate.npz";
+/// Sums of the attribution of a watched campaign, with `--attribute`.
+const WATCH_ATTRIBUTION_NPZ: &str = "watch_state_attribution.npz";
+
+/// Moments of a partition of the campaign, saved next to its t-test results.
+fn partition_moments_npz(partition: &Partition) -> String {
+    format!("campaign_moments_{}.npz", partition.file_stem())
+}
+
+/// Save the max |t| trajectory of a watched campaign and the runs ingested so far, along with its bivariate t-test
+/// and attribution, if any.
+/// Must be called after the moments of the campaign are saved by [`write_results`].
+fn save_watch_state(
+    output_dir: &Path,
+    progress: &TtestProgress,
+    ingested: &[PathBuf],
+    args: &Args,
+    maybe_attribution: Option<&Mutex<Attribution>>,
+) -> miette::Result<()> {
+    let mut state = progress.to_json();
+    state["ingested"] = serde_json::json!(ingested);
+    state["partitions"] =
+        serde_json::json!(args.partitions.iter().map(|p| p.to_string()).collect_vec());
+    if let Some(bivariate_ttacc) = &progress.maybe_bivariate {
+        bivariate_ttacc.save(output_dir.join(WATCH_BIVARIATE_NPZ))?;
+        state["bivariate"] = serde_json::json!(bivariate_ttacc.window());
+    }
+    if let Some(attribution) = maybe_attribution {
+        let attribution = attribution.lock().unwrap();
+        attribution.save(output_dir.join(WATCH_ATTRIBUTION_NPZ))?;
+        state["attribution"] = serde_json::json!({
+            "unit": attribution.unit().to_string(),
+            "num_traces": attribution.num_traces(),
+        });
+    }
+    write_json_atomic(&output_dir.join(WATCH_STATE_JSON), &state).into_diagnostic()
+}
+
+/// Restore the progress of a watched campaign, the runs it has already ingested, and its attribution if any.
+/// The campaign must have been watched with the same partitions, bivariate window and attribution unit, whose
+/// moments are saved by [`write_results`] and [`save_watch_state`]. The restored attribution keeps its flagged
+/// samples, unless others are given with `--attribute-samples`.
+fn load_watch_state(
+    output_dir: &Path,
+    args: &Args,
+) -> Option<(TtestProgress, Vec<PathBuf>, Option<Attribution>)> {
+    let order = args.order;
+    let partitions = &args.partitions;
+    let state_path = output_dir.join(WATCH_STATE_JSON);
+    let moments_path = output_dir.join(ttest::CAMPAIGN_MOMENTS_NPZ);
+    if !state_path.exists() || !moments_path.exists() {
+        return None;
+    }
+    let state: serde_json::Value = std::fs::read(&state_path)
+        .ok()
+        .and_then(|bytes| serde_json::from_slice(&bytes).ok())?;
+    let ingested: Vec<PathBuf> = serde_json::from_value(state["ingested"].clone()).ok()?;
+    let num_traces_so_far: Vec<usize> = serde_json::from_value(state["num_traces"].clone()).ok()?;
+    let max_t_values: Vec<Vec<f64>> = serde_json::from_value(state["max_t"].clone()).ok()?;
+    let state_partitions: Vec<String> =
+        serde_json::from_value(state["partitions"].clone()).unwrap_or_default();
+    if state_partitions != partitions.iter().map(|p| p.to_string()).collect_vec() {
+        warn!(
+            "Saved state in {} is of the partitions [{}], starting over",
+            state_path.display(),
+            state_partitions.join(", ")
+        );
+        return None;
+    }
+    let state_bivariate: Option<(usize, usize)> =
+        serde_json::from_value(state["bivariate"].clone()).unwrap_or_default();
+    let bivariate_window = args
+        .bivariate
+        .map(|(start, end)| (start as usize, end as usize));
+    if state_bivariate != bivariate_window {
+        warn!(
+            "Saved state in {} is of the bivariate window {:?}, starting over",
+            state_path.display(),
+            state_bivariate
+        );
+        return None;
+    }
+    let state_attribution_unit = state["attribution"]["unit"].as_str();
+    if state_attribution_unit != args.attribute.map(|unit| unit.to_string()).as_deref() {
+        warn!(
+            "Saved state in {} is of the attribution unit {:?}, starting over",
+            state_path.display(),
+            state_attribution_unit
+        );
+        return None;
+    }
+    let mut partition_ttaccs = Vec::new();
+    for partition in partitions.iter().skip(1) {
+        let partition_moments_path = output_dir.join(partition_moments_npz(partition));
+        match ttest::Ttest::load(&partition_moments_path) {
+            Ok(ttacc) if ttacc.order() >= order => partition_ttaccs.push(ttacc.with_order(order)),
+            Ok(_) => return None,
+            Err(e) => {
+                warn!(
+                    "Failed to load {}: {:?}",
+                    partition_moments_path.display(),
+                    e
                 );
-                if cur_samples_per_trace > samples_per_trace {
+                return None;
+            }
+        }
+    }
+    let ttacc = match ttest::Ttest::load(&moments_path) {
+        Ok(ttacc) => ttacc,
+        Err(e) => {
+            warn!("Failed to load {}: {:?}", moments_path.display(), e);
+            return None;
+        }
+    };
+    let moments_traces = ttacc.num_traces().iter().sum::<u64>() as usize;
+    if state["order"].as_u64() != Some(order as u64)
+        || ttacc.order() < order
+        || max_t_values.len() != order
+        || num_traces_so_far.last() != Some(&moments_traces)
+    {
+        warn!(
+            "Saved state in {} does not match the campaign moments or the requested order, starting over",
+            state_path.display()
+        );
+        return None;
+    }
+    // the bivariate test accumulates the same traces as the t-test of the first partition
+    let maybe_bivariate = match bivariate_window {
+        Some(window) => {
+            let bivariate_path = output_dir.join(WATCH_BIVARIATE_NPZ);
+            match bivariate::BivariateTtest::load(&bivariate_path) {
+                Ok(bivariate_ttacc)
+                    if bivariate_ttacc.window() == window
+                        && bivariate_ttacc.num_traces() == ttacc.num_traces() =>
+                {
+                    Some(bivariate_ttacc)
+                }
+                Ok(_) => {
                     warn!(
-                        "Using the first {} samples of the longer trace",
-                        samples_per_trace
+                        "Saved bivariate moments in {} do not match the campaign moments, starting over",
+                        bivariate_path.display()
                     );
-                    // Array2::<f32>::from(traces_array.slice(s![.., ..samples_per_trace]))
-                    traces_array.slice(s![.., ..samples_per_trace]).to_owned()
-                } else {
-                    error!(
-                        "skipping trace with {} samples as expected {}",
-                        cur_samples_per_trace, samples_per_trace
+                    return None;
+                }
+                Err(e) => {
+                    warn!("Failed to load {}: {:?}", bivariate_path.display(), e);
+                    return None;
+                }
+            }
+        }
+        None => None,
+    };
+    let maybe_attribution = match args.attribute {
+        Some(_) => {
+            let attribution_path = output_dir.join(WATCH_ATTRIBUTION_NPZ);
+            let state_traces: Option<[u64; ttest::NUM_CLASSES]> =
+                serde_json::from_value(state["attribution"]["num_traces"].clone()).ok();
+            match Attribution::load(&attribution_path) {
+                Ok(attribution)
+                    if Some(attribution.num_traces()) == state_traces
+                        && (args.attribute_samples.is_empty()
+                            || attribution.samples() == given_attribution_samples(args)) =>
+                {
+                    Some(attribution)
+                }
+                Ok(_) => {
+                    warn!(
+                        "Saved attribution in {} does not match the saved state or --attribute-samples, starting over",
+                        attribution_path.display()
                     );
-                    // create a larger array with zeros
-                    let mut t = Array2::<f32>::zeros((num_traces, samples_per_trace));
-                    // fill in each row with the available samples
-                    for (i, row) in traces_array.outer_iter().enumerate() {
-                        t.slice_mut(s![i, ..row.len()]).assign(&row);
-                    }
-                    t
+                    return None;
                 }
-            }};
-            num_traces_so_far.push(
-                num_traces_so_far
-                    .last()
-                    .map_or(num_traces, |&last| last + num_traces),
+                Err(e) => {
+                    warn!("Failed to load {}: {:?}", attribution_path.display(), e);
+                    return None;
+                }
+            }
+        }
+        None => None,
+    };
+    let ttacc = ttacc.with_order(order);
+    let progress = TtestProgress {
+        order,
+        samples_per_trace: ttacc.ns(),
+        maybe_t_values: Some(ttacc.get_ttest()),
+        partition_ttaccs,
+        maybe_bivariate,
+        maybe_ttacc: Some(ttacc),
+        max_t_values,
+        num_traces_so_far,
+    };
+    Some((progress, ingested, maybe_attribution))
+}
+
+fn main() -> miette::Result<()> {
+    let args = Args::parse();
+
+    // set default log level to info
+    env_logger::Builder::from_env(env_logger::Env::default().default_filter_or("info"))
+        .format_timestamp(None)
+        .init();
+
+    if let Some(Commands::Merge { paths }) = &args.maybe_cmd {
+        let progress = merge_moments(paths, args.order)?;
+        return write_results(&progress, &args);
+    }
+
+    let order = args.order;
+    let selection = SignalSelection::new(
+        &args.include_signals,
+        &args.exclude_signals,
+        !args.keep_constant_signals,
+        args.registers_only,
+    )?;
+    let watch_interval = std::time::Duration::from_secs(args.watch_interval);
+
+    // a watched campaign resumes from its saved state, and does not ingest the same run twice
+    let (mut progress, mut ingested, maybe_restored_attribution) = match args
+        .watch
+        .then(|| load_watch_state(Path::new(&args.ttest_output_dir), &args))
+        .flatten()
+    {
+        Some((progress, ingested, maybe_attribution)) => {
+            info!(
+                "Resuming the watched campaign with {} runs and {} traces",
+                ingested.len(),
+                progress.total_traces()
+            );
+            (progress, ingested, maybe_attribution)
+        }
+        None => (TtestProgress::new(order), Vec::new(), None),
+    };
+    let maybe_attribution = match (args.attribute, maybe_restored_attribution) {
+        (Some(_), Some(attribution)) => Some(Mutex::new(attribution)),
+        (Some(unit), None) => {
+            let samples = attribution_samples(&args)?;
+            info!(
+                "Attributing {} flagged samples to each {}",
+                samples.len(),
+                unit
             );
+            Some(Mutex::new(Attribution::new(unit, samples)))
+        }
+        (None, _) => None,
+    };
 
-            assert!(num_traces > 1, "Number of traces must be greater than 1");
-            assert!(
-                labels_array.len() == num_traces,
-                "Number of trace labels does not match number of traces"
+    // Metadata files are either known upfront, or arrive on stdin (or in a watched meta list) while the
+    // simulations are still running.
+    let meta_paths: Box<dyn Iterator<Item = PathBuf> + Send> = if args.watch {
+        let meta_list_path = args.maybe_meta_list_path.as_ref().unwrap();
+        Box::new(MetaListTail::new(
+            PathBuf::from(meta_list_path),
+            watch_interval,
+            ingested.iter().cloned().collect(),
+        ))
+    } else if args.meta_stdin {
+        Box::new(
+            BufReader::new(std::io::stdin())
+                .lines()
+                .map_while(Result::ok)
+                .filter_map(|line| {
+                    let trimmed = line.trim();
+                    (!trimmed.is_empty()).then(|| PathBuf::from(trimmed))
+                }),
+        )
+    } else {
+        let filenames: Vec<PathBuf> = if let Some(meta_list_path) = &args.maybe_meta_list_path {
+            read_meta_list(meta_list_path)
+        } else if let Some(filename) = &args.maybe_metadata {
+            vec![PathBuf::from(filename)]
+        } else {
+            panic!("No meta files provided. Please specify at least one NPZ file.");
+        };
+        if filenames.is_empty() {
+            panic!("No meta files provided. Please specify at least one NPZ file.");
+        }
+        Box::new(filenames.into_iter())
+    };
+
+    args.num_threads.iter().for_each(|&n| {
+        rayon::ThreadPoolBuilder::new()
+            .num_threads(n)
+            .build_global()
+            .unwrap()
+    });
+
+    let default_num_threads = rayon::current_num_threads();
+
+    println!(
+        "Using {} threads for parallel processing",
+        default_num_threads
+    );
+
+    let mut maybe_campaign_store = match &args.zarr_store {
+        Some(path) if CampaignStore::exists(path) => {
+            let campaign_store = CampaignStore::open(path)?;
+            info!(
+                "Appending to campaign store {} with {} traces of {} samples",
+                path.display(),
+                campaign_store.num_traces(),
+                campaign_store.samples_per_trace()
             );
+            progress.samples_per_trace = campaign_store.samples_per_trace();
+            Some(campaign_store)
+        }
+        _ => None,
+    };
+    // the traces of these runs are not needed, so their moments sidecars can be used
+    let stored_runs: HashSet<String> = maybe_campaign_store
+        .as_ref()
+        .map(|campaign_store| campaign_store.runs().into_iter().collect())
+        .unwrap_or_default();
 
-            if maybe_ttacc.is_none() {
-                maybe_ttacc = Some(ttest::Ttest::new(samples_per_trace, order));
+    // Runs are loaded by `queue_depth` workers, and each worker reduces its run to a t-test accumulator right away.
+    // The accumulators are merged in the order they complete, so that the t-test of early runs overlaps with
+    // loading (or simulating) the later ones, and only the moments of a run cross threads.
+    // Each worker holds at most one trace block, and hands it over through a rendezvous channel, so that at most
+    // `queue_depth` trace blocks (and the one being appended to the campaign store) are in memory at once.
+    let queue_depth = args.queue_depth.unwrap_or(default_num_threads).max(1);
+    info!("Loading up to {} runs at a time", queue_depth);
+    let meta_paths = Mutex::new(meta_paths);
+    std::thread::scope(|scope| {
+        let (sender, receiver) = mpsc::sync_channel(0);
+        let args = &args;
+        let meta_paths = &meta_paths;
+        let stored_runs = &stored_runs;
+        let selection = &selection;
+        let maybe_attribution = maybe_attribution.as_ref();
+        for _ in 0..queue_depth {
+            let sender = sender.clone();
+            scope.spawn(move || {
+                loop {
+                    // the lock is released at the end of the statement, before the run is loaded
+                    let Some(metadata_path) = meta_paths.lock().unwrap().next() else {
+                        break;
+                    };
+                    // the traces themselves are only needed to append them to the campaign store
+                    let keep_traces = args.zarr_store.is_some()
+                        && !stored_runs.contains(metadata_path.to_string_lossy().as_ref());
+                    if let Some(run_accumulators) = load_run_ttest(
+                        &metadata_path,
+                        args,
+                        selection,
+                        keep_traces,
+                        maybe_attribution,
+                    ) {
+                        sender
+                            .send((metadata_path, run_accumulators))
+                            .expect("Failed to send the run accumulator");
+                    }
+                }
+            });
+        }
+        // the receiver is done once every worker has dropped its sender
+        drop(sender);
+        // must be done sequentially
+        let mut last_write = std::time::Instant::now();
+        let mut unsaved_runs = 0;
+        loop {
+            match receiver.recv_timeout(watch_interval) {
+                Ok((metadata_path, run_accumulators)) => {
+                    if let (Some(zarr_store), Some(run_traces)) =
+                        (&args.zarr_store, run_accumulators.maybe_traces)
+                    {
+                        let traces = progress.conform(run_traces.traces());
+                        let campaign_store = maybe_campaign_store.get_or_insert_with(|| {
+                            CampaignStore::create(zarr_store, traces.ncols())
+                                .expect("Failed to create the campaign store")
+                        });
+                        let run_id = metadata_path.to_string_lossy();
+                        if campaign_store.contains_run(&run_id) {
+                            info!("Run {} is already in the campaign store", run_id);
+                        } else {
+                            campaign_store
+                                .append(&run_id, traces.view(), run_traces.labels())
+                                .expect("Failed to append traces to the campaign store");
+                        }
+                    }
+                    progress.merge(run_accumulators.ttacc);
+                    progress.merge_partitions(run_accumulators.partition_ttaccs);
+                    if let Some(run_bivariate) = run_accumulators.maybe_bivariate {
+                        progress.merge_bivariate(run_bivariate);
+                    }
+                    if let (Some(attribution), Some(run_attribution)) =
+                        (maybe_attribution, &run_accumulators.maybe_attribution)
+                    {
+                        attribution.lock().unwrap().merge(run_attribution);
+                    }
+                    if let Some(progress_file) = &args.progress_file {
+                        if let Err(e) = progress.write_progress(progress_file) {
+                            error!(
+                                "Failed to write progress to {}: {}",
+                                progress_file.display(),
+                                e
+                            );
+                        }
+                    }
+                    ingested.push(metadata_path);
+                    unsaved_runs += 1;
+                }
+                Err(mpsc::RecvTimeoutError::Timeout) => {}
+                Err(mpsc::RecvTimeoutError::Disconnected) => break,
             }
-
-            if let Some(ref mut ttacc) = maybe_ttacc {
-                // Update the ttest accumulator with the current traces and labels
-                ttacc.update(traces_array.view(), labels_array.view());
-
-                let t_values = ttacc.get_ttest();
-                max_t_values
-                    .iter_mut()
-                    .zip(t_values.rows())
-                    .for_each(|(max_t, t_row)| {
-                        max_t.push(
-                            t_row
-                                .iter()
-                                .filter_map(|&x| x.is_finite().then_some(x.abs()))
-                                .max_by(|a, b| a.partial_cmp(b).unwrap())
-                                .expect("Failed to find max t-value in current row"),
-                        );
+            // in watch mode the results are kept current, as the campaign may never end
+            if args.watch && unsaved_runs > 0 && last_write.elapsed() >= watch_interval {
+                info!("Rewriting the results after {} new runs", unsaved_runs);
+                let saved = write_results(&progress, args)
+                    .and_then(|_| write_attribution(maybe_attribution, args))
+                    .and_then(|_| {
+                        save_watch_state(
+                            Path::new(&args.ttest_output_dir),
+                            &progress,
+                            &ingested,
+                            args,
+                            maybe_attribution,
+                        )
                     });
-                Some(t_values)
-            } else {
-                panic!("Ttest accumulator is not initialized");
+                if let Err(e) = saved {
+                    error!("Failed to save the results: {:?}", e);
+                }
+                last_write = std::time::Instant::now();
+                unsaved_runs = 0;
             }
-        })
-        .expect("Failed to compute t-test values");
+        }
+    });
+
+    write_results(&progress, &args)?;
+    write_attribution(maybe_attribution.as_ref(), &args)
+}
+
+/// The samples of each trace to attribute: those given on the command line, or else the flagged samples of the
+/// t-test results of a previous analysis in the output directory.
+fn attribution_samples(args: &Args) -> miette::Result<Vec<usize>> {
+    if !args.attribute_samples.is_empty() {
+        return Ok(given_attribution_samples(args));
+    }
+    let npz_path = PathBuf::from(&args.ttest_output_dir).join("t_values.npz");
+    let file = File::open(&npz_path).into_diagnostic().wrap_err_with(|| {
+        format!(
+            "No --attribute-samples given, and no previous t-test results in {}",
+            npz_path.display()
+        )
+    })?;
+    let mut npz = NpzReader::new(BufReader::new(file)).into_diagnostic()?;
+    let t_values: Array2<f64> = npz
+        .by_name("t_values")
+        .into_diagnostic()
+        .wrap_err("Failed to find 't_values' in NPZ file")?;
+    let samples = flagged_samples(t_values.view(), T_THRESHOLD, args.attribute_max_samples);
+    if samples.is_empty() {
+        return Err(miette!(
+            "No sample of {} exceeds the t-test threshold of {}",
+            npz_path.display(),
+            T_THRESHOLD
+        ));
+    }
+    Ok(samples)
+}
 
-    log::info!(
-        "Total number of traces: {}",
-        total_collected_traces
+/// The samples of each trace given by `--attribute-samples`, sorted.
+fn given_attribution_samples(args: &Args) -> Vec<usize> {
+    args.attribute_samples
+        .iter()
+        .flat_map(|&(start, end)| start as usize..end as usize)
+        .sorted()
+        .dedup()
+        .collect_vec()
+}
+
+/// Save the ranking of the attribution, if any, to the output directory.
+fn write_attribution(
+    maybe_attribution: Option<&Mutex<Attribution>>,
+    args: &Args,
+) -> miette::Result<()> {
+    let Some(attribution) = maybe_attribution else {
+        return Ok(());
+    };
+    let attribution = attribution.lock().unwrap();
+    let csv_path = PathBuf::from(&args.ttest_output_dir).join(ATTRIBUTION_CSV);
+    attribution.write_csv(&csv_path)?;
+    info!(
+        "Saved the attribution of {} traces to {}",
+        attribution.num_traces().iter().sum::<u64>(),
+        csv_path.display()
     );
+    Ok(())
+}
+
+/// The moments files given on the command line, searching directories for per-run moments sidecars.
+fn find_moments_files(paths: &[PathBuf]) -> std::io::Result<Vec<PathBuf>> {
+    let mut files = Vec::new();
+    for path in paths {
+        if path.is_dir() {
+            let mut entries = std::fs::read_dir(path)?
+                .map(|entry| entry.map(|entry| entry.path()))
+                .collect::<std::io::Result<Vec<_>>>()?;
+            entries.sort();
+            files.extend(find_moments_files(
+                &entries
+                    .into_iter()
+                    .filter(|p| {
+                        p.is_dir() || p.file_name().is_some_and(|n| n == ttest::MOMENTS_NPZ)
+                    })
+                    .collect_vec(),
+            )?);
+        } else {
+            files.push(path.clone());
+        }
+    }
+    Ok(files)
+}
+
+/// Merge saved t-test moments, of single runs or of whole campaign shards, one file at a time.
+fn merge_moments(paths: &[PathBuf], order: usize) -> miette::Result<TtestProgress> {
+    let moments_files = find_moments_files(paths)
+        .into_diagnostic()
+        .wrap_err("Failed to list the moments files")?
+        .into_iter()
+        .unique_by(|path| std::fs::canonicalize(path).unwrap_or_else(|_| path.clone()))
+        .collect_vec();
+    if moments_files.is_empty() {
+        return Err(miette!("No moments files found"));
+    }
+    info!("Merging the moments of {} files", moments_files.len());
+    let mut progress = TtestProgress::new(order);
+    for moments_path in moments_files {
+        let ttacc = ttest::Ttest::load(&moments_path)?;
+        if ttacc.order() < order {
+            return Err(miette!(
+                "Moments in {} are of order {}, but order {} was requested",
+                moments_path.display(),
+                ttacc.order(),
+                order
+            ));
+        }
+        info!("Merging {}", moments_path.display());
+        progress.merge(ttacc.with_order(order));
+    }
+    Ok(progress)
+}
+
+/// Save the t-test values and the moments of the campaign to the output directory, and plot the results.
+fn write_results(progress: &TtestProgress, args: &Args) -> miette::Result<()> {
+    log::info!("Total number of traces: {}", progress.total_traces());
+
+    // e.g. no run was ingested yet, or none of them had traces to test
+    let Some(t_values) = progress.maybe_t_values.clone() else {
+        return Err(miette!(
+            "No traces were accumulated, there are no t-test results to write"
+        ));
+    };
 
     let output_dir = PathBuf::from(&args.ttest_output_dir);
     if !output_dir.exists() {
@@ -466,6 +1964,73 @@ fn main() -> miette::Result<()> {
     npz.finish().expect("Failed to finish writing npz file");
     info!("Saved t_values to {}", npz_path.display());
 
+    // the first partition is the test above, saved again under its own name along with the others
+    for (partition, ttacc) in args.partitions.iter().zip(
+        progress
+            .maybe_ttacc
+            .iter()
+            .chain(&progress.partition_ttaccs),
+    ) {
+        let partition_t_values = ttacc.get_ttest();
+        let partition_path = output_dir.join(format!("t_values_{}.npz", partition.file_stem()));
+        let mut npz = NpzWriter::new_compressed(
+            File::create(&partition_path).expect("Failed to create npz file"),
+        );
+        npz.add_array("t_values", &partition_t_values)
+            .expect("Failed to add t_values array to npz");
+        npz.finish().expect("Failed to finish writing npz file");
+        ttacc.save(output_dir.join(partition_moments_npz(partition)))?;
+        info!(
+            "Partition {} ({} traces), max |t|: {}",
+            partition,
+            ttacc.num_traces().iter().sum::<u64>(),
+            partition_t_values
+                .rows()
+                .into_iter()
+                .map(|t_row| {
+                    t_row
+                        .iter()
+                        .filter(|t| t.is_finite())
+                        .fold(0f64, |max_t, t| max_t.max(t.abs()))
+                })
+                .map(|max_t| format!("{max_t:.3}"))
+                .join(", ")
+        );
+    }
+
+    // pairs of samples of the bivariate test, packed row by row in the upper triangle of the window
+    if let Some(bivariate_ttacc) = &progress.maybe_bivariate {
+        let bivariate_path = output_dir.join(bivariate::BIVARIATE_T_VALUES_NPZ);
+        bivariate_ttacc.save_ttest(&bivariate_path)?;
+        let (start, end) = bivariate_ttacc.window();
+        let max_t = bivariate_ttacc
+            .get_ttest()
+            .iter()
+            .zip(bivariate::pairs(end - start))
+            .filter(|(t, _)| t.is_finite())
+            .max_by(|a, b| a.0.abs().total_cmp(&b.0.abs()))
+            .map(|(&t, (i, j))| (t, start + i, start + j));
+        if let Some((t, i, j)) = max_t {
+            info!(
+                "Max bivariate |t|: {:.3} at samples ({}, {})",
+                t.abs(),
+                i,
+                j
+            );
+        }
+        info!(
+            "Saved bivariate t-test results to {}",
+            bivariate_path.display()
+        );
+    }
+
+    // the moments of this campaign can be merged with other shards by the `merge` subcommand
+    if let Some(ttacc) = &progress.maybe_ttacc {
+        let moments_path = output_dir.join(ttest::CAMPAIGN_MOMENTS_NPZ);
+        ttacc.save(&moments_path)?;
+        info!("Saved the t-test moments to {}", moments_path.display());
+    }
+
     if args.plot {
         let mut image_exporter = plotly_static::StaticExporterBuilder::default()
             .pdf_export_timeout(1000)
@@ -481,7 +2046,7 @@ fn main() -> miette::Result<()> {
             .responsive(true)
             .typeset_math(true);
 
-        let t_threshold = Some(4.5);
+        let t_threshold = Some(T_THRESHOLD);
 
         plot_t_traces(
             t_values,
@@ -494,8 +2059,8 @@ fn main() -> miette::Result<()> {
         )?;
 
         plot_max_t_values(
-            max_t_values,
-            num_traces_so_far,
+            progress.max_t_values.clone(),
+            progress.num_traces_so_far.clone(),
             t_threshold,
             &output_dir,
             args.show_plots,
@@ -508,4 +2073,86 @@ fn main() -> miette::Result<()> {
 }
 
 #[cfg(test)]
-mod tests {}
+mod tests {
+    use super::*;
+
+    #[test]
+    fn use_existing_can_be_turned_off() {
+        let parse = |flags: &[&str]| {
+            Args::try_parse_from(["tvla"].iter().chain(flags))
+                .unwrap()
+                .use_existing
+        };
+        assert!(parse(&[]));
+        assert!(parse(&["--use-existing"]));
+        assert!(parse(&["--use-existing=true"]));
+        assert!(!parse(&["--use-existing=false"]));
+    }
+
+    #[test]
+    fn single_trace_runs_are_merged() {
+        let mut progress = TtestProgress::new(2);
+        let mut single = ttest::Ttest::new(3, 2);
+        single.update(
+            Array2::from_elem((1, 3), 1.0).view(),
+            Array1::from(vec![0u16]).view(),
+        );
+        progress.merge(single.clone());
+        assert_eq!(progress.total_traces(), 1);
+        // no t-value yet
+        assert_eq!(progress.max_t_values, [[0.0, 0.0], [0.0, 0.0]]);
+
+        let mut run = ttest::Ttest::new(3, 2);
+        let traces = Array2::from_shape_fn((6, 3), |(i, j)| (i * (j + 1)) as f32);
+        run.update(
+            traces.view(),
+            Array1::from(vec![0u16, 1, 0, 1, 0, 1]).view(),
+        );
+        progress.merge(run.clone());
+        assert_eq!(progress.total_traces(), 7);
+        let mut expected = single;
+        expected.merge(&run);
+        assert_eq!(progress.maybe_ttacc, Some(expected));
+    }
+
+    #[test]
+    fn sidecars_of_other_parameters_are_stale() {
+        let run_dir = std::env::temp_dir().join(format!("scasim_sidecars_{}", std::process::id()));
+        std::fs::create_dir_all(&run_dir).unwrap();
+        let metadata_json = serde_json::json!({"power_model": {"model": "hd"}});
+        let args = Args::try_parse_from(["tvla"]).unwrap();
+        let params = generation_params(&args, &metadata_json).unwrap();
+        // not recorded yet
+        assert!(!sidecar_matches(&run_dir, TRACES_NPY, &params));
+        record_sidecar_params(&run_dir, TRACES_NPY, Some(&params)).unwrap();
+        assert!(sidecar_matches(&run_dir, TRACES_NPY, &params));
+        assert!(!sidecar_matches(&run_dir, ttest::MOMENTS_NPZ, &params));
+
+        for flags in [
+            &["tvla", "--power-model", "hw"][..],
+            &["tvla", "--xz-policy", "toggle"],
+            &["tvla", "--exclude", "*clk*"],
+            &["tvla", "--signal-weight", "tb.dut*=0.1"],
+            &["tvla", "--roi", "0:100"],
+            &["tvla", "--bin-cycles"],
+        ] {
+            let other_args = Args::try_parse_from(flags).unwrap();
+            let other_params = generation_params(&other_args, &metadata_json).unwrap();
+            assert!(
+                !sidecar_matches(&run_dir, TRACES_NPY, &other_params),
+                "{flags:?}"
+            );
+        }
+        // the same parameters given by the metadata
+        let args = Args::try_parse_from(["tvla", "--power-model", "hd"]).unwrap();
+        assert!(sidecar_matches(
+            &run_dir,
+            TRACES_NPY,
+            &generation_params(&args, &serde_json::json!({})).unwrap()
+        ));
+
+        record_sidecar_params(&run_dir, TRACES_NPY, None).unwrap();
+        assert!(!sidecar_matches(&run_dir, TRACES_NPY, &params));
+        std::fs::remove_dir_all(&run_dir).unwrap();
+    }
+}
@@ -0,0 +1,574 @@
+//! Bivariate second-order t-test over the pairs of samples of a window, with mergeable accumulators.
+//!
+//! Masked implementations may leak only through the joint distribution of two samples. For each pair `(i, j)`,
+//! `i < j`, of a window of samples, the test compares the means of the centred product
+//! `(x_i - mean_i) * (x_j - mean_j)` of the two classes. For each class, the accumulator keeps the number of traces,
+//! the mean and second central moment sum of each sample, and the co-moment sums `M_pq = sum (x_i - mean_i)^p *
+//! (x_j - mean_j)^q` of each pair for `(p, q)` in `(1, 1)`, `(2, 1)`, `(1, 2)` and `(2, 2)`, from which the mean and
+//! variance of the centred product follow. Batches are merged with the pairwise update formulas of Pébay (2008), as
+//! in [`crate::ttest`].
+//!
+//! The pairs are packed row by row in the upper triangle (see [`pair_index`]). The co-moments of a batch are the
+//! products of the centred (and squared centred) traces, computed by tiles of rows of the triangle in parallel.
+
+use std::fs::File;
+use std::path::Path;
+
+use miette::{Context, IntoDiagnostic, miette};
+use ndarray::{Array1, Array2, Array3, ArrayView1, ArrayView2, ArrayViewMut2, Axis, s};
+use ndarray_npz::{NpzReader, NpzWriter};
+use rayon::prelude::*;
+
+use crate::ttest::NUM_CLASSES;
+
+/// Bivariate t-test results saved next to the univariate ones.
+pub const BIVARIATE_T_VALUES_NPZ: &str = "bivariate_t_values.npz";
+
+/// Number of window samples per tile of rows of the triangle of pairs, computed by a single worker.
+const PAIR_TILE: usize = 64;
+
+/// Number of traces of a class whose co-moments are computed at once, before being merged into the accumulator.
+const BATCH_TRACES: usize = 1024;
+
+/// Number of co-moment sums kept per pair.
+const NUM_COMOMENTS: usize = 4;
+
+/// Orders `(p, q)` of the co-moment sums kept per pair.
+const COMOMENT_ORDERS: [(usize, usize); NUM_COMOMENTS] = [(1, 1), (2, 1), (1, 2), (2, 2)];
+
+/// Binomial coefficients `C(n, k)` for `n, k <= 2`.
+const BINOMIAL: [[f64; 3]; 3] = [[1.0, 0.0, 0.0], [1.0, 1.0, 0.0], [1.0, 2.0, 1.0]];
+
+/// Number of pairs `(i, j)`, `i < j`, of `w` samples.
+pub fn num_pairs(w: usize) -> usize {
+    w * w.saturating_sub(1) / 2
+}
+
+/// Index of the first pair `(i, i + 1)` of row `i` of the packed triangle of `w` samples.
+fn row_start(w: usize, i: usize) -> usize {
+    i * (2 * w - i - 1) / 2
+}
+
+/// Index of the pair `(i, j)`, `i < j`, of `w` samples in the upper triangle packed row by row.
+pub fn pair_index(w: usize, i: usize, j: usize) -> usize {
+    debug_assert!(i < j && j < w, "Invalid pair ({i}, {j}) of {w} samples");
+    row_start(w, i) + (j - i - 1)
+}
+
+/// The pairs `(i, j)`, `i < j`, of `w` samples, in packed order.
+pub fn pairs(w: usize) -> impl Iterator<Item = (usize, usize)> {
+    (0..w).flat_map(move |i| (i + 1..w).map(move |j| (i, j)))
+}
+
+/// Split the packed pairs (one per row) of `w` samples into the tiles of [`PAIR_TILE`] rows of the triangle, as
+/// `(first row, end row, pairs)`.
+fn split_tiles<'a>(
+    mut packed: ArrayViewMut2<'a, f64>,
+    w: usize,
+) -> Vec<(usize, usize, ArrayViewMut2<'a, f64>)> {
+    let mut tiles = Vec::with_capacity(w.div_ceil(PAIR_TILE));
+    for i0 in (0..w).step_by(PAIR_TILE) {
+        let i1 = (i0 + PAIR_TILE).min(w);
+        let (tile, rest) = packed.split_at(Axis(0), row_start(w, i1) - row_start(w, i0));
+        tiles.push((i0, i1, tile));
+        packed = rest;
+    }
+    tiles
+}
+
+/// Co-moment sum of order `(p, q)` around a mean shifted by `shift` from the mean of the `moments` sums, indexed
+/// by order `[p][q]` up to 2 (with `M_00 = n` and `M_10 = M_01 = 0`).
+#[inline(always)]
+fn shifted_comoment(moments: &[[f64; 3]; 3], shift: [f64; 2], p: usize, q: usize) -> f64 {
+    let mut sum = 0.0;
+    for k in 0..=p {
+        for l in 0..=q {
+            sum += BINOMIAL[p][k]
+                * BINOMIAL[q][l]
+                * moments[p - k][q - l]
+                * shift[0].powi(k as i32)
+                * shift[1].powi(l as i32);
+        }
+    }
+    sum
+}
+
+#[derive(Clone, Debug, PartialEq)]
+pub struct BivariateTtest {
+    /// first sample of the window, within a trace
+    start: usize,
+    /// number of samples of the window
+    w: usize,
+    /// number of traces of each class
+    n: [u64; NUM_CLASSES],
+    /// mean of each class and window sample: shape (NUM_CLASSES, w)
+    mean: Array2<f64>,
+    /// second central moment sum of each class and window sample: shape (NUM_CLASSES, w)
+    m2: Array2<f64>,
+    /// co-moment sums of each class, packed pair and order of [`COMOMENT_ORDERS`]:
+    /// shape (NUM_CLASSES, num_pairs(w), NUM_COMOMENTS)
+    cm: Array3<f64>,
+}
+
+impl BivariateTtest {
+    /// An accumulator of the pairs of the samples `start..start + w` of each trace.
+    pub fn new(start: usize, w: usize) -> Self {
+        BivariateTtest {
+            start,
+            w,
+            n: [0; NUM_CLASSES],
+            mean: Array2::zeros((NUM_CLASSES, w)),
+            m2: Array2::zeros((NUM_CLASSES, w)),
+            cm: Array3::zeros((NUM_CLASSES, num_pairs(w), NUM_COMOMENTS)),
+        }
+    }
+
+    /// The window of samples `(start, end)`.
+    pub fn window(&self) -> (usize, usize) {
+        (self.start, self.start + self.w)
+    }
+
+    /// Number of traces accumulated in each class.
+    pub fn num_traces(&self) -> [u64; NUM_CLASSES] {
+        self.n
+    }
+
+    /// Accumulate a batch of traces (one per row) with their class labels (0 or 1). The samples of the window past
+    /// the end of the traces are taken as zero, as if the traces were zero-padded.
+    pub fn update(&mut self, traces: ArrayView2<f32>, labels: ArrayView1<u16>) {
+        assert_eq!(
+            traces.nrows(),
+            labels.len(),
+            "Number of trace labels does not match number of traces"
+        );
+        assert!(
+            labels.iter().all(|&label| (label as usize) < NUM_CLASSES),
+            "Trace labels must be 0 or 1"
+        );
+        let rows: [Vec<usize>; NUM_CLASSES] = std::array::from_fn(|class| {
+            labels
+                .iter()
+                .enumerate()
+                .filter_map(|(i, &label)| (label as usize == class).then_some(i))
+                .collect()
+        });
+        self.update_rows(traces, &rows);
+    }
+
+    /// Accumulate the given rows of a batch of traces (one per row) into each class. The other rows are left out.
+    pub fn update_rows(&mut self, traces: ArrayView2<f32>, rows: &[Vec<usize>; NUM_CLASSES]) {
+        for (class, rows) in rows.iter().enumerate() {
+            for batch_rows in rows.chunks(BATCH_TRACES) {
+                let batch = self.batch_comoments(traces, batch_rows);
+                self.combine_class(class, &batch, 0);
+            }
+        }
+    }
+
+    /// Co-moments of the given rows of `traces`, as a single-class accumulator (class 0).
+    fn batch_comoments(&self, traces: ArrayView2<f32>, rows: &[usize]) -> BivariateTtest {
+        let w = self.w;
+        let mut batch = BivariateTtest::new(self.start, w);
+        batch.n[0] = rows.len() as u64;
+        // the window samples of each trace, then centred
+        let len = (self.start + w)
+            .min(traces.ncols())
+            .saturating_sub(self.start);
+        let mut d = Array2::<f64>::zeros((rows.len(), w));
+        if len > 0 {
+            for (mut d_row, &row) in d.rows_mut().into_iter().zip(rows) {
+                d_row.slice_mut(s![..len]).zip_mut_with(
+                    &traces.slice(s![row, self.start..self.start + len]),
+                    |d, &x| *d = x as f64,
+                );
+            }
+        }
+        let mean = d.mean_axis(Axis(0)).expect("Empty batch of traces");
+        d -= &mean;
+        let d2 = d.mapv(|x| x * x);
+        batch.mean.row_mut(0).assign(&mean);
+        batch.m2.row_mut(0).assign(&d2.sum_axis(Axis(0)));
+        // M_pq of the pairs (i, j) of a tile of rows i0..i1 are the products of the columns i0..i1 of d^p and
+        // the columns i0 + 1.. of d^q
+        split_tiles(batch.cm.index_axis_mut(Axis(0), 0), w)
+            .into_par_iter()
+            .for_each(|(i0, i1, mut tile)| {
+                for (c, &(p, q)) in COMOMENT_ORDERS.iter().enumerate() {
+                    let left = if p == 1 { &d } else { &d2 };
+                    let right = if q == 1 { &d } else { &d2 };
+                    let product = left
+                        .slice(s![.., i0..i1])
+                        .t()
+                        .dot(&right.slice(s![.., i0 + 1..]));
+                    let mut k = 0;
+                    for i in i0..i1 {
+                        let len = w - i - 1;
+                        tile.slice_mut(s![k..k + len, c])
+                            .assign(&product.slice(s![i - i0, i - i0..]));
+                        k += len;
+                    }
+                }
+            });
+        batch
+    }
+
+    /// Combine class `other_class` of `other` into class `class` of `self`.
+    fn combine_class(&mut self, class: usize, other: &BivariateTtest, other_class: usize) {
+        let (na, nb) = (self.n[class], other.n[other_class]);
+        if nb == 0 {
+            return;
+        }
+        if na == 0 {
+            self.n[class] = nb;
+            self.mean
+                .row_mut(class)
+                .assign(&other.mean.row(other_class));
+            self.m2.row_mut(class).assign(&other.m2.row(other_class));
+            self.cm
+                .index_axis_mut(Axis(0), class)
+                .assign(&other.cm.index_axis(Axis(0), other_class));
+            return;
+        }
+        let w = self.w;
+        let (na_f, nb_f) = (na as f64, nb as f64);
+        let n_f = na_f + nb_f;
+        let delta: Array1<f64> = &other.mean.row(other_class) - &self.mean.row(class);
+        let m2_a = self.m2.row(class);
+        let m2_b = other.m2.row(other_class);
+        let cm_b = other.cm.index_axis(Axis(0), other_class);
+        // the co-moments of the pairs are updated first, as they depend on the moments of each sample of both sides
+        split_tiles(self.cm.index_axis_mut(Axis(0), class), w)
+            .into_par_iter()
+            .for_each(|(i0, i1, mut tile)| {
+                let offset = row_start(w, i0);
+                let mut k = 0;
+                for i in i0..i1 {
+                    for j in i + 1..w {
+                        let mut pair_a = tile.row_mut(k);
+                        let pair_b = cm_b.row(offset + k);
+                        let moments_a = [
+                            [na_f, 0.0, m2_a[j]],
+                            [0.0, pair_a[0], pair_a[2]],
+                            [m2_a[i], pair_a[1], pair_a[3]],
+                        ];
+                        let moments_b = [
+                            [nb_f, 0.0, m2_b[j]],
+                            [0.0, pair_b[0], pair_b[2]],
+                            [m2_b[i], pair_b[1], pair_b[3]],
+                        ];
+                        // deviations of the mean of each side from the combined mean
+                        let shift_a = [-nb_f / n_f * delta[i], -nb_f / n_f * delta[j]];
+                        let shift_b = [na_f / n_f * delta[i], na_f / n_f * delta[j]];
+                        for (c, &(p, q)) in COMOMENT_ORDERS.iter().enumerate() {
+                            pair_a[c] = shifted_comoment(&moments_a, shift_a, p, q)
+                                + shifted_comoment(&moments_b, shift_b, p, q);
+                        }
+                        k += 1;
+                    }
+                }
+            });
+        let mut m2_a = self.m2.row_mut(class);
+        let mut mean_a = self.mean.row_mut(class);
+        for i in 0..w {
+            m2_a[i] += m2_b[i] + delta[i].powi(2) * na_f * nb_f / n_f;
+            mean_a[i] += delta[i] * nb_f / n_f;
+        }
+        self.n[class] = na + nb;
+    }
+
+    /// Merge the traces accumulated by `other` into `self`.
+    pub fn merge(&mut self, other: &BivariateTtest) {
+        assert_eq!(
+            self.window(),
+            other.window(),
+            "Cannot merge bivariate t-test accumulators of different windows"
+        );
+        for class in 0..NUM_CLASSES {
+            self.combine_class(class, other, class);
+        }
+    }
+
+    /// The t-statistic of the centred product of each pair, packed as in [`pair_index`].
+    pub fn get_ttest(&self) -> Array1<f64> {
+        let cm_0 = self.cm.index_axis(Axis(0), 0);
+        let cm_1 = self.cm.index_axis(Axis(0), 1);
+        let (n_0, n_1) = (self.n[0] as f64, self.n[1] as f64);
+        cm_0.rows()
+            .into_iter()
+            .zip(cm_1.rows())
+            .map(|(pair_0, pair_1)| {
+                // mean and variance of the centred product: M_11 / n and M_22 / n - (M_11 / n)^2
+                let (u_0, u_1) = (pair_0[0] / n_0, pair_1[0] / n_1);
+                let (v_0, v_1) = (pair_0[3] / n_0 - u_0.powi(2), pair_1[3] / n_1 - u_1.powi(2));
+                (u_0 - u_1) / (v_0 / n_0 + v_1 / n_1).sqrt()
+            })
+            .collect()
+    }
+
+    /// Save the t-statistics of the pairs to an NPZ file with the arrays `t_values` (packed upper triangle, see
+    /// [`pair_index`]) and `window` (`[start, end)` of the samples).
+    /// The file is written under a temporary name and then renamed, so readers never see partial files.
+    pub fn save_ttest<P: AsRef<Path>>(&self, path: P) -> miette::Result<()> {
+        let path = path.as_ref();
+        let tmp_path = path.with_extension("npz.tmp");
+        let file = File::create(&tmp_path)
+            .into_diagnostic()
+            .wrap_err_with(|| format!("Failed to create {}", tmp_path.display()))?;
+        let (start, end) = self.window();
+        let mut npz = NpzWriter::new_compressed(file);
+        npz.add_array("t_values", &self.get_ttest())
+            .into_diagnostic()?;
+        npz.add_array("window", &Array1::from_vec(vec![start as u64, end as u64]))
+            .into_diagnostic()?;
+        npz.finish()
+            .into_diagnostic()
+            .wrap_err_with(|| format!("Failed to write {}", tmp_path.display()))?;
+        std::fs::rename(&tmp_path, path).into_diagnostic()
+    }
+
+    /// Save the accumulator to an NPZ file with the arrays `num_traces`, `window`, `mean`, `m2` and `comoments`.
+    /// The file is written under a temporary name and then renamed, so readers never see partial files.
+    pub fn save<P: AsRef<Path>>(&self, path: P) -> miette::Result<()> {
+        let path = path.as_ref();
+        let tmp_path = path.with_extension("npz.tmp");
+        let file = File::create(&tmp_path)
+            .into_diagnostic()
+            .wrap_err_with(|| format!("Failed to create {}", tmp_path.display()))?;
+        let (start, end) = self.window();
+        let mut npz = NpzWriter::new_compressed(file);
+        npz.add_array("num_traces", &Array1::from_iter(self.n))
+            .into_diagnostic()?;
+        npz.add_array("window", &Array1::from_vec(vec![start as u64, end as u64]))
+            .into_diagnostic()?;
+        npz.add_array("mean", &self.mean).into_diagnostic()?;
+        npz.add_array("m2", &self.m2).into_diagnostic()?;
+        npz.add_array("comoments", &self.cm).into_diagnostic()?;
+        npz.finish()
+            .into_diagnostic()
+            .wrap_err_with(|| format!("Failed to write {}", tmp_path.display()))?;
+        std::fs::rename(&tmp_path, path).into_diagnostic()
+    }
+
+    /// Load an accumulator saved with [`BivariateTtest::save`].
+    pub fn load<P: AsRef<Path>>(path: P) -> miette::Result<Self> {
+        let path = path.as_ref();
+        let file = File::open(path)
+            .into_diagnostic()
+            .wrap_err_with(|| format!("Failed to open {}", path.display()))?;
+        let mut npz = NpzReader::new(std::io::BufReader::new(file)).into_diagnostic()?;
+        let n: Array1<u64> = npz
+            .by_name("num_traces")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'num_traces' in NPZ file")?;
+        let window: Array1<u64> = npz
+            .by_name("window")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'window' in NPZ file")?;
+        let mean: Array2<f64> = npz
+            .by_name("mean")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'mean' in NPZ file")?;
+        let m2: Array2<f64> = npz
+            .by_name("m2")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'm2' in NPZ file")?;
+        let cm: Array3<f64> = npz
+            .by_name("comoments")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'comoments' in NPZ file")?;
+        if n.len() != NUM_CLASSES || window.len() != 2 || window[1] < window[0] {
+            return Err(miette!(
+                "Inconsistent bivariate t-test moments in {}: {} classes, window {:?}",
+                path.display(),
+                n.len(),
+                window.to_vec()
+            ));
+        }
+        let (start, w) = (window[0] as usize, (window[1] - window[0]) as usize);
+        if mean.dim() != (NUM_CLASSES, w)
+            || m2.dim() != (NUM_CLASSES, w)
+            || cm.dim() != (NUM_CLASSES, num_pairs(w), NUM_COMOMENTS)
+        {
+            return Err(miette!(
+                "Inconsistent bivariate t-test moments in {}: window of {} samples, mean of shape {:?}, co-moments of shape {:?}",
+                path.display(),
+                w,
+                mean.dim(),
+                cm.dim()
+            ));
+        }
+        Ok(BivariateTtest {
+            start,
+            w,
+            n: [n[0], n[1]],
+            mean,
+            m2,
+            cm,
+        })
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use approx::assert_relative_eq;
+
+    /// Deterministic pseudo-random traces, where the neighbouring samples of class 1 are correlated.
+    fn test_traces(num_traces: usize, ns: usize) -> (Array2<f32>, Array1<u16>) {
+        let labels = Array1::from_shape_fn(num_traces, |i| ((i * 7 + i / 3) % 2) as u16);
+        let noise = Array2::from_shape_fn((num_traces, ns), |(i, j)| {
+            ((i as f32 * 12.9898 + j as f32 * 78.233).sin() * 43758.547).fract()
+        });
+        let traces = Array2::from_shape_fn((num_traces, ns), |(i, j)| match labels[i] {
+            0 => noise[(i, j)],
+            _ if j == 0 => noise[(i, j)],
+            _ => noise[(i, j)] + 0.8 * noise[(i, j - 1)],
+        });
+        (traces, labels)
+    }
+
+    /// The bivariate t-statistic of the pair `(i, j)`, from the centred products of each class computed directly.
+    fn direct_ttest(traces: ArrayView2<f32>, labels: ArrayView1<u16>, i: usize, j: usize) -> f64 {
+        let mut u = [0f64; NUM_CLASSES];
+        let mut v = [0f64; NUM_CLASSES];
+        let mut n = [0f64; NUM_CLASSES];
+        for class in 0..NUM_CLASSES {
+            let rows = traces
+                .rows()
+                .into_iter()
+                .zip(labels)
+                .filter(|&(_, &label)| label as usize == class)
+                .map(|(row, _)| (row[i] as f64, row[j] as f64))
+                .collect::<Vec<_>>();
+            n[class] = rows.len() as f64;
+            let mean_i = rows.iter().map(|&(x_i, _)| x_i).sum::<f64>() / n[class];
+            let mean_j = rows.iter().map(|&(_, x_j)| x_j).sum::<f64>() / n[class];
+            let products = rows
+                .iter()
+                .map(|&(x_i, x_j)| (x_i - mean_i) * (x_j - mean_j))
+                .collect::<Vec<_>>();
+            u[class] = products.iter().sum::<f64>() / n[class];
+            v[class] = products
+                .iter()
+                .map(|product| (product - u[class]).powi(2))
+                .sum::<f64>()
+                / n[class];
+        }
+        (u[0] - u[1]) / (v[0] / n[0] + v[1] / n[1]).sqrt()
+    }
+
+    #[test]
+    fn pairs_are_packed_row_by_row() {
+        for w in [0, 1, 2, 5, PAIR_TILE, PAIR_TILE + 1, 2 * PAIR_TILE + 3] {
+            let mut count = 0;
+            for (k, (i, j)) in pairs(w).enumerate() {
+                assert!(i < j && j < w);
+                assert_eq!(pair_index(w, i, j), k);
+                count += 1;
+            }
+            assert_eq!(count, num_pairs(w));
+            // the tiles cover the pairs in order
+            let mut packed = Array2::<f64>::zeros((num_pairs(w), 1));
+            let tiles = split_tiles(packed.view_mut(), w);
+            let mut next_row = 0;
+            let mut num_tile_pairs = 0;
+            for (i0, i1, tile) in tiles {
+                assert_eq!(i0, next_row);
+                assert!(i1 - i0 <= PAIR_TILE);
+                assert_eq!(tile.nrows(), (i0..i1).map(|i| w - i - 1).sum::<usize>());
+                next_row = i1;
+                num_tile_pairs += tile.nrows();
+            }
+            assert_eq!(next_row, w);
+            assert_eq!(num_tile_pairs, num_pairs(w));
+        }
+        assert_eq!(
+            pairs(4).collect::<Vec<_>>(),
+            [(0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3)]
+        );
+    }
+
+    #[test]
+    fn ttest_matches_direct_centred_products() {
+        // more traces than a batch, and a window wider than a tile
+        let (traces, labels) = test_traces(BATCH_TRACES + 300, 80);
+        let (start, w) = (3, PAIR_TILE + 6);
+        let mut bivariate = BivariateTtest::new(start, w);
+        bivariate.update(traces.view(), labels.view());
+        assert_eq!(
+            bivariate.num_traces().iter().sum::<u64>(),
+            traces.nrows() as u64
+        );
+        let t_values = bivariate.get_ttest();
+        assert_eq!(t_values.len(), num_pairs(w));
+        for (i, j) in [
+            (0, 1),
+            (0, w - 1),
+            (5, 6),
+            (PAIR_TILE - 1, PAIR_TILE),
+            (PAIR_TILE, w - 1),
+        ] {
+            assert_relative_eq!(
+                t_values[pair_index(w, i, j)],
+                direct_ttest(traces.view(), labels.view(), start + i, start + j),
+                epsilon = 1e-9,
+                max_relative = 1e-6
+            );
+        }
+        // the correlated neighbours of class 1 leak
+        assert!(t_values[pair_index(w, 5, 6)].abs() > 10.0);
+    }
+
+    #[test]
+    fn merge_matches_single_update() {
+        let (traces, labels) = test_traces(400, 12);
+        let (start, w) = (1, 10);
+        let mut all = BivariateTtest::new(start, w);
+        all.update(traces.view(), labels.view());
+        for split in [1, 150, 399] {
+            let mut merged = BivariateTtest::new(start, w);
+            merged.update(traces.slice(s![..split, ..]), labels.slice(s![..split]));
+            let mut other = BivariateTtest::new(start, w);
+            other.update(traces.slice(s![split.., ..]), labels.slice(s![split..]));
+            merged.merge(&other);
+            assert_eq!(merged.num_traces(), all.num_traces());
+            assert_relative_eq!(merged.mean, all.mean, epsilon = 1e-12, max_relative = 1e-9);
+            assert_relative_eq!(merged.m2, all.m2, epsilon = 1e-12, max_relative = 1e-9);
+            assert_relative_eq!(merged.cm, all.cm, epsilon = 1e-12, max_relative = 1e-9);
+            let t_values = merged.get_ttest();
+            for (i, j) in [(0, 1), (2, 7), (8, 9)] {
+                assert_relative_eq!(
+                    t_values[pair_index(w, i, j)],
+                    direct_ttest(traces.view(), labels.view(), start + i, start + j),
+                    epsilon = 1e-9,
+                    max_relative = 1e-6
+                );
+            }
+        }
+    }
+
+    #[test]
+    fn window_past_the_traces_is_zero_padded() {
+        let (traces, labels) = test_traces(200, 6);
+        let mut padded = Array2::<f32>::zeros((200, 9));
+        padded.slice_mut(s![.., ..6]).assign(&traces);
+        let mut bivariate = BivariateTtest::new(4, 5);
+        bivariate.update(traces.view(), labels.view());
+        let mut expected = BivariateTtest::new(4, 5);
+        expected.update(padded.view(), labels.view());
+        assert_eq!(bivariate, expected);
+    }
+
+    #[test]
+    fn save_and_load() {
+        let (traces, labels) = test_traces(100, 8);
+        let mut bivariate = BivariateTtest::new(2, 5);
+        bivariate.update(traces.view(), labels.view());
+        let path =
+            std::env::temp_dir().join(format!("scasim_bivariate_{}.npz", std::process::id()));
+        bivariate.save(&path).unwrap();
+        let loaded = BivariateTtest::load(&path).unwrap();
+        std::fs::remove_file(&path).unwrap();
+        assert_eq!(loaded, bivariate);
+    }
+}
@@ -1,45 +1,321 @@
-use fst_reader::{FstFilter, FstReader, FstSignalValue};
+use fst_reader::{
+    FstFilter, FstHierarchyEntry, FstReader, FstSignalHandle, FstSignalValue, FstVarType,
+};
 
 use itertools::Itertools;
 use log::info;
+use memmap2::Mmap;
 use miette::{Context, IntoDiagnostic};
-use ndarray::{Array1, Array2};
-use rustc_hash::FxHashMap as HashMap;
+use ndarray::{Array1, Array2, ArrayView1, s};
+use rayon::prelude::*;
 
-use std::io::BufReader;
+use std::io::{BufRead, Cursor, Seek};
+use std::ops::Range;
 use std::path::Path;
 
-use crate::{Hamming, markers_to_time_indices, power_model};
+use crate::popcount;
+use crate::power_model::with_power_kernel;
+use crate::{
+    Hamming, PowerKernel, PowerModel, SignalSelection, markers_to_time_indices, time_bins,
+    time_extent,
+};
 
+/// FST values are strings of bit characters (`0`, `1`, `x`, ...), one byte per bit.
 impl<'a> Hamming for &'a [u8] {
     #[inline(always)]
     fn hamming_weight(&self) -> u32 {
-        self.into_iter().fold(0, |w, byte| w + byte.count_ones()) as u32
+        popcount::ascii_ones(self)
     }
 
     #[inline(always)]
-    fn hamming_distance(&self, other: &Self) -> u32 {
-        self.into_iter()
-            .zip(other.into_iter())
-            .map(|(a, b)| (a ^ b).count_ones())
-            .sum()
+    fn transitions(&self, other: &Self) -> (u32, u32) {
+        popcount::ascii_transitions(self, other)
     }
 }
 
-pub fn traces_from_fst<P: AsRef<Path>, F: Fn(u64) -> bool>(
+/// Power of a value change under `kernel`. 1-bit values, which are a single state character, take a fast path.
+#[inline(always)]
+fn change_power<K: PowerKernel>(kernel: K, last_value: &[u8], new_value: &[u8]) -> f32 {
+    match (last_value, new_value) {
+        ([last_state], [new_state]) => kernel.bit_power(
+            popcount::ascii_level(*last_state),
+            popcount::ascii_level(*new_state),
+        ),
+        _ => kernel.power(&last_value, &new_value),
+    }
+}
+
+/// Index of `time` in the sorted `times`, advancing `cursor` for monotonically increasing queries.
+#[inline(always)]
+fn seek_time(times: &[u64], cursor: &mut usize, time: u64) -> Option<usize> {
+    if *cursor > 0 && times.get(*cursor - 1).is_some_and(|&t| t >= time) {
+        // went backwards, fall back to a binary search
+        *cursor = times.partition_point(|&t| t < time);
+    }
+    while *cursor < times.len() && times[*cursor] < time {
+        *cursor += 1;
+    }
+    (times.get(*cursor) == Some(&time)).then_some(*cursor)
+}
+
+/// Handles of the variables of an FST file selected by `selection`, or `None` if all variables are selected,
+/// and the weights of the handles under `power_model`, indexed by handle (empty if no signal is weighted).
+/// Aliased variables share a handle, which is listed once and takes the weight of its first weighted variable.
+fn select_fst_handles<R: BufRead + Seek>(
+    fst_reader: &mut FstReader<R>,
+    selection: &SignalSelection,
+    power_model: &PowerModel,
+) -> miette::Result<(Option<Vec<FstSignalHandle>>, Vec<f32>)> {
+    if selection.selects_all() && !power_model.has_weights() {
+        return Ok((None, Vec::new()));
+    }
+    let mut scopes: Vec<String> = Vec::new();
+    let mut handles = Vec::new();
+    let mut handle_weights: Vec<Option<f32>> = Vec::new();
+    fst_reader
+        .read_hierarchy(|entry| match entry {
+            FstHierarchyEntry::Scope { name, .. } => scopes.push(name),
+            FstHierarchyEntry::UpScope => {
+                scopes.pop();
+            }
+            FstHierarchyEntry::Var {
+                name, handle, tpe, ..
+            } => {
+                let full_name = scopes
+                    .iter()
+                    .map(String::as_str)
+                    .chain([name.as_str()])
+                    .join(".");
+                if selection.selects_all()
+                    || selection.is_selected(&full_name, matches!(tpe, FstVarType::Reg))
+                {
+                    handles.push(handle);
+                }
+                if let Some(weight) = power_model.weight_of(&full_name) {
+                    let index = handle.get_index();
+                    if handle_weights.len() <= index {
+                        handle_weights.resize(index + 1, None);
+                    }
+                    handle_weights[index].get_or_insert(weight);
+                }
+            }
+            _ => {}
+        })
+        .into_diagnostic()
+        .wrap_err("Failed to read the hierarchy of the FST file")?;
+    let handle_weights = handle_weights
+        .into_iter()
+        .map(|weight| weight.unwrap_or(1.0))
+        .collect();
+    if selection.selects_all() {
+        return Ok((None, handle_weights));
+    }
+    handles.sort_by_key(|handle| handle.get_index());
+    handles.dedup();
+    info!("Selected {} signals", handles.len());
+    Ok((Some(handles), handle_weights))
+}
+
+/// Number of pieces the analyzed time of an FST file is split into, for decoding them in parallel.
+/// It is fixed, so that the order of the floating-point additions does not depend on the number of threads.
+const FST_PIECES: usize = 64;
+
+/// A time range `[start_time, end_time)` of an FST file, decoded by a single thread.
+struct FstPiece {
+    start_time: u64,
+    end_time: u64,
+    /// indices of the samples within the piece
+    samples: Range<usize>,
+    /// whether the piece starts where the previous piece ends, so that the signal values carry over
+    continues: bool,
+}
+
+/// The power of the samples of a piece, and what is needed to stitch it to the previous piece.
+struct DecodedPiece {
+    power: Vec<f32>,
+    /// changes at a sample whose previous value is in an earlier piece, as (sample index, handle index, value)
+    first_changes: Vec<(usize, usize, Vec<u8>)>,
+    /// value of each signal at the end of the piece, empty if it was not seen
+    last_values: Vec<Vec<u8>>,
+}
+
+/// Split the time spans into contiguous pieces of about `samples_per_piece` samples each.
+/// If `binned`, the sample times are the start times of bins, and the samples of a span also include the bin holding
+/// its start, as [`crate::accumulate_binned_power`] adds the changes at the start of the span to it. Adjacent spans
+/// may then share a bin.
+fn split_spans(
+    time_spans: &[(u64, u64)],
+    sample_times: &[u64],
+    samples_per_piece: usize,
+    binned: bool,
+) -> Vec<FstPiece> {
+    let mut pieces = Vec::new();
+    for &(span_start, span_end) in time_spans {
+        let lo = if binned {
+            sample_times
+                .partition_point(|&t| t <= span_start)
+                .saturating_sub(1)
+        } else {
+            sample_times.partition_point(|&t| t < span_start)
+        };
+        let hi = sample_times.partition_point(|&t| t < span_end);
+        let num_pieces = (hi - lo).div_ceil(samples_per_piece).max(1);
+        for k in 0..num_pieces {
+            let (a, b) = (
+                lo + (hi - lo) * k / num_pieces,
+                lo + (hi - lo) * (k + 1) / num_pieces,
+            );
+            pieces.push(FstPiece {
+                start_time: if k == 0 { span_start } else { sample_times[a] },
+                end_time: if k + 1 == num_pieces {
+                    span_end
+                } else {
+                    sample_times[b]
+                },
+                samples: a..b,
+                continues: k > 0,
+            });
+        }
+    }
+    pieces
+}
+
+/// Decode the value changes of a piece with its own reader, adding their power under `kernel`, scaled by the weight
+/// of their handle, into the samples of the piece.
+fn decode_piece<F: Fn(u64) -> bool, K: PowerKernel>(
+    data: &[u8],
+    piece: &FstPiece,
+    sample_times: &[u64],
+    time_filter: &F,
+    bin_width: Option<u64>,
+    maybe_handles: &Option<Vec<FstSignalHandle>>,
+    num_handles: usize,
+    kernel: K,
+    handle_weights: &[f32],
+) -> miette::Result<DecodedPiece> {
+    let mut fst_reader =
+        FstReader::open_and_read_time_table(Cursor::new(data)).into_diagnostic()?;
+    let mut power = vec![0f32; piece.samples.len()];
+    let mut first_changes = Vec::new();
+    // dense table of the last value of each signal, indexed by handle; an empty value means not seen yet
+    let mut last_values: Vec<Vec<u8>> = vec![Vec::new(); num_handles];
+    let mut sample_cursor = piece.samples.start;
+    let signal_filter = FstFilter {
+        start: piece.start_time,
+        end: (piece.end_time != u64::MAX).then_some(piece.end_time),
+        include: maybe_handles.clone(),
+    };
+    fst_reader
+        .read_signals(&signal_filter, |time, signal_handle, signal_value| {
+            let FstSignalValue::String(signal_value) = signal_value else {
+                return;
+            };
+            // the blocks overlapping the piece also hold changes after it, which belong to the next piece
+            if time >= piece.end_time {
+                return;
+            }
+            let last_value = &mut last_values[signal_handle.get_index()];
+            // changes before the piece (in its first block) only set the values at its start
+            let maybe_sample_index = match bin_width {
+                _ if time < piece.start_time => None,
+                // the bins are contiguous, starting at the first sample time
+                Some(bin_width) => sample_times
+                    .first()
+                    .and_then(|&first_time| time.checked_sub(first_time))
+                    .map(|offset| (offset / bin_width) as usize)
+                    .filter(|sample_index| piece.samples.contains(sample_index)),
+                None if time_filter(time) => seek_time(sample_times, &mut sample_cursor, time),
+                None => None,
+            };
+            if let Some(sample_index) = maybe_sample_index {
+                if !last_value.is_empty() {
+                    let weight = handle_weights
+                        .get(signal_handle.get_index())
+                        .copied()
+                        .unwrap_or(1.0);
+                    power[sample_index - piece.samples.start] +=
+                        weight * change_power(kernel, last_value, signal_value);
+                } else if piece.continues {
+                    first_changes.push((
+                        sample_index,
+                        signal_handle.get_index(),
+                        signal_value.to_vec(),
+                    ));
+                }
+            }
+            last_value.clear();
+            last_value.extend_from_slice(signal_value);
+        })
+        .into_diagnostic()
+        .wrap_err("Failed to read signals from FST file")?;
+    Ok(DecodedPiece {
+        power,
+        first_changes,
+        last_values,
+    })
+}
+
+/// Convert an FST waveform directly into power traces, one per marker, decoding the file in parallel.
+///  * `meta_markers` are the `(start_time, end_time, label)` of each trace.
+///  * `time_filter` selects the time points that become samples (e.g. clock edges).
+///    Value changes at other times update the signal state but do not contribute power.
+///  * `bin_width`, if given, replaces `time_filter`: samples are bins of `bin_width` time units (e.g. clock
+///    cycles), aligned to multiples of `bin_width`, and each one adds the power of all the changes within it.
+///  * `selection` selects the signals that contribute power; the others are not read at all.
+///  * `power_model` gives the power of each value change, and the weights of the signals.
+///  * `time_spans`, if given, are the sorted and disjoint `(start_time, end_time)` spans covering all markers
+///    (see [`crate::marker_spans`]). Only the blocks of value changes overlapping them are read.
+///
+/// The file is memory-mapped, and the spans are split into pieces that are decoded in parallel, each with its own
+/// reader, into the power of their samples. The pieces are then stitched in time order: the first change of a
+/// signal within a piece takes its previous value from the end of the earlier pieces. Samples are the distinct
+/// filtered time points within each marker, matching the layout of [`crate::generate_power_trace`] followed by
+/// cutting the trace at the markers.
+/// Returns the traces, their labels and the time table of the file.
+pub fn traces_from_fst<P: AsRef<Path>, F: Fn(u64) -> bool + Sync>(
     filename: P,
     meta_markers: &[(u64, u64, u16)],
     time_filter: F,
+    bin_width: Option<u64>,
+    selection: &SignalSelection,
+    power_model: &PowerModel,
+    time_spans: Option<&[(u64, u64)]>,
 ) -> miette::Result<(Array2<f32>, Array1<u16>, Vec<u64>)> {
-    let file_reader = BufReader::new(std::fs::File::open(filename).into_diagnostic()?);
-    let mut fst_reader = FstReader::open_and_read_time_table(file_reader).into_diagnostic()?;
+    let filename = filename.as_ref();
+    let file = std::fs::File::open(filename)
+        .into_diagnostic()
+        .wrap_err_with(|| format!("Failed to open {}", filename.display()))?;
+    // Safety: waveform files are not modified while they are analyzed.
+    let data = unsafe { Mmap::map(&file) }
+        .into_diagnostic()
+        .wrap_err_with(|| format!("Failed to map {}", filename.display()))?;
+    let mut fst_reader =
+        FstReader::open_and_read_time_table(Cursor::new(&data[..])).into_diagnostic()?;
     let time_table = fst_reader
         .get_time_table()
         .wrap_err("Failed to read time table from FST file. Is the file valid?")?
         .to_vec();
+
+    // the distinct time points that become samples, or the start times of the bins
+    let sample_times = match bin_width {
+        Some(bin_width) => {
+            let (start_time, end_time) = time_extent(time_spans, &time_table);
+            time_bins(&[], bin_width, start_time, end_time).0
+        }
+        None => {
+            let mut sample_times = time_table
+                .iter()
+                .copied()
+                .filter(|&t| time_filter(t))
+                .collect_vec();
+            sample_times.dedup();
+            sample_times
+        }
+    };
+
     println!("Converting markers to time indices...");
     let start_time = std::time::Instant::now();
-    let time_indices_and_labels = markers_to_time_indices(meta_markers, &time_table);
+    let windows = markers_to_time_indices(meta_markers, &sample_times);
     println!(
         "Converted markers to time indices in {:.2}s",
         start_time.elapsed().as_secs_f32()
@@ -47,7 +323,17 @@ pub fn traces_from_fst<P: AsRef<Path>, F: Fn(u64) -> bool>(
 
     let num_traces = meta_markers.len();
 
-    let (min_len, max_len) = time_indices_and_labels
+    assert!(
+        num_traces > 0,
+        "No traces found in the FST file. Please check the file and markers."
+    );
+    assert!(
+        num_traces == windows.len(),
+        "Number of traces ({num_traces}) does not match number of time indices ({})",
+        windows.len()
+    );
+
+    let (min_len, max_len) = windows
         .iter()
         .map(|(lo, hi, _)| hi - lo)
         .minmax()
@@ -55,91 +341,94 @@ pub fn traces_from_fst<P: AsRef<Path>, F: Fn(u64) -> bool>(
         .expect("No time indices found");
 
     info!("Num traces: {num_traces}, Max length of traces: {max_len}, Min length: {min_len}");
-    assert!(
-        num_traces > 0,
-        "No traces found in the FST file. Please check the file and markers."
-    );
-    assert!(
-        num_traces == time_indices_and_labels.len(),
-        "Number of traces ({num_traces}) does not match number of time indices ({})",
-        time_indices_and_labels.len()
+
+    let (maybe_handles, handle_weights) =
+        select_fst_handles(&mut fst_reader, selection, power_model)?;
+    let num_handles = fst_reader.get_header().max_handle as usize + 1;
+
+    let whole_file = [(0, u64::MAX)];
+    let time_spans = time_spans.unwrap_or(&whole_file);
+    let num_samples: usize = time_spans
+        .iter()
+        .map(|&(span_start, span_end)| {
+            sample_times.partition_point(|&t| t < span_end)
+                - sample_times.partition_point(|&t| t < span_start)
+        })
+        .sum();
+    let pieces = split_spans(
+        time_spans,
+        &sample_times,
+        num_samples.div_ceil(FST_PIECES).max(1),
+        bin_width.is_some(),
     );
 
-    let header = fst_reader.get_header();
+    let start_time = std::time::Instant::now();
+    let decoded_pieces = pieces
+        .par_iter()
+        .map(|piece| {
+            with_power_kernel!(power_model, kernel => decode_piece(
+                &data,
+                piece,
+                &sample_times,
+                &time_filter,
+                bin_width,
+                &maybe_handles,
+                num_handles,
+                kernel,
+                &handle_weights,
+            ))
+        })
+        .collect::<miette::Result<Vec<_>>>()?;
 
-    // let mut traces_array = Array2::<f32>::zeros((time_indices_and_labels.len(), max_len));
-    // let mut labels_array = Array1::<u16>::zeros(time_indices_and_labels.len());
-    // let (num_traces, cur_samples_per_trace) = traces_array.dim();
+    // stitch the pieces in time order
+    let mut power_table = vec![0f32; sample_times.len()];
+    let mut carried_values: Vec<Vec<u8>> = vec![Vec::new(); num_handles];
+    for (piece, decoded_piece) in pieces.iter().zip(decoded_pieces) {
+        if !piece.continues {
+            // The values before a skipped gap are stale: start over from the values reported by the reader, which
+            // begin with the value frame of the first block overlapping the span.
+            carried_values.iter_mut().for_each(Vec::clear);
+        }
+        // pieces of adjacent spans may share a bin
+        power_table[piece.samples.clone()]
+            .iter_mut()
+            .zip(&decoded_piece.power)
+            .for_each(|(power, piece_power)| *power += piece_power);
+        for (sample_index, handle_index, signal_value) in decoded_piece.first_changes {
+            let carried_value = &carried_values[handle_index];
+            if !carried_value.is_empty() {
+                let weight = handle_weights.get(handle_index).copied().unwrap_or(1.0);
+                power_table[sample_index] += weight
+                    * with_power_kernel!(power_model, kernel => change_power(
+                        kernel,
+                        carried_value,
+                        &signal_value,
+                    ));
+            }
+        }
+        for (carried_value, last_value) in carried_values.iter_mut().zip(decoded_piece.last_values)
+        {
+            if !last_value.is_empty() {
+                *carried_value = last_value;
+            }
+        }
+    }
 
     let mut all_traces = Array2::<f32>::zeros((num_traces, max_len));
-    let mut labels = Array1::<u16>::zeros(num_traces);
-
-    meta_markers
-        .into_iter()
-        .enumerate()
-        .for_each(|(trace_index, (start, end, label))| {
-            labels[trace_index] = *label;
-
-            let low_index = time_table.binary_search(&start).unwrap_or_else(|x| x);
-            // find the end index
-            let high_index = time_table.binary_search(&end).unwrap_or_else(|x| x);
-
-            let time_table_slice = &time_table[low_index..high_index];
-            let mut last_values: HashMap<u32, Vec<u8>> = HashMap::with_capacity_and_hasher(
-                header.var_count as usize,
-                rustc_hash::FxBuildHasher,
-            );
-            let filter = FstFilter::filter_time(*start, *end - 1);
-            fst_reader
-                .read_signals(
-                    &filter,
-                    |time, signal_handle, signal_value| match signal_value {
-                        FstSignalValue::String(signal_value) => {
-                            let time_index =
-                                time_table_slice.binary_search(&time).unwrap_or_else(|x| x);
-
-                            // if time_filter.as_ref().map(|f| f(time)).unwrap_or(true) {
-                            if time_filter(time) {
-                                let sig = signal_handle.get_index() as u32;
-
-                                // println!(
-                                //     "Processing signal: {}, time: {}, time_index: {}",
-                                //     sig, time, time_index
-                                // );
-
-                                if let Some(last_value) = last_values.get(&sig) {
-                                    all_traces[[trace_index, time_index]] +=
-                                        power_model(&last_value.as_slice(), &signal_value);
-                                }
-
-                                last_values.insert(sig, signal_value.to_vec());
-                            }
-                        }
-                        _ => {}
-                    },
-                )
-                .expect("Failed to read signals from FST file");
-        });
-
-    // let mut leftover = 0.0;
-
-    // let (left, right): (Vec<u64>, Vec<f32>) = time_table
-    //     .iter()
-    //     .zip(power_table)
-    //     .opt_filter(filter_predicate, do_filter) // filter out zero power values
-    //     .tuple_windows()
-    //     .filter_map(|((t0, p0), (t1, _))| {
-    //         if t0 == t1 {
-    //             // If two consecutive time points are the same, average their power values
-    //             leftover = p0;
-    //             None
-    //         } else {
-    //             let p: f32 = p0 + leftover;
-    //             leftover = 0.0; // reset leftover
-    //             Some((t0, p))
-    //         }
-    //     })
-    //     .unzip(); // .collect::<Vec<_>>();
+    for (i, &(lo, hi, _)) in windows.iter().enumerate() {
+        all_traces
+            .slice_mut(s![i, ..hi - lo])
+            .assign(&ArrayView1::from(&power_table[lo..hi]));
+    }
+    let labels = windows
+        .iter()
+        .map(|&(_, _, label)| label)
+        .collect::<Array1<u16>>();
+    info!(
+        "Generated {num_traces} traces from the FST file in {} pieces in {:.2}s",
+        pieces.len(),
+        start_time.elapsed().as_secs_f32()
+    );
 
     Ok((all_traces, labels, time_table))
 }
@@ -2,19 +2,36 @@ use indicatif::ProgressStyle;
 use itertools::Itertools;
 use log::{debug, info};
 use num_format::{Locale, ToFormattedString};
+use rayon::prelude::*;
+use std::ops::Range;
 use std::path::Path;
 use std::sync::Arc;
 use std::sync::atomic::{AtomicBool, AtomicU64, Ordering};
 use std::thread;
 
+pub mod attribution;
+pub mod bivariate;
 pub mod fst;
 pub mod optional_filter;
+pub mod partition;
 pub mod plot;
+pub mod popcount;
 pub mod power_model;
+pub mod signal_selection;
+pub mod toggle_cache;
+pub mod trace_store;
+pub mod ttest;
+pub mod zarr_store;
 
+pub use attribution::*;
 pub use fst::*;
 pub use optional_filter::*;
+pub use partition::*;
 pub use power_model::*;
+pub use signal_selection::*;
+pub use toggle_cache::*;
+pub use trace_store::*;
+pub use zarr_store::*;
 
 pub fn markers_to_time_indices(
     meta_markers: &[(u64, u64, u16)],
@@ -43,11 +60,88 @@ pub fn markers_to_time_indices(
         .collect()
 }
 
-pub fn load_waveform<P: AsRef<Path>>(
+/// Restrict each marker to the region of interest `[start_time + roi.0, start_time + roi.1)`, relative to its start.
+pub fn apply_roi(meta_markers: &[(u64, u64, u16)], roi: (u64, u64)) -> Vec<(u64, u64, u16)> {
+    meta_markers
+        .iter()
+        .map(|&(start_time, _, label)| (start_time + roi.0, start_time + roi.1, label))
+        .collect()
+}
+
+/// The union of the marker intervals, as sorted and disjoint `(start_time, end_time)` spans.
+/// Intervals separated by a gap shorter than `min_gap` are merged, so that short gaps are read through.
+pub fn marker_spans(meta_markers: &[(u64, u64, u16)], min_gap: u64) -> Vec<(u64, u64)> {
+    let mut spans: Vec<(u64, u64)> = Vec::new();
+    for &(start_time, end_time, _) in meta_markers.iter().sorted_by_key(|marker| marker.0) {
+        match spans.last_mut() {
+            Some(last) if start_time < last.1.saturating_add(min_gap) => {
+                last.1 = last.1.max(end_time)
+            }
+            _ => spans.push((start_time, end_time)),
+        }
+    }
+    spans
+}
+
+/// The time index ranges of sorted time spans, as [`markers_to_time_indices`] does for markers.
+pub fn spans_to_time_indices(spans: &[(u64, u64)], time_table: &[u64]) -> Vec<Range<usize>> {
+    spans
+        .iter()
+        .map(|&(start_time, end_time)| {
+            time_table.partition_point(|&t| t < start_time)
+                ..time_table.partition_point(|&t| t < end_time)
+        })
+        .collect()
+}
+
+/// The time range `[start_time, end_time)` covered by the sorted time spans, or by the whole time table.
+pub fn time_extent(time_spans: Option<&[(u64, u64)]>, time_table: &[u64]) -> (u64, u64) {
+    match time_spans {
+        Some(time_spans) => (
+            time_spans.first().map_or(0, |span| span.0),
+            time_spans.last().map_or(0, |span| span.1),
+        ),
+        None => (
+            time_table.first().copied().unwrap_or(0),
+            time_table.last().map_or(0, |&t| t + 1),
+        ),
+    }
+}
+
+/// Bin the time between `start_time` and `end_time` into samples of `bin_width` time units, aligned to multiples of
+/// `bin_width`: sample `k` covers `[(first + k) * bin_width, (first + k + 1) * bin_width)`.
+/// Returns the start time of each bin, and the bin of each time index of `time_table` (`u32::MAX` outside the bins).
+pub fn time_bins(
+    time_table: &[u64],
+    bin_width: u64,
+    start_time: u64,
+    end_time: u64,
+) -> (Vec<u64>, Vec<u32>) {
+    assert!(bin_width > 0, "Bin width must be greater than 0");
+    let first_bin = start_time / bin_width;
+    let end_bin = end_time.div_ceil(bin_width).max(first_bin);
+    let bin_times = (first_bin..end_bin).map(|k| k * bin_width).collect_vec();
+    let slots = time_table
+        .iter()
+        .map(|&t| {
+            let k = t / bin_width;
+            if (first_bin..end_bin).contains(&k) {
+                (k - first_bin) as u32
+            } else {
+                u32::MAX
+            }
+        })
+        .collect_vec();
+    (bin_times, slots)
+}
+
+/// Read the header and body of a waveform file, without loading any signals.
+/// Returns the hierarchy, the signal source to load signals from, and the time table.
+pub fn open_waveform<P: AsRef<Path>>(
     filename: P,
     multi_thread: bool,
     show_progress: bool,
-) -> Result<(Vec<(wellen::SignalRef, wellen::Signal)>, Vec<u64>), wellen::WellenError> {
+) -> Result<(wellen::Hierarchy, wellen::SignalSource, Vec<u64>), wellen::WellenError> {
     let load_opts = wellen::LoadOptions {
         multi_thread,
         remove_scopes_with_empty_name: false,
@@ -113,11 +207,32 @@ pub fn load_waveform<P: AsRef<Path>>(
         body.time_table.len().to_formatted_string(&Locale::en)
     );
 
-    let signal_refs = hierarchy.iter_vars().map(|v| v.signal_ref()).collect_vec();
+    body.source.print_statistics();
 
-    let mut wave_source = body.source;
+    Ok((hierarchy, body.source, body.time_table))
+}
 
-    wave_source.print_statistics();
+/// Load the signals selected by `selection` from a waveform file, its time table, and the weights of the signals
+/// under `power_model`.
+pub fn load_waveform<P: AsRef<Path>>(
+    filename: P,
+    multi_thread: bool,
+    show_progress: bool,
+    selection: &SignalSelection,
+    power_model: &PowerModel,
+) -> Result<
+    (
+        Vec<(wellen::SignalRef, wellen::Signal)>,
+        Vec<u64>,
+        SignalWeights,
+    ),
+    wellen::WellenError,
+> {
+    let (hierarchy, mut wave_source, time_table) =
+        open_waveform(filename, multi_thread, show_progress)?;
+
+    let signal_refs = selection.select_signal_refs(&hierarchy);
+    let signal_weights = power_model.signal_weights(&hierarchy);
 
     info!(
         "Loading {} signals..",
@@ -125,36 +240,432 @@ pub fn load_waveform<P: AsRef<Path>>(
     );
     let start_time = std::time::Instant::now();
     // wave_source.print_statistics();
-    let signals = wave_source.load_signals(&signal_refs, &hierarchy, load_opts.multi_thread);
+    let mut signals = wave_source.load_signals(&signal_refs, &hierarchy, multi_thread);
+    selection.retain_changing(&mut signals);
     info!(
         "Loaded signals in {:.2}s",
         start_time.elapsed().as_secs_f32()
     );
 
-    Ok((signals, body.time_table))
+    Ok((signals, time_table, signal_weights))
 }
 
-pub fn generate_power_trace<F: Fn(&(&u64, f32)) -> bool>(
-    signals: &[(wellen::SignalRef, wellen::Signal)],
-    time_table: &[u64],
-    filter_predicate: F,
-    //    filter_predicate: Option<fn((u64, f32)) -> bool>,
-    // filter_predicate: fn(&(&u64, f32)) -> bool,
-    do_filter: bool,
+/// Number of signals in the first batch of [`load_power_table_batched`], before their memory footprint is known.
+const FIRST_SIGNAL_BATCH: usize = 256;
+
+/// Load the signals selected by `selection` from a waveform in batches and add their power under `power_model` into
+/// a per-time-index power table, dropping each batch before loading the next one.
+/// If `time_spans` is given, only the power of the value changes within these time spans is computed.
+///  * `max_memory` is the memory budget in bytes for the time table, the power tables and one batch of signals.
+///    The size of each batch is chosen from the average in-memory size of the signals loaded so far.
+///  * `bin_width`, if given, adds the power into bins of that many time units instead (see [`time_bins`]),
+///    covering the time spans (or the whole waveform).
+/// returns the time table and the (unfiltered) power table, or the start times of the bins and their power.
+pub fn load_power_table_batched<P: AsRef<Path>>(
+    filename: P,
+    multi_thread: bool,
+    show_progress: bool,
+    max_memory: u64,
+    selection: &SignalSelection,
+    power_model: &PowerModel,
+    time_spans: Option<&[(u64, u64)]>,
+    bin_width: Option<u64>,
 ) -> Result<(Vec<u64>, Vec<f32>), wellen::WellenError> {
-    let mut power_table = vec![0f32; time_table.len()];
+    let (hierarchy, mut wave_source, time_table) =
+        open_waveform(filename, multi_thread, show_progress)?;
 
-    for (_, signal) in signals.iter() {
-        let mut prev_value: Option<wellen::SignalValue> = None;
-        for (time_index, new_value) in signal.iter_changes() {
-            if let Some(prev_value) = prev_value {
-                // we have a previous value, compute the power
-                power_table[time_index as usize] += power_model(&prev_value, &new_value);
+    let signal_refs = selection.select_signal_refs(&hierarchy);
+    let signal_weights = power_model.signal_weights(&hierarchy);
+    let index_spans = match time_spans {
+        Some(time_spans) => spans_to_time_indices(time_spans, &time_table),
+        None => vec![0..time_table.len()],
+    };
+    let maybe_bins = bin_width.map(|bin_width| {
+        let (start_time, end_time) = time_extent(time_spans, &time_table);
+        time_bins(&time_table, bin_width, start_time, end_time)
+    });
+    let num_samples = maybe_bins
+        .as_ref()
+        .map_or(time_table.len(), |(bin_times, _)| bin_times.len());
+    let mut power_table = vec![0f32; num_samples];
+
+    // the time table, the power table and the partial power tables of the workers
+    let tables_size = (time_table.len() * size_of::<u64>()
+        + maybe_bins.as_ref().map_or(0, |(bin_times, slots)| {
+            bin_times.len() * size_of::<u64>() + slots.len() * size_of::<u32>()
+        })
+        + power_table.len() * (1 + rayon::current_num_threads()) * size_of::<f32>())
+        as u64;
+    let batch_budget = max_memory.saturating_sub(tables_size);
+    if batch_budget == 0 {
+        log::warn!(
+            "The time and power tables alone need {} bytes, exceeding the memory budget of {} bytes",
+            tables_size.to_formatted_string(&Locale::en),
+            max_memory.to_formatted_string(&Locale::en)
+        );
+    }
+
+    info!(
+        "Loading {} signals in batches of at most {} bytes..",
+        signal_refs.len().to_formatted_string(&Locale::en),
+        batch_budget.to_formatted_string(&Locale::en)
+    );
+    let start_time = std::time::Instant::now();
+    let mut num_loaded = 0;
+    let mut loaded_size = 0u64;
+    let mut num_batches = 0;
+    while num_loaded < signal_refs.len() {
+        let batch_len = if num_loaded == 0 {
+            FIRST_SIGNAL_BATCH
+        } else {
+            let avg_signal_size = (loaded_size / num_loaded as u64).max(1);
+            (batch_budget / avg_signal_size).max(1) as usize
+        };
+        let batch = &signal_refs[num_loaded..(num_loaded + batch_len).min(signal_refs.len())];
+        let mut signals = wave_source.load_signals(batch, &hierarchy, multi_thread);
+        loaded_size += signals
+            .iter()
+            .map(|(_, signal)| signal.size_in_memory() as u64)
+            .sum::<u64>();
+        selection.retain_changing(&mut signals);
+        match &maybe_bins {
+            Some((_, slots)) => accumulate_binned_power(
+                &signals,
+                power_model,
+                &signal_weights,
+                &mut power_table,
+                &index_spans,
+                slots,
+            ),
+            None => accumulate_power_in_spans(
+                &signals,
+                power_model,
+                &signal_weights,
+                &mut power_table,
+                &index_spans,
+            ),
+        }
+        num_loaded += batch.len();
+        num_batches += 1;
+        debug!(
+            "Batch {num_batches}: {} signals, {} of {} signals processed",
+            batch.len(),
+            num_loaded,
+            signal_refs.len()
+        );
+    }
+    info!(
+        "Loaded signals and generated power in {} batches in {:.2}s",
+        num_batches,
+        start_time.elapsed().as_secs_f32()
+    );
+
+    match maybe_bins {
+        Some((bin_times, _)) => Ok((bin_times, power_table)),
+        None => Ok((time_table, power_table)),
+    }
+}
+
+/// Number of signals whose power is summed into one partial power table by a single worker.
+/// It is fixed, so that the order of the floating-point additions does not depend on the number of threads.
+const POWER_CHUNK_SIGNALS: usize = 512;
+
+/// Number of time indices reduced at once when adding the partial power tables into the result.
+const POWER_REDUCE_CHUNK: usize = 1 << 16;
+
+/// Add the power of all value changes of `signals` under `power_model`, scaled by their `signal_weights`, into
+/// `power_table`, indexed by time index.
+///
+/// Signals are split into fixed-size chunks, and each rayon worker sums the power of one chunk into its own
+/// partial table. The partial tables are then added into `power_table` in chunk order, so the result is
+/// bit-identical for any number of threads. Needs one extra table of `power_table.len()` floats per thread.
+pub fn accumulate_power(
+    signals: &[(wellen::SignalRef, wellen::Signal)],
+    power_model: &PowerModel,
+    signal_weights: &SignalWeights,
+    power_table: &mut [f32],
+) {
+    let whole_table = [0..power_table.len()];
+    accumulate_power_in_spans(
+        signals,
+        power_model,
+        signal_weights,
+        power_table,
+        &whole_table,
+    );
+}
+
+/// Like [`accumulate_power`], but only for the value changes within the sorted and disjoint time index ranges
+/// `index_spans`. The values outside the spans are still followed, as the power depends on the previous value.
+pub fn accumulate_power_in_spans(
+    signals: &[(wellen::SignalRef, wellen::Signal)],
+    power_model: &PowerModel,
+    signal_weights: &SignalWeights,
+    power_table: &mut [f32],
+    index_spans: &[Range<usize>],
+) {
+    accumulate_power_slots(
+        signals,
+        power_model,
+        signal_weights,
+        power_table,
+        index_spans,
+        |time_index| time_index,
+    );
+}
+
+/// Like [`accumulate_power_in_spans`], but adding the power of the changes at each time index into its bin
+/// `slots[time_index]` (see [`time_bins`]), so that no change between the sampled time points is lost.
+pub fn accumulate_binned_power(
+    signals: &[(wellen::SignalRef, wellen::Signal)],
+    power_model: &PowerModel,
+    signal_weights: &SignalWeights,
+    bin_power: &mut [f32],
+    index_spans: &[Range<usize>],
+    slots: &[u32],
+) {
+    accumulate_power_slots(
+        signals,
+        power_model,
+        signal_weights,
+        bin_power,
+        index_spans,
+        |time_index| slots[time_index] as usize,
+    );
+}
+
+/// Add the power of the value changes within `index_spans` into `power_table[slot_of(time_index)]`,
+/// in parallel as described in [`accumulate_power`]. Changes whose slot is out of the table are skipped.
+fn accumulate_power_slots<S: Fn(usize) -> usize + Sync>(
+    signals: &[(wellen::SignalRef, wellen::Signal)],
+    power_model: &PowerModel,
+    signal_weights: &SignalWeights,
+    power_table: &mut [f32],
+    index_spans: &[Range<usize>],
+    slot_of: S,
+) {
+    accumulate_in_chunks(signals, power_table, |chunk, partial| {
+        with_power_kernel!(power_model, kernel => accumulate_power_serial(
+            chunk,
+            kernel,
+            signal_weights,
+            partial,
+            index_spans,
+            &slot_of,
+        ))
+    });
+}
+
+/// Add the power that `accumulate(chunk, partial_table)` computes for fixed-size chunks of `signals` into
+/// `power_table`, in parallel and in a deterministic order as described in [`accumulate_power`].
+pub(crate) fn accumulate_in_chunks<T: Sync, A: Fn(&[T], &mut [f32]) + Sync>(
+    signals: &[T],
+    power_table: &mut [f32],
+    accumulate: A,
+) {
+    let num_time_indices = power_table.len();
+    let num_chunks = signals.len().div_ceil(POWER_CHUNK_SIGNALS);
+    let mut partials = vec![Vec::<f32>::new(); rayon::current_num_threads().min(num_chunks)];
+    if partials.is_empty() {
+        return;
+    }
+    for group in signals.chunks(POWER_CHUNK_SIGNALS * partials.len()) {
+        let partials = &mut partials[..group.len().div_ceil(POWER_CHUNK_SIGNALS)];
+        partials
+            .par_iter_mut()
+            .zip(group.par_chunks(POWER_CHUNK_SIGNALS))
+            .for_each(|(partial, chunk)| {
+                partial.clear();
+                partial.resize(num_time_indices, 0.0);
+                accumulate(chunk, partial);
+            });
+        power_table
+            .par_chunks_mut(POWER_REDUCE_CHUNK)
+            .enumerate()
+            .for_each(|(i, out)| {
+                let offset = i * POWER_REDUCE_CHUNK;
+                for partial in partials.iter() {
+                    out.iter_mut()
+                        .zip(&partial[offset..offset + out.len()])
+                        .for_each(|(o, p)| *o += p);
+                }
+            });
+    }
+}
+
+fn accumulate_power_serial<K: PowerKernel, S: Fn(usize) -> usize>(
+    signals: &[(wellen::SignalRef, wellen::Signal)],
+    kernel: K,
+    signal_weights: &SignalWeights,
+    power_table: &mut [f32],
+    index_spans: &[Range<usize>],
+    slot_of: &S,
+) {
+    // the 1-bit signals of the chunk, grouped by weight
+    let mut bit_groups: Vec<(f32, Vec<&wellen::Signal>)> = Vec::new();
+    for (signal_ref, signal) in signals.iter() {
+        let weight = signal_weights.get(signal_ref).copied().unwrap_or(1.0);
+        if weight == 0.0 {
+            continue;
+        }
+        if is_one_bit(signal) {
+            match bit_groups
+                .iter_mut()
+                .find(|(group_weight, _)| *group_weight == weight)
+            {
+                Some((_, group)) => group.push(signal),
+                None => bit_groups.push((weight, vec![signal])),
             }
-            prev_value = Some(new_value);
+            continue;
         }
+        for_each_change_in_spans(
+            signal,
+            index_spans,
+            |value| value,
+            |time_index, prev_value, new_value| {
+                if let Some(power) = power_table.get_mut(slot_of(time_index)) {
+                    *power += weight * kernel.power(prev_value, new_value);
+                }
+            },
+        );
         // debug!("{}: {}", s.full_name(&hierarchy), signal.size_in_memory());
     }
+    for (weight, group) in bit_groups {
+        let levels = group
+            .into_iter()
+            .map(|signal| {
+                signal.iter_changes().map(|(time_index, value)| {
+                    let level = bit_level(&value).expect("All values of a 1-bit signal are 1-bit");
+                    (time_index as usize, level)
+                })
+            })
+            .collect_vec();
+        accumulate_bit_power(levels, kernel, weight, power_table, index_spans, slot_of);
+    }
+}
+
+/// Whether the values of `signal` are 1-bit. wellen stores all the values of a signal with the width of its
+/// variable, so its first value tells.
+fn is_one_bit(signal: &wellen::Signal) -> bool {
+    signal
+        .iter_changes()
+        .next()
+        .is_some_and(|(_, value)| bit_level(&value).is_some())
+}
+
+/// Number of time indices whose toggles of 1-bit signals are counted at once.
+const BIT_COUNT_BLOCK: usize = 1 << 14;
+
+/// Add the power of a group of 1-bit signals of the same `weight`, given as their `(time_index, level)` changes (see
+/// [`bit_level`]), like [`accumulate_power_serial`] does for one signal.
+///
+/// Instead of the power of each change, the changes of all signals are counted per time index, over blocks of
+/// [`BIT_COUNT_BLOCK`] time indices: the toggles between known levels, those from or to an unknown level, and the
+/// changes to `1`. The power of each time index is then added once, from its counts.
+fn accumulate_bit_power<I, K, S>(
+    signals: Vec<I>,
+    kernel: K,
+    weight: f32,
+    power_table: &mut [f32],
+    index_spans: &[Range<usize>],
+    slot_of: &S,
+) where
+    I: Iterator<Item = (usize, u8)>,
+    K: PowerKernel,
+    S: Fn(usize) -> usize,
+{
+    let Some(end) = index_spans.last().map(|span| span.end) else {
+        return;
+    };
+    // the remaining changes of each signal, its last level and the first span that can hold its next change
+    let mut walks = signals
+        .into_iter()
+        .map(|changes| (changes.peekable(), None::<u8>, 0))
+        .collect_vec();
+    let mut counts = vec![[0u32; 3]; BIT_COUNT_BLOCK.min(end)];
+    for block_start in (0..end).step_by(BIT_COUNT_BLOCK) {
+        let block_end = (block_start + BIT_COUNT_BLOCK).min(end);
+        let mut counted = false;
+        for (changes, last_level, span_cursor) in walks.iter_mut() {
+            while let Some((time_index, new_level)) =
+                changes.next_if(|&(time_index, _)| time_index < block_end)
+            {
+                // changes are in time order, so the spans that ended before this change are never needed again;
+                // the change is before the end of the last span, so there is one that ends after it
+                while index_spans[*span_cursor].end <= time_index {
+                    *span_cursor += 1;
+                }
+                if let Some(prev_level) = *last_level {
+                    if index_spans[*span_cursor].start <= time_index {
+                        let count = &mut counts[time_index - block_start];
+                        if prev_level != new_level {
+                            // count[0]: between known levels, count[1]: from or to an unknown level
+                            count[(prev_level.max(new_level) >= 2) as usize] += 1;
+                        }
+                        count[2] += (new_level == 1) as u32;
+                        counted = true;
+                    }
+                }
+                *last_level = Some(new_level);
+            }
+        }
+        if !counted {
+            continue;
+        }
+        for (offset, count) in counts[..block_end - block_start].iter_mut().enumerate() {
+            if *count != [0; 3] {
+                if let Some(power) = power_table.get_mut(slot_of(block_start + offset)) {
+                    *power += weight * kernel.transition_power(count[0], count[1], count[2]);
+                }
+                *count = [0; 3];
+            }
+        }
+    }
+}
+
+/// Call `on_change(time_index, prev_value, new_value)` for each value change of `signal` within the sorted and
+/// disjoint `index_spans` that has a previous value, with the values decoded by `decode`.
+#[inline(always)]
+fn for_each_change_in_spans<'a, T, D, C>(
+    signal: &'a wellen::Signal,
+    index_spans: &[Range<usize>],
+    decode: D,
+    mut on_change: C,
+) where
+    D: Fn(wellen::SignalValue<'a>) -> T,
+    C: FnMut(usize, &T, &T),
+{
+    let mut prev_value: Option<T> = None;
+    let mut span_cursor = 0;
+    for (time_index, new_value) in signal.iter_changes() {
+        let time_index = time_index as usize;
+        // changes are in time order, so the spans that ended before this change are never needed again
+        while span_cursor < index_spans.len() && index_spans[span_cursor].end <= time_index {
+            span_cursor += 1;
+        }
+        let Some(span) = index_spans.get(span_cursor) else {
+            // past the last span
+            break;
+        };
+        let new_value = decode(new_value);
+        if let Some(prev_value) = &prev_value {
+            if span.start <= time_index {
+                // we have a previous value, compute the power
+                on_change(time_index, prev_value, &new_value);
+            }
+        }
+        prev_value = Some(new_value);
+    }
+}
+
+/// Keep the power values at the time points selected by `filter_predicate` (if `do_filter`),
+/// merging the power of consecutive equal time points.
+pub fn filter_power_trace<F: Fn(&(&u64, f32)) -> bool>(
+    time_table: &[u64],
+    power_table: Vec<f32>,
+    filter_predicate: F,
+    do_filter: bool,
+) -> (Vec<u64>, Vec<f32>) {
     let mut leftover = 0.0;
 
     let (left, right): (Vec<u64>, Vec<f32>) = time_table
@@ -175,10 +686,30 @@ pub fn generate_power_trace<F: Fn(&(&u64, f32)) -> bool>(
         })
         .unzip(); // .collect::<Vec<_>>();
 
-    Ok((left, right))
+    (left, right)
+}
+
+pub fn generate_power_trace<F: Fn(&(&u64, f32)) -> bool>(
+    signals: &[(wellen::SignalRef, wellen::Signal)],
+    power_model: &PowerModel,
+    signal_weights: &SignalWeights,
+    time_table: &[u64],
+    filter_predicate: F,
+    //    filter_predicate: Option<fn((u64, f32)) -> bool>,
+    // filter_predicate: fn(&(&u64, f32)) -> bool,
+    do_filter: bool,
+) -> Result<(Vec<u64>, Vec<f32>), wellen::WellenError> {
+    let mut power_table = vec![0f32; time_table.len()];
+    accumulate_power(signals, power_model, signal_weights, &mut power_table);
+    Ok(filter_power_trace(
+        time_table,
+        power_table,
+        filter_predicate,
+        do_filter,
+    ))
 }
 
-/// Convert a waveform file to a power trace.
+/// Convert a waveform file to a power trace, with the default (Hamming distance) power model.
 ///  * `filename` is the path to the waveform file.
 ///  * `multi_thread` enables multi-threaded loading of the waveform and signals.
 ///  * `show_progress` enables a progress bar while loading the file.
@@ -191,6 +722,77 @@ pub fn wave_to_powertrace<F: Fn(&(&u64, f32)) -> bool, P: AsRef<Path>>(
     filter_predicate: F,
     do_filter: bool,
 ) -> Result<(Vec<u64>, Vec<f32>), wellen::WellenError> {
-    let (signals, time_table) = load_waveform(filename, multi_thread, show_progress)?;
-    generate_power_trace(&signals, &time_table, filter_predicate, do_filter)
+    let power_model = PowerModel::default();
+    let (signals, time_table, signal_weights) = load_waveform(
+        filename,
+        multi_thread,
+        show_progress,
+        &SignalSelection::all(),
+        &power_model,
+    )?;
+    generate_power_trace(
+        &signals,
+        &power_model,
+        &signal_weights,
+        &time_table,
+        filter_predicate,
+        do_filter,
+    )
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn bit_power_counts_match_the_power_of_each_change() {
+        // levels 0, 1, x (2) and z (3), with changes before, between and after the spans, and across count blocks
+        let signals: Vec<Vec<(usize, u8)>> = vec![
+            vec![
+                (0, 0),
+                (3, 1),
+                (5, 2),
+                (9, 1),
+                (12, 1),
+                (BIT_COUNT_BLOCK + 2, 0),
+            ],
+            vec![
+                (1, 3),
+                (3, 2),
+                (6, 0),
+                (9, 0),
+                (10, 1),
+                (BIT_COUNT_BLOCK + 2, 2),
+            ],
+            vec![(2, 1), (7, 0), (13, 1), (BIT_COUNT_BLOCK + 5, 3)],
+        ];
+        let index_spans = [2..8, 9..11, BIT_COUNT_BLOCK..BIT_COUNT_BLOCK + 4];
+        let slot_of = |time_index: usize| time_index / 2;
+        let power_model = PowerModel::new(
+            PowerModelKind::Mixed { hd: 1.0, hw: 0.25 },
+            XzPolicy::Half,
+            &[],
+        )
+        .unwrap();
+        with_power_kernel!(power_model, kernel => {
+            let mut expected = vec![0f32; BIT_COUNT_BLOCK];
+            for changes in &signals {
+                for (&(_, prev_level), &(time_index, new_level)) in changes.iter().tuple_windows() {
+                    if index_spans.iter().any(|span| span.contains(&time_index)) {
+                        expected[slot_of(time_index)] += 2.0 * kernel.bit_power(prev_level, new_level);
+                    }
+                }
+            }
+            let mut power_table = vec![0f32; BIT_COUNT_BLOCK];
+            accumulate_bit_power(
+                signals.iter().map(|changes| changes.iter().copied()).collect(),
+                kernel,
+                2.0,
+                &mut power_table,
+                &index_spans,
+                &slot_of,
+            );
+            assert_eq!(power_table, expected);
+        });
+    }
 }
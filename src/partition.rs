@@ -0,0 +1,134 @@
+//! Partitions of the trace labels into the two classes of a t-test.
+//!
+//! Markers carry arbitrary `u16` labels. A partition `GROUP:GROUP` puts the traces whose label is in its first
+//! group in class 0, and those whose label is in its second group in class 1. A group is a comma-separated list of
+//! labels, or `*` for all the labels that are not in the other group. Traces whose label is in neither group are left
+//! out. For example, `0:1` compares labels 0 and 1, `2:*` compares label 2 with all the others, and `0,1:2,3`
+//! compares two groups of labels. Several partitions can be tested on the same traces, each with its own
+//! accumulator.
+
+use std::str::FromStr;
+
+use itertools::Itertools;
+use ndarray::{ArrayView1, ArrayView2};
+
+use crate::ttest::{NUM_CLASSES, Ttest};
+
+#[derive(Clone, Debug, PartialEq, Eq)]
+enum LabelGroup {
+    Labels(Vec<u16>),
+    /// all the labels that are not in the other group
+    Rest,
+}
+
+impl FromStr for LabelGroup {
+    type Err = String;
+
+    fn from_str(s: &str) -> Result<Self, Self::Err> {
+        match s.trim() {
+            "*" => Ok(LabelGroup::Rest),
+            "" => Err("empty group of labels".to_string()),
+            s => s
+                .split(',')
+                .map(|label| {
+                    label
+                        .trim()
+                        .parse::<u16>()
+                        .map_err(|e| format!("invalid label '{label}': {e}"))
+                })
+                .collect::<Result<Vec<_>, _>>()
+                .map(LabelGroup::Labels),
+        }
+    }
+}
+
+impl std::fmt::Display for LabelGroup {
+    fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
+        match self {
+            LabelGroup::Labels(labels) => write!(f, "{}", labels.iter().join(",")),
+            LabelGroup::Rest => write!(f, "*"),
+        }
+    }
+}
+
+#[derive(Clone, Debug, PartialEq, Eq)]
+pub struct Partition {
+    groups: [LabelGroup; NUM_CLASSES],
+}
+
+impl FromStr for Partition {
+    type Err = String;
+
+    /// Parse `GROUP:GROUP`, e.g. `0:1`, `2:*` or `0,1:2,3`.
+    fn from_str(s: &str) -> Result<Self, Self::Err> {
+        let (group_0, group_1) = s
+            .split_once(':')
+            .ok_or_else(|| format!("expected GROUP:GROUP, found '{s}'"))?;
+        let groups = [group_0.parse()?, group_1.parse()?];
+        match &groups {
+            [LabelGroup::Rest, LabelGroup::Rest] => {
+                Err(format!("at most one group can be '*', found '{s}'"))
+            }
+            [LabelGroup::Labels(labels_0), LabelGroup::Labels(labels_1)]
+                if labels_0.iter().any(|label| labels_1.contains(label)) =>
+            {
+                Err(format!("the groups of '{s}' share labels"))
+            }
+            _ => Ok(Partition { groups }),
+        }
+    }
+}
+
+impl std::fmt::Display for Partition {
+    fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
+        write!(f, "{}:{}", self.groups[0], self.groups[1])
+    }
+}
+
+impl Partition {
+    /// The class of the traces with `label`, or `None` if they are left out.
+    pub fn class_of(&self, label: u16) -> Option<usize> {
+        self.groups
+            .iter()
+            .position(
+                |group| matches!(group, LabelGroup::Labels(labels) if labels.contains(&label)),
+            )
+            .or_else(|| {
+                self.groups
+                    .iter()
+                    .position(|group| *group == LabelGroup::Rest)
+            })
+    }
+
+    /// A name of the partition that can be used in file names, e.g. `0+1_vs_rest` for `0,1:*`.
+    pub fn file_stem(&self) -> String {
+        self.groups
+            .iter()
+            .map(|group| match group {
+                LabelGroup::Labels(labels) => labels.iter().join("+"),
+                LabelGroup::Rest => "rest".to_string(),
+            })
+            .join("_vs_")
+    }
+
+    /// The rows of the traces of each class, given the label of each trace.
+    pub fn class_rows(&self, labels: ArrayView1<u16>) -> [Vec<usize>; NUM_CLASSES] {
+        let mut rows: [Vec<usize>; NUM_CLASSES] = Default::default();
+        for (row, &label) in labels.iter().enumerate() {
+            if let Some(class) = self.class_of(label) {
+                rows[class].push(row);
+            }
+        }
+        rows
+    }
+
+    /// Accumulate the traces (one per row) of the partition, given their labels, into `ttacc`.
+    pub fn update(&self, ttacc: &mut Ttest, traces: ArrayView2<f32>, labels: ArrayView1<u16>) {
+        assert_eq!(
+            traces.nrows(),
+            labels.len(),
+            "Number of trace labels does not match number of traces"
+        );
+        ttacc.update_rows(traces, &self.class_rows(labels));
+    }
+}
@@ -0,0 +1,958 @@
+//! Population counts of byte slices, for the Hamming distance and weight of signal values.
+//!
+//! Short slices are counted inline, one `u64` word at a time. Longer ones (wide buses) go through the fastest kernel
+//! supported by the CPU, detected once at run time: AVX-512 `VPOPCNTQ`, AVX2 (nibble lookup table), the `POPCNT`
+//! instruction, or the portable word loop.
+//!
+//! Multi-state values are counted a word at a time as well, split into the transitions between known levels (`0`,
+//! `1`) and those involving an unknown one (`x`, `z`, ...):
+//!  * 4-state values packed 2 bits per digit, as by wellen (`0`, `1`, `x`, `z`),
+//!  * 9-state values packed 4 bits per digit, first mapped to 4-state digits with a lookup table,
+//!  * strings of state characters, one byte per digit, as read from FST files.
+
+use std::sync::OnceLock;
+
+#[cfg(target_arch = "x86_64")]
+use std::arch::x86_64::*;
+
+/// Slices of at most this many bytes are counted inline instead of through the detected kernel.
+const INLINE_BYTES: usize = 32;
+
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+pub enum PopcountKernel {
+    /// portable loop over `u64` words
+    Scalar,
+    /// loop over `u64` words with the `POPCNT` instruction
+    Popcnt,
+    /// 256-bit lanes, counting each nibble with a lookup table
+    Avx2,
+    /// 512-bit lanes with `VPOPCNTQ`
+    Avx512,
+}
+
+struct Kernels {
+    kind: PopcountKernel,
+    popcount: fn(&[u8]) -> u32,
+    xor_popcount: fn(&[u8], &[u8]) -> u32,
+    count_byte: fn(&[u8], u8) -> u32,
+    four_state_transitions: fn(&[u8], &[u8]) -> (u32, u32),
+    ascii_transitions: fn(&[u8], &[u8]) -> (u32, u32),
+}
+
+static KERNELS: OnceLock<Kernels> = OnceLock::new();
+
+impl PopcountKernel {
+    /// The fastest kernel supported by this CPU.
+    pub fn detect() -> Self {
+        [
+            PopcountKernel::Avx512,
+            PopcountKernel::Avx2,
+            PopcountKernel::Popcnt,
+        ]
+        .into_iter()
+        .find(|kind| kind.is_supported())
+        .unwrap_or(PopcountKernel::Scalar)
+    }
+
+    /// Whether this CPU supports the kernel.
+    pub fn is_supported(self) -> bool {
+        match self {
+            PopcountKernel::Scalar => true,
+            #[cfg(target_arch = "x86_64")]
+            PopcountKernel::Popcnt => is_x86_feature_detected!("popcnt"),
+            #[cfg(target_arch = "x86_64")]
+            PopcountKernel::Avx2 => {
+                is_x86_feature_detected!("avx2") && is_x86_feature_detected!("popcnt")
+            }
+            #[cfg(target_arch = "x86_64")]
+            PopcountKernel::Avx512 => {
+                is_x86_feature_detected!("avx512f")
+                    && is_x86_feature_detected!("avx512vpopcntdq")
+                    && is_x86_feature_detected!("popcnt")
+            }
+            #[cfg(not(target_arch = "x86_64"))]
+            _ => false,
+        }
+    }
+
+    /// The kernel used for long slices.
+    pub fn current() -> Self {
+        kernels().kind
+    }
+}
+
+fn kernels() -> &'static Kernels {
+    KERNELS.get_or_init(|| {
+        let kind = PopcountKernel::detect();
+        log::debug!("Using the {kind:?} popcount kernel");
+        // Safety: the detected kernel is supported.
+        unsafe { Kernels::new(kind) }
+    })
+}
+
+impl Kernels {
+    /// The functions of the kernel `kind`.
+    ///
+    /// Safety: the CPU must support the kernel (see [`PopcountKernel::is_supported`]).
+    unsafe fn new(kind: PopcountKernel) -> Self {
+        match kind {
+            PopcountKernel::Scalar => Kernels {
+                kind,
+                popcount: popcount_words,
+                xor_popcount: xor_popcount_words,
+                count_byte: count_byte_words,
+                four_state_transitions: four_state_transitions_words,
+                ascii_transitions: ascii_transitions_words,
+            },
+            #[cfg(target_arch = "x86_64")]
+            PopcountKernel::Popcnt => Kernels {
+                kind,
+                // Safety: the CPU supports the target features of the kernel.
+                popcount: |data| unsafe { popcnt::popcount(data) },
+                xor_popcount: |a, b| unsafe { popcnt::xor_popcount(a, b) },
+                count_byte: |data, byte| unsafe { popcnt::count_byte(data, byte) },
+                four_state_transitions: |a, b| unsafe { popcnt::four_state_transitions(a, b) },
+                ascii_transitions: |a, b| unsafe { popcnt::ascii_transitions(a, b) },
+            },
+            #[cfg(target_arch = "x86_64")]
+            PopcountKernel::Avx2 => Kernels {
+                kind,
+                popcount: |data| unsafe { avx2::popcount(data) },
+                xor_popcount: |a, b| unsafe { avx2::xor_popcount(a, b) },
+                count_byte: |data, byte| unsafe { avx2::count_byte(data, byte) },
+                four_state_transitions: |a, b| unsafe { avx2::four_state_transitions(a, b) },
+                ascii_transitions: |a, b| unsafe { avx2::ascii_transitions(a, b) },
+            },
+            #[cfg(target_arch = "x86_64")]
+            PopcountKernel::Avx512 => Kernels {
+                kind,
+                popcount: |data| unsafe { avx512::popcount(data) },
+                xor_popcount: |a, b| unsafe { avx512::xor_popcount(a, b) },
+                count_byte: |data, byte| unsafe { avx2::count_byte(data, byte) },
+                four_state_transitions: |a, b| unsafe { avx512::four_state_transitions(a, b) },
+                ascii_transitions: |a, b| unsafe { avx2::ascii_transitions(a, b) },
+            },
+            #[cfg(not(target_arch = "x86_64"))]
+            _ => unreachable!(),
+        }
+    }
+}
+
+/// Number of bits set in `data`.
+#[inline(always)]
+pub fn popcount(data: &[u8]) -> u32 {
+    if data.len() <= INLINE_BYTES {
+        popcount_words(data)
+    } else {
+        (kernels().popcount)(data)
+    }
+}
+
+/// Number of bits that differ between `a` and `b`, over the length of the shorter one.
+#[inline(always)]
+pub fn xor_popcount(a: &[u8], b: &[u8]) -> u32 {
+    if a.len().min(b.len()) <= INLINE_BYTES {
+        xor_popcount_words(a, b)
+    } else {
+        (kernels().xor_popcount)(a, b)
+    }
+}
+
+/// Number of bytes of `data` equal to `byte`.
+#[inline(always)]
+pub fn count_byte(data: &[u8], byte: u8) -> u32 {
+    if data.len() <= INLINE_BYTES {
+        count_byte_words(data, byte)
+    } else {
+        (kernels().count_byte)(data, byte)
+    }
+}
+
+/// Number of digits of the 4-state values `a` and `b` (2 bits per digit) that differ, as (between known levels,
+/// involving an unknown level), over the length of the shorter one.
+#[inline(always)]
+pub fn four_state_transitions(a: &[u8], b: &[u8]) -> (u32, u32) {
+    if a.len().min(b.len()) <= INLINE_BYTES {
+        four_state_transitions_words(a, b)
+    } else {
+        (kernels().four_state_transitions)(a, b)
+    }
+}
+
+/// Number of digits of the 4-state value `data` (2 bits per digit) that are `1`.
+#[inline(always)]
+pub fn four_state_ones(data: &[u8]) -> u32 {
+    let mut words = data.chunks_exact(8);
+    let mut count = 0;
+    for word in &mut words {
+        count += four_state_word_ones(load_word(word));
+    }
+    count
+        + words
+            .remainder()
+            .iter()
+            .map(|&byte| four_state_word_ones(byte as u64))
+            .sum::<u32>()
+}
+
+/// Like [`four_state_transitions`], for 9-state values (4 bits per digit).
+#[inline(always)]
+pub fn nine_state_transitions(a: &[u8], b: &[u8]) -> (u32, u32) {
+    let len = a.len().min(b.len());
+    let mut a_words = a[..len].chunks_exact(16);
+    let mut b_words = b[..len].chunks_exact(16);
+    let (mut known, mut unknown) = (0, 0);
+    for (a_word, b_word) in (&mut a_words).zip(&mut b_words) {
+        let (k, u) = four_state_word_transitions(nine_to_four(a_word), nine_to_four(b_word));
+        known += k;
+        unknown += u;
+    }
+    let (k, u) = four_state_word_transitions(
+        nine_to_four(a_words.remainder()),
+        nine_to_four(b_words.remainder()),
+    );
+    (known + k, unknown + u)
+}
+
+/// Number of digits of the 9-state value `data` (4 bits per digit) that are `1` or `h`.
+#[inline(always)]
+pub fn nine_state_ones(data: &[u8]) -> u32 {
+    data.chunks(16)
+        .map(|word| four_state_word_ones(nine_to_four(word)))
+        .sum()
+}
+
+/// The value `data` of `digits` digits packed `from_bits` bits per digit, repacked `to_bits` bits per digit, as by
+/// wellen: the most significant digits first, the last digit in the lowest bits of the last byte. The binary digits
+/// and the 4-state digits are the first codes of the 4-state and 9-state digits respectively, so that a narrower value
+/// can be compared with a wider one.
+pub fn widen_digits(data: &[u8], digits: u32, from_bits: u32, to_bits: u32) -> Vec<u8> {
+    let (digits, from_bits, to_bits) = (digits as usize, from_bits as usize, to_bits as usize);
+    debug_assert!(from_bits <= to_bits && data.len() * 8 >= digits * from_bits);
+    let mut widened = vec![0u8; (digits * to_bits).div_ceil(8)];
+    let widened_len = widened.len();
+    for i in 0..digits {
+        let digit = (data[data.len() - 1 - i * from_bits / 8] >> (i * from_bits % 8))
+            & ((1 << from_bits) - 1);
+        widened[widened_len - 1 - i * to_bits / 8] |= digit << (i * to_bits % 8);
+    }
+    widened
+}
+
+/// Number of digits of the strings of state characters `a` and `b` that differ, as (between known levels,
+/// involving an unknown level), over the length of the shorter one. `l` and `h` are the known levels `0` and `1`.
+#[inline(always)]
+pub fn ascii_transitions(a: &[u8], b: &[u8]) -> (u32, u32) {
+    if a.len().min(b.len()) <= INLINE_BYTES {
+        ascii_transitions_words(a, b)
+    } else {
+        (kernels().ascii_transitions)(a, b)
+    }
+}
+
+/// Number of digits of the string of state characters `data` that are `1` or `h`.
+#[inline(always)]
+pub fn ascii_ones(data: &[u8]) -> u32 {
+    let mut words = data.chunks_exact(8);
+    let mut count = 0;
+    for word in &mut words {
+        let word = load_word(word);
+        count += if is_binary_ascii(word) {
+            (word & ASCII_LSB).count_ones()
+        } else {
+            word.to_ne_bytes()
+                .iter()
+                .filter(|&&c| ascii_level(c) == 1)
+                .count() as u32
+        };
+    }
+    count
+        + words
+            .remainder()
+            .iter()
+            .filter(|&&c| ascii_level(c) == 1)
+            .count() as u32
+}
+
+/// The level of a state character: `0` and `1` for the known levels (including the weak `l` and `h`), and a
+/// distinct code of at least `2` for each unknown one.
+#[inline(always)]
+pub fn ascii_level(c: u8) -> u8 {
+    match c {
+        b'0' | b'l' | b'L' => 0,
+        b'1' | b'h' | b'H' => 1,
+        b'x' | b'X' => 2,
+        b'z' | b'Z' => 3,
+        c => c.max(4),
+    }
+}
+
+/// The 4-state level of each 9-state digit (`0`, `1`, `x`, `z`, `h`, `u`, `w`, `l`, `-`), where the weak `h` and
+/// `l` are known levels.
+pub const NINE_STATE_LEVELS: [u8; 16] = [0, 1, 2, 3, 1, 2, 2, 0, 2, 2, 2, 2, 2, 2, 2, 2];
+
+/// The two 4-state digits of each byte of two 9-state digits.
+const NINE_TO_FOUR: [u8; 256] = {
+    let mut table = [0u8; 256];
+    let mut byte = 0;
+    while byte < 256 {
+        table[byte] = (NINE_STATE_LEVELS[byte >> 4] << 2) | NINE_STATE_LEVELS[byte & 0xf];
+        byte += 1;
+    }
+    table
+};
+
+/// Bits of the low (level) half of each 2-bit digit.
+const FOUR_STATE_LOW: u64 = 0x5555_5555_5555_5555;
+
+/// Bytes of `'0'` and `'1'` characters differ only in their least significant bit.
+const ASCII_LSB: u64 = 0x0101_0101_0101_0101;
+
+/// Up to 16 bytes of 9-state digits, as a word of 4-state digits.
+#[inline(always)]
+fn nine_to_four(bytes: &[u8]) -> u64 {
+    bytes.iter().enumerate().fold(0, |word, (i, &byte)| {
+        word | (NINE_TO_FOUR[byte as usize] as u64) << (4 * i)
+    })
+}
+
+#[inline(always)]
+fn four_state_word_transitions(a: u64, b: u64) -> (u32, u32) {
+    let diff = a ^ b;
+    let changed = (diff | diff >> 1) & FOUR_STATE_LOW;
+    // the high bit of a digit is set for `x` and `z`
+    let unknown = ((a | b) >> 1) & FOUR_STATE_LOW;
+    (
+        (changed & !unknown).count_ones(),
+        (changed & unknown).count_ones(),
+    )
+}
+
+#[inline(always)]
+fn four_state_word_ones(a: u64) -> u32 {
+    (a & !(a >> 1) & FOUR_STATE_LOW).count_ones()
+}
+
+/// Whether all the bytes of the word are `'0'` or `'1'`.
+#[inline(always)]
+fn is_binary_ascii(word: u64) -> bool {
+    word & !ASCII_LSB == 0x3030_3030_3030_3030
+}
+
+#[inline(always)]
+fn ascii_byte_transitions(a: &[u8], b: &[u8]) -> (u32, u32) {
+    a.iter()
+        .zip(b)
+        .map(|(&a, &b)| (ascii_level(a), ascii_level(b)))
+        .filter(|(a, b)| a != b)
+        .fold((0, 0), |(known, unknown), (a, b)| {
+            if a.max(b) >= 2 {
+                (known, unknown + 1)
+            } else {
+                (known + 1, unknown)
+            }
+        })
+}
+
+#[inline(always)]
+fn ascii_transitions_words(a: &[u8], b: &[u8]) -> (u32, u32) {
+    let len = a.len().min(b.len());
+    let mut a_words = a[..len].chunks_exact(8);
+    let mut b_words = b[..len].chunks_exact(8);
+    let (mut known, mut unknown) = (0, 0);
+    for (a_word, b_word) in (&mut a_words).zip(&mut b_words) {
+        let (a_word, b_word) = (load_word(a_word), load_word(b_word));
+        if is_binary_ascii(a_word) && is_binary_ascii(b_word) {
+            known += (a_word ^ b_word).count_ones();
+        } else {
+            let (k, u) = ascii_byte_transitions(&a_word.to_ne_bytes(), &b_word.to_ne_bytes());
+            known += k;
+            unknown += u;
+        }
+    }
+    let (k, u) = ascii_byte_transitions(a_words.remainder(), b_words.remainder());
+    (known + k, unknown + u)
+}
+
+#[inline(always)]
+fn four_state_transitions_words(a: &[u8], b: &[u8]) -> (u32, u32) {
+    let len = a.len().min(b.len());
+    let mut a_words = a[..len].chunks_exact(8);
+    let mut b_words = b[..len].chunks_exact(8);
+    let (mut known, mut unknown) = (0, 0);
+    for (a_word, b_word) in (&mut a_words).zip(&mut b_words) {
+        let (k, u) = four_state_word_transitions(load_word(a_word), load_word(b_word));
+        known += k;
+        unknown += u;
+    }
+    for (&a, &b) in a_words.remainder().iter().zip(b_words.remainder()) {
+        let (k, u) = four_state_word_transitions(a as u64, b as u64);
+        known += k;
+        unknown += u;
+    }
+    (known, unknown)
+}
+
+#[inline(always)]
+fn load_word(bytes: &[u8]) -> u64 {
+    u64::from_ne_bytes(bytes.try_into().unwrap())
+}
+
+#[inline(always)]
+fn popcount_words(data: &[u8]) -> u32 {
+    let mut words = data.chunks_exact(8);
+    let mut count = 0;
+    for word in &mut words {
+        count += load_word(word).count_ones();
+    }
+    count
+        + words
+            .remainder()
+            .iter()
+            .map(|byte| byte.count_ones())
+            .sum::<u32>()
+}
+
+#[inline(always)]
+fn xor_popcount_words(a: &[u8], b: &[u8]) -> u32 {
+    let len = a.len().min(b.len());
+    let (a, b) = (&a[..len], &b[..len]);
+    let mut a_words = a.chunks_exact(8);
+    let mut b_words = b.chunks_exact(8);
+    let mut count = 0;
+    for (a_word, b_word) in (&mut a_words).zip(&mut b_words) {
+        count += (load_word(a_word) ^ load_word(b_word)).count_ones();
+    }
+    count
+        + a_words
+            .remainder()
+            .iter()
+            .zip(b_words.remainder())
+            .map(|(a, b)| (a ^ b).count_ones())
+            .sum::<u32>()
+}
+
+#[inline(always)]
+fn count_byte_words(data: &[u8], byte: u8) -> u32 {
+    const LOW_7: u64 = 0x7f7f_7f7f_7f7f_7f7f;
+    const HIGH: u64 = 0x8080_8080_8080_8080;
+    let pattern = u64::from_ne_bytes([byte; 8]);
+    let mut words = data.chunks_exact(8);
+    let mut count = 0;
+    for word in &mut words {
+        let x = load_word(word) ^ pattern;
+        // the high bit of each byte is set iff the byte is not zero, i.e. differs from `byte`
+        let nonzero = (((x & LOW_7) + LOW_7) | x) & HIGH;
+        count += 8 - nonzero.count_ones();
+    }
+    count + words.remainder().iter().filter(|&&b| b == byte).count() as u32
+}
+
+#[cfg(target_arch = "x86_64")]
+mod popcnt {
+    #[target_feature(enable = "popcnt")]
+    pub(super) unsafe fn popcount(data: &[u8]) -> u32 {
+        super::popcount_words(data)
+    }
+
+    #[target_feature(enable = "popcnt")]
+    pub(super) unsafe fn xor_popcount(a: &[u8], b: &[u8]) -> u32 {
+        super::xor_popcount_words(a, b)
+    }
+
+    #[target_feature(enable = "popcnt")]
+    pub(super) unsafe fn count_byte(data: &[u8], byte: u8) -> u32 {
+        super::count_byte_words(data, byte)
+    }
+
+    #[target_feature(enable = "popcnt")]
+    pub(super) unsafe fn four_state_transitions(a: &[u8], b: &[u8]) -> (u32, u32) {
+        super::four_state_transitions_words(a, b)
+    }
+
+    #[target_feature(enable = "popcnt")]
+    pub(super) unsafe fn ascii_transitions(a: &[u8], b: &[u8]) -> (u32, u32) {
+        super::ascii_transitions_words(a, b)
+    }
+}
+
+#[cfg(target_arch = "x86_64")]
+mod avx2 {
+    use super::*;
+
+    /// Number of bits set in each byte of `v`, summed into its four 64-bit lanes.
+    #[inline]
+    #[target_feature(enable = "avx2")]
+    fn popcount_lanes(v: __m256i) -> __m256i {
+        let lookup = _mm256_setr_epi8(
+            0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4, //
+            0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4,
+        );
+        let low_nibbles = _mm256_set1_epi8(0x0f);
+        let low = _mm256_and_si256(v, low_nibbles);
+        let high = _mm256_and_si256(_mm256_srli_epi16(v, 4), low_nibbles);
+        let counts = _mm256_add_epi8(
+            _mm256_shuffle_epi8(lookup, low),
+            _mm256_shuffle_epi8(lookup, high),
+        );
+        _mm256_sad_epu8(counts, _mm256_setzero_si256())
+    }
+
+    #[inline]
+    #[target_feature(enable = "avx2")]
+    fn sum_lanes(v: __m256i) -> u32 {
+        let sum = _mm_add_epi64(_mm256_castsi256_si128(v), _mm256_extracti128_si256(v, 1));
+        (_mm_cvtsi128_si64(sum) + _mm_extract_epi64(sum, 1)) as u32
+    }
+
+    #[inline]
+    #[target_feature(enable = "avx2")]
+    fn load(bytes: &[u8]) -> __m256i {
+        debug_assert_eq!(bytes.len(), 32);
+        // Safety: `bytes` holds 32 bytes, and the load is unaligned.
+        unsafe { _mm256_loadu_si256(bytes.as_ptr() as *const __m256i) }
+    }
+
+    #[target_feature(enable = "avx2,popcnt")]
+    pub(super) unsafe fn popcount(data: &[u8]) -> u32 {
+        let mut blocks = data.chunks_exact(32);
+        let mut acc = _mm256_setzero_si256();
+        for block in &mut blocks {
+            acc = _mm256_add_epi64(acc, popcount_lanes(load(block)));
+        }
+        sum_lanes(acc) + super::popcount_words(blocks.remainder())
+    }
+
+    #[target_feature(enable = "avx2,popcnt")]
+    pub(super) unsafe fn xor_popcount(a: &[u8], b: &[u8]) -> u32 {
+        let len = a.len().min(b.len());
+        let mut a_blocks = a[..len].chunks_exact(32);
+        let mut b_blocks = b[..len].chunks_exact(32);
+        let mut acc = _mm256_setzero_si256();
+        for (a_block, b_block) in (&mut a_blocks).zip(&mut b_blocks) {
+            let x = _mm256_xor_si256(load(a_block), load(b_block));
+            acc = _mm256_add_epi64(acc, popcount_lanes(x));
+        }
+        sum_lanes(acc) + super::xor_popcount_words(a_blocks.remainder(), b_blocks.remainder())
+    }
+
+    #[target_feature(enable = "avx2,popcnt")]
+    pub(super) unsafe fn count_byte(data: &[u8], byte: u8) -> u32 {
+        let pattern = _mm256_set1_epi8(byte as i8);
+        let mut blocks = data.chunks_exact(32);
+        let mut count = 0;
+        for block in &mut blocks {
+            let equal = _mm256_cmpeq_epi8(load(block), pattern);
+            count += (_mm256_movemask_epi8(equal) as u32).count_ones();
+        }
+        count + super::count_byte_words(blocks.remainder(), byte)
+    }
+
+    #[target_feature(enable = "avx2,popcnt")]
+    pub(super) unsafe fn four_state_transitions(a: &[u8], b: &[u8]) -> (u32, u32) {
+        let len = a.len().min(b.len());
+        let mut a_blocks = a[..len].chunks_exact(32);
+        let mut b_blocks = b[..len].chunks_exact(32);
+        let low = _mm256_set1_epi64x(FOUR_STATE_LOW as i64);
+        let (mut known, mut unknown) = (_mm256_setzero_si256(), _mm256_setzero_si256());
+        for (a_block, b_block) in (&mut a_blocks).zip(&mut b_blocks) {
+            let (a, b) = (load(a_block), load(b_block));
+            let diff = _mm256_xor_si256(a, b);
+            let changed = _mm256_and_si256(_mm256_or_si256(diff, _mm256_srli_epi64(diff, 1)), low);
+            let unknowns = _mm256_and_si256(_mm256_srli_epi64(_mm256_or_si256(a, b), 1), low);
+            known = _mm256_add_epi64(
+                known,
+                popcount_lanes(_mm256_andnot_si256(unknowns, changed)),
+            );
+            unknown =
+                _mm256_add_epi64(unknown, popcount_lanes(_mm256_and_si256(changed, unknowns)));
+        }
+        let (k, u) =
+            super::four_state_transitions_words(a_blocks.remainder(), b_blocks.remainder());
+        (sum_lanes(known) + k, sum_lanes(unknown) + u)
+    }
+
+    #[target_feature(enable = "avx2,popcnt")]
+    pub(super) unsafe fn ascii_transitions(a: &[u8], b: &[u8]) -> (u32, u32) {
+        let len = a.len().min(b.len());
+        let mut a_blocks = a[..len].chunks_exact(32);
+        let mut b_blocks = b[..len].chunks_exact(32);
+        let not_lsb = _mm256_set1_epi8(!ASCII_LSB as i8);
+        let zero_chars = _mm256_set1_epi8(b'0' as i8);
+        let mut acc = _mm256_setzero_si256();
+        let (mut known, mut unknown) = (0, 0);
+        for (a_block, b_block) in (&mut a_blocks).zip(&mut b_blocks) {
+            let (a, b) = (load(a_block), load(b_block));
+            // all the characters are '0' or '1', so that each differing character differs by a single bit
+            let binary =
+                _mm256_cmpeq_epi8(_mm256_and_si256(_mm256_or_si256(a, b), not_lsb), zero_chars);
+            if _mm256_movemask_epi8(binary) == -1 {
+                acc = _mm256_add_epi64(acc, popcount_lanes(_mm256_xor_si256(a, b)));
+            } else {
+                let (k, u) = super::ascii_byte_transitions(a_block, b_block);
+                known += k;
+                unknown += u;
+            }
+        }
+        let (k, u) = super::ascii_transitions_words(a_blocks.remainder(), b_blocks.remainder());
+        (sum_lanes(acc) + known + k, unknown + u)
+    }
+}
+
+#[cfg(target_arch = "x86_64")]
+mod avx512 {
+    use super::*;
+
+    #[inline]
+    #[target_feature(enable = "avx512f")]
+    fn load(bytes: &[u8]) -> __m512i {
+        debug_assert_eq!(bytes.len(), 64);
+        // Safety: `bytes` holds 64 bytes, and the load is unaligned.
+        unsafe { _mm512_loadu_si512(bytes.as_ptr() as *const __m512i) }
+    }
+
+    #[target_feature(enable = "avx512f,avx512vpopcntdq,popcnt")]
+    pub(super) unsafe fn popcount(data: &[u8]) -> u32 {
+        let mut blocks = data.chunks_exact(64);
+        let mut acc = _mm512_setzero_si512();
+        for block in &mut blocks {
+            acc = _mm512_add_epi64(acc, _mm512_popcnt_epi64(load(block)));
+        }
+        _mm512_reduce_add_epi64(acc) as u32 + super::popcount_words(blocks.remainder())
+    }
+
+    #[target_feature(enable = "avx512f,avx512vpopcntdq,popcnt")]
+    pub(super) unsafe fn xor_popcount(a: &[u8], b: &[u8]) -> u32 {
+        let len = a.len().min(b.len());
+        let mut a_blocks = a[..len].chunks_exact(64);
+        let mut b_blocks = b[..len].chunks_exact(64);
+        let mut acc = _mm512_setzero_si512();
+        for (a_block, b_block) in (&mut a_blocks).zip(&mut b_blocks) {
+            let x = _mm512_xor_si512(load(a_block), load(b_block));
+            acc = _mm512_add_epi64(acc, _mm512_popcnt_epi64(x));
+        }
+        _mm512_reduce_add_epi64(acc) as u32
+            + super::xor_popcount_words(a_blocks.remainder(), b_blocks.remainder())
+    }
+
+    #[target_feature(enable = "avx512f,avx512vpopcntdq,popcnt")]
+    pub(super) unsafe fn four_state_transitions(a: &[u8], b: &[u8]) -> (u32, u32) {
+        let len = a.len().min(b.len());
+        let mut a_blocks = a[..len].chunks_exact(64);
+        let mut b_blocks = b[..len].chunks_exact(64);
+        let low = _mm512_set1_epi64(FOUR_STATE_LOW as i64);
+        let (mut known, mut unknown) = (_mm512_setzero_si512(), _mm512_setzero_si512());
+        for (a_block, b_block) in (&mut a_blocks).zip(&mut b_blocks) {
+            let (a, b) = (load(a_block), load(b_block));
+            let diff = _mm512_xor_si512(a, b);
+            let changed = _mm512_and_si512(_mm512_or_si512(diff, _mm512_srli_epi64(diff, 1)), low);
+            let unknowns = _mm512_and_si512(_mm512_srli_epi64(_mm512_or_si512(a, b), 1), low);
+            known = _mm512_add_epi64(
+                known,
+                _mm512_popcnt_epi64(_mm512_andnot_si512(unknowns, changed)),
+            );
+            unknown = _mm512_add_epi64(
+                unknown,
+                _mm512_popcnt_epi64(_mm512_and_si512(changed, unknowns)),
+            );
+        }
+        let (k, u) =
+            super::four_state_transitions_words(a_blocks.remainder(), b_blocks.remainder());
+        (
+            _mm512_reduce_add_epi64(known) as u32 + k,
+            _mm512_reduce_add_epi64(unknown) as u32 + u,
+        )
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    /// Lengths around the word and vector widths.
+    const LENGTHS: [usize; 14] = [0, 1, 7, 8, 9, 31, 32, 33, 63, 64, 65, 100, 129, 1000];
+
+    /// Deterministic pseudo-random bytes (xorshift).
+    fn test_bytes(len: usize, seed: u64) -> Vec<u8> {
+        let mut state = seed.wrapping_mul(0x9e37_79b9_7f4a_7c15) | 1;
+        (0..len)
+            .map(|_| {
+                state ^= state << 13;
+                state ^= state >> 7;
+                state ^= state << 17;
+                (state >> 32) as u8
+            })
+            .collect()
+    }
+
+    /// Strings of state characters, mostly `0` and `1`, with a few unknown and weak ones when `mixed`.
+    fn test_chars(len: usize, seed: u64, mixed: bool) -> Vec<u8> {
+        test_bytes(len, seed)
+            .into_iter()
+            .map(|byte| match byte {
+                0..=5 if mixed => b"xzhlXZ"[byte as usize],
+                byte => b'0' + (byte & 1),
+            })
+            .collect()
+    }
+
+    /// The kernels supported by this CPU, including the scalar one.
+    fn supported_kernels() -> Vec<Kernels> {
+        [
+            PopcountKernel::Scalar,
+            PopcountKernel::Popcnt,
+            PopcountKernel::Avx2,
+            PopcountKernel::Avx512,
+        ]
+        .into_iter()
+        .filter(|kind| kind.is_supported())
+        // Safety: the kernel is supported.
+        .map(|kind| unsafe { Kernels::new(kind) })
+        .collect()
+    }
+
+    #[test]
+    fn popcount_kernels_match_scalar() {
+        for kernels in supported_kernels() {
+            for len in LENGTHS {
+                let data = test_bytes(len + 1, len as u64);
+                // also from an unaligned start
+                for data in [&data[..len], &data[1..]] {
+                    assert_eq!(
+                        (kernels.popcount)(data),
+                        popcount_words(data),
+                        "{:?}, {} bytes",
+                        kernels.kind,
+                        data.len()
+                    );
+                }
+            }
+        }
+    }
+
+    #[test]
+    fn xor_popcount_kernels_match_scalar() {
+        for kernels in supported_kernels() {
+            for len in LENGTHS {
+                let a = test_bytes(len + 1, 2 * len as u64);
+                let b = test_bytes(len + 3, 2 * len as u64 + 1);
+                for (a, b) in [
+                    (&a[..len], &b[..len]),
+                    (&a[1..], &b[..len]),
+                    (&a[..], &b[..]),
+                ] {
+                    assert_eq!(
+                        (kernels.xor_popcount)(a, b),
+                        xor_popcount_words(a, b),
+                        "{:?}, {} and {} bytes",
+                        kernels.kind,
+                        a.len(),
+                        b.len()
+                    );
+                }
+                assert_eq!((kernels.xor_popcount)(&a, &a), 0);
+            }
+        }
+    }
+
+    #[test]
+    fn count_byte_kernels_match_scalar() {
+        for kernels in supported_kernels() {
+            for len in LENGTHS {
+                // few distinct bytes, so that each of them occurs
+                let data: Vec<u8> = test_bytes(len, len as u64)
+                    .into_iter()
+                    .map(|byte| byte % 4)
+                    .collect();
+                for byte in 0..5 {
+                    let expected = data.iter().filter(|&&b| b == byte).count() as u32;
+                    assert_eq!(count_byte_words(&data, byte), expected);
+                    assert_eq!(
+                        (kernels.count_byte)(&data, byte),
+                        expected,
+                        "{:?}, {len} bytes",
+                        kernels.kind
+                    );
+                }
+            }
+        }
+    }
+
+    #[test]
+    fn four_state_transitions_kernels_match_scalar() {
+        for kernels in supported_kernels() {
+            for len in LENGTHS {
+                let a = test_bytes(len, 3 * len as u64);
+                let b = test_bytes(len + 5, 3 * len as u64 + 1);
+                assert_eq!(
+                    (kernels.four_state_transitions)(&a, &b),
+                    four_state_transitions_words(&a, &b),
+                    "{:?}, {len} bytes",
+                    kernels.kind
+                );
+            }
+        }
+    }
+
+    #[test]
+    fn ascii_transitions_kernels_match_scalar() {
+        for kernels in supported_kernels() {
+            for len in LENGTHS {
+                for mixed in [false, true] {
+                    let a = test_chars(len, 5 * len as u64, mixed);
+                    let b = test_chars(len, 5 * len as u64 + 1, mixed);
+                    assert_eq!(
+                        (kernels.ascii_transitions)(&a, &b),
+                        ascii_transitions_words(&a, &b),
+                        "{:?}, {len} bytes",
+                        kernels.kind
+                    );
+                }
+            }
+        }
+    }
+
+    /// Pack the digits (most significant first) `bits_per_digit` bits per digit, as by wellen.
+    fn pack(digits: &[u8], bits_per_digit: usize) -> Vec<u8> {
+        let mut packed = vec![0u8; (digits.len() * bits_per_digit).div_ceil(8)];
+        let packed_len = packed.len();
+        for (i, &digit) in digits.iter().rev().enumerate() {
+            packed[packed_len - 1 - i * bits_per_digit / 8] |= digit << (i * bits_per_digit % 8);
+        }
+        packed
+    }
+
+    /// Deterministic digits with `num_codes` distinct codes.
+    fn test_digits(len: usize, seed: u64, num_codes: u8) -> Vec<u8> {
+        test_bytes(len, seed)
+            .into_iter()
+            .map(|byte| byte % num_codes)
+            .collect()
+    }
+
+    /// The transitions between the digit levels, one digit at a time.
+    fn reference_transitions(a_levels: &[u8], b_levels: &[u8]) -> (u32, u32) {
+        let (mut known, mut unknown) = (0, 0);
+        for (&a, &b) in a_levels.iter().zip(b_levels) {
+            if a == b {
+                continue;
+            }
+            if a < 2 && b < 2 {
+                known += 1;
+            } else {
+                unknown += 1;
+            }
+        }
+        (known, unknown)
+    }
+
+    #[test]
+    fn four_state_transitions_match_reference() {
+        for kernels in supported_kernels() {
+            for len in LENGTHS {
+                let num_digits = 4 * len;
+                // mostly known digits, to have transitions of both kinds
+                let a: Vec<u8> = test_digits(num_digits, 7 * len as u64, 3)
+                    .into_iter()
+                    .map(|d| if d == 2 { 3 } else { d })
+                    .collect();
+                let b = test_digits(num_digits, 7 * len as u64 + 1, 4);
+                let expected = reference_transitions(&a, &b);
+                let (a, b) = (pack(&a, 2), pack(&b, 2));
+                assert_eq!(four_state_transitions_words(&a, &b), expected);
+                assert_eq!(
+                    (kernels.four_state_transitions)(&a, &b),
+                    expected,
+                    "{:?}, {num_digits} digits",
+                    kernels.kind
+                );
+            }
+        }
+    }
+
+    #[test]
+    fn four_state_ones_matches_reference() {
+        for len in LENGTHS {
+            let digits = test_digits(4 * len, len as u64, 4);
+            let expected = digits.iter().filter(|&&d| d == 1).count() as u32;
+            assert_eq!(four_state_ones(&pack(&digits, 2)), expected);
+        }
+    }
+
+    #[test]
+    fn nine_state_transitions_match_reference() {
+        for len in LENGTHS {
+            // an odd number of digits, so that the first byte is padded
+            let num_digits = (2 * len).saturating_sub(1);
+            let a = test_digits(num_digits, 11 * len as u64, 9);
+            let b = test_digits(num_digits, 11 * len as u64 + 1, 9);
+            let levels = |digits: &[u8]| -> Vec<u8> {
+                digits
+                    .iter()
+                    .map(|&d| NINE_STATE_LEVELS[d as usize])
+                    .collect()
+            };
+            let expected = reference_transitions(&levels(&a), &levels(&b));
+            assert_eq!(
+                nine_state_transitions(&pack(&a, 4), &pack(&b, 4)),
+                expected,
+                "{num_digits} digits"
+            );
+            let ones = levels(&a).iter().filter(|&&level| level == 1).count() as u32;
+            assert_eq!(nine_state_ones(&pack(&a, 4)), ones);
+        }
+    }
+
+    #[test]
+    fn ascii_transitions_match_reference() {
+        for kernels in supported_kernels() {
+            for len in LENGTHS {
+                for mixed in [false, true] {
+                    let a = test_chars(len, 13 * len as u64, mixed);
+                    let b = test_chars(len, 13 * len as u64 + 1, mixed);
+                    let levels = |chars: &[u8]| -> Vec<u8> {
+                        chars.iter().map(|&c| ascii_level(c)).collect()
+                    };
+                    let expected = reference_transitions(&levels(&a), &levels(&b));
+                    assert_eq!(
+                        (kernels.ascii_transitions)(&a, &b),
+                        expected,
+                        "{:?}, {len} characters",
+                        kernels.kind
+                    );
+                    assert_eq!(
+                        ascii_ones(&a),
+                        levels(&a).iter().filter(|&&level| level == 1).count() as u32
+                    );
+                }
+            }
+        }
+    }
+
+    #[test]
+    fn widen_digits_matches_wider_packing() {
+        for num_digits in [1, 3, 4, 5, 8, 9, 17, 64, 65, 130] {
+            let binary = test_digits(num_digits, num_digits as u64, 2);
+            let four_state = test_digits(num_digits, num_digits as u64 + 1, 4);
+            let n = num_digits as u32;
+            assert_eq!(widen_digits(&pack(&binary, 1), n, 1, 2), pack(&binary, 2));
+            assert_eq!(widen_digits(&pack(&binary, 1), n, 1, 4), pack(&binary, 4));
+            assert_eq!(
+                widen_digits(&pack(&four_state, 2), n, 2, 4),
+                pack(&four_state, 4)
+            );
+            assert_eq!(
+                widen_digits(&pack(&four_state, 2), n, 2, 2),
+                pack(&four_state, 2)
+            );
+            // a binary value against a 4-state one
+            assert_eq!(
+                four_state_transitions(
+                    &widen_digits(&pack(&binary, 1), n, 1, 2),
+                    &pack(&four_state, 2)
+                ),
+                reference_transitions(&binary, &four_state)
+            );
+        }
+    }
+}
@@ -1,15 +1,319 @@
+//! Power models, mapping each value change of a signal to its contribution to the power trace.
+//!
+//! A [`PowerModel`] combines the model of a single change ([`PowerModelKind`]) with optional per-signal weights,
+//! matched by full hierarchical name like the patterns of [`crate::SignalSelection`]. The loops over the value
+//! changes are specialized for each kind through a [`PowerKernel`] (see [`with_power_kernel`]), so that the model
+//! is dispatched once per batch of signals instead of once per value change.
+//!
+//! Transitions of multi-state values are split into those between the known levels `0` and `1`, and those involving
+//! an unknown level (`x`, `z`, ...), which are weighted according to an [`XzPolicy`].
+
+use std::str::FromStr;
+
+use globset::GlobSet;
+use rustc_hash::FxHashMap;
+
+use crate::popcount;
+use crate::signal_selection::{build_glob_set, scope_prefixes};
 
 pub trait Hamming {
     /// Get the Hamming weight of the value, i.e. number of bits set to `1`.
     fn hamming_weight(&self) -> u32;
+    /// Get the number of bits that differ between two values, as (between known levels, involving an unknown level).
+    fn transitions(&self, other: &Self) -> (u32, u32);
     /// Get the Hamming distance between two values, i.e. number of bits that differ.
-    fn hamming_distance(&self, other: &Self) -> u32;
+    fn hamming_distance(&self, other: &Self) -> u32 {
+        let (known, unknown) = self.transitions(other);
+        known + unknown
+    }
+}
+
+/// How the transitions of a bit from or to an unknown level (`x`, `z`, ...) are counted.
+#[derive(Clone, Copy, Debug, Default, PartialEq, Eq)]
+pub enum XzPolicy {
+    /// Not counted.
+    Ignore,
+    /// Counted as a full toggle.
+    Toggle,
+    /// Counted as half a toggle, the expected toggle of an unknown bit that is `0` or `1` with equal probability.
+    #[default]
+    Half,
+}
+
+impl XzPolicy {
+    /// Power of a transition involving an unknown level, relative to a toggle between known levels.
+    pub fn unknown_weight(self) -> f32 {
+        match self {
+            XzPolicy::Ignore => 0.0,
+            XzPolicy::Toggle => 1.0,
+            XzPolicy::Half => 0.5,
+        }
+    }
+}
+
+impl FromStr for XzPolicy {
+    type Err = String;
+
+    /// Parse `ignore`, `toggle` or `half`.
+    fn from_str(s: &str) -> Result<Self, Self::Err> {
+        match s.trim().to_ascii_lowercase().as_str() {
+            "ignore" => Ok(XzPolicy::Ignore),
+            "toggle" => Ok(XzPolicy::Toggle),
+            "half" => Ok(XzPolicy::Half),
+            s => Err(format!("expected ignore, toggle or half, found '{s}'")),
+        }
+    }
+}
+
+impl std::fmt::Display for XzPolicy {
+    fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
+        match self {
+            XzPolicy::Ignore => write!(f, "ignore"),
+            XzPolicy::Toggle => write!(f, "toggle"),
+            XzPolicy::Half => write!(f, "half"),
+        }
+    }
+}
+
+/// The power of a single value change.
+#[derive(Clone, Copy, Debug, Default, PartialEq)]
+pub enum PowerModelKind {
+    /// Number of toggled bits.
+    #[default]
+    HammingDistance,
+    /// Number of bits set in the new value.
+    HammingWeight,
+    /// `hd` times the Hamming distance plus `hw` times the Hamming weight of the new value.
+    Mixed { hd: f32, hw: f32 },
+}
+
+impl FromStr for PowerModelKind {
+    type Err = String;
+
+    /// Parse `hd`, `hw`, `hd+hw`, or `mixed:HD_COEF,HW_COEF`.
+    fn from_str(s: &str) -> Result<Self, Self::Err> {
+        match s.trim().to_ascii_lowercase().as_str() {
+            "hd" => Ok(PowerModelKind::HammingDistance),
+            "hw" => Ok(PowerModelKind::HammingWeight),
+            "hd+hw" => Ok(PowerModelKind::Mixed { hd: 1.0, hw: 1.0 }),
+            s => {
+                let (hd, hw) = s
+                    .strip_prefix("mixed:")
+                    .and_then(|coefs| coefs.split_once(','))
+                    .ok_or_else(|| {
+                        format!("expected hd, hw, hd+hw or mixed:HD_COEF,HW_COEF, found '{s}'")
+                    })?;
+                let hd = hd.trim().parse::<f32>().map_err(|e| e.to_string())?;
+                let hw = hw.trim().parse::<f32>().map_err(|e| e.to_string())?;
+                Ok(PowerModelKind::Mixed { hd, hw })
+            }
+        }
+    }
+}
+
+impl std::fmt::Display for PowerModelKind {
+    fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
+        match self {
+            PowerModelKind::HammingDistance => write!(f, "hd"),
+            PowerModelKind::HammingWeight => write!(f, "hw"),
+            PowerModelKind::Mixed { hd, hw } => write!(f, "mixed:{hd},{hw}"),
+        }
+    }
+}
+
+/// The power of a single value change, for a [`PowerModelKind`] fixed at compile time.
+pub trait PowerKernel: Copy + Send + Sync {
+    fn power<V: Hamming>(&self, prev_value: &V, new_value: &V) -> f32;
+    /// Power of a change of a 1-bit signal between two levels: `0`, `1`, or a distinct code of at least `2` for each
+    /// unknown level (see [`bit_level`]).
+    fn bit_power(&self, prev_level: u8, new_level: u8) -> f32;
+    /// Power of a value change from its counts: bits toggled between known levels, bits changed from or to an unknown
+    /// level, and bits that are `1` after the change (see [`crate::ToggleCache`]).
+    fn transition_power(&self, known: u32, unknown: u32, ones: u32) -> f32;
 }
 
+/// Toggles between the levels of a bit, with those involving an unknown level weighted by `unknown_weight`.
 #[inline(always)]
-pub fn power_model<V: Hamming>(prev_value: &V, new_value: &V) -> f32 {
-    // new_value.hamming_weight() as f32 * 0.1 + // static power
-    new_value.hamming_distance(&prev_value) as f32
+fn bit_toggles(prev_level: u8, new_level: u8, unknown_weight: f32) -> f32 {
+    if prev_level == new_level {
+        0.0
+    } else if prev_level.max(new_level) >= 2 {
+        unknown_weight
+    } else {
+        1.0
+    }
+}
+
+#[derive(Clone, Copy, Debug)]
+pub struct HammingDistanceKernel {
+    /// see [`XzPolicy::unknown_weight`]
+    pub unknown_weight: f32,
+}
+
+impl PowerKernel for HammingDistanceKernel {
+    #[inline(always)]
+    fn power<V: Hamming>(&self, prev_value: &V, new_value: &V) -> f32 {
+        let (known, unknown) = new_value.transitions(prev_value);
+        known as f32 + self.unknown_weight * unknown as f32
+    }
+    #[inline(always)]
+    fn bit_power(&self, prev_level: u8, new_level: u8) -> f32 {
+        bit_toggles(prev_level, new_level, self.unknown_weight)
+    }
+    #[inline(always)]
+    fn transition_power(&self, known: u32, unknown: u32, _ones: u32) -> f32 {
+        known as f32 + self.unknown_weight * unknown as f32
+    }
+}
+
+#[derive(Clone, Copy, Debug)]
+pub struct HammingWeightKernel;
+
+impl PowerKernel for HammingWeightKernel {
+    #[inline(always)]
+    fn power<V: Hamming>(&self, _prev_value: &V, new_value: &V) -> f32 {
+        new_value.hamming_weight() as f32
+    }
+    #[inline(always)]
+    fn bit_power(&self, _prev_level: u8, new_level: u8) -> f32 {
+        (new_level == 1) as u32 as f32
+    }
+    #[inline(always)]
+    fn transition_power(&self, _known: u32, _unknown: u32, ones: u32) -> f32 {
+        ones as f32
+    }
+}
+
+#[derive(Clone, Copy, Debug)]
+pub struct MixedKernel {
+    pub hd: f32,
+    pub hw: f32,
+    /// see [`XzPolicy::unknown_weight`]
+    pub unknown_weight: f32,
+}
+
+impl PowerKernel for MixedKernel {
+    #[inline(always)]
+    fn power<V: Hamming>(&self, prev_value: &V, new_value: &V) -> f32 {
+        let (known, unknown) = new_value.transitions(prev_value);
+        self.hd * (known as f32 + self.unknown_weight * unknown as f32)
+            + self.hw * new_value.hamming_weight() as f32
+    }
+    #[inline(always)]
+    fn bit_power(&self, prev_level: u8, new_level: u8) -> f32 {
+        self.hd * bit_toggles(prev_level, new_level, self.unknown_weight)
+            + self.hw * (new_level == 1) as u32 as f32
+    }
+    #[inline(always)]
+    fn transition_power(&self, known: u32, unknown: u32, ones: u32) -> f32 {
+        self.hd * (known as f32 + self.unknown_weight * unknown as f32) + self.hw * ones as f32
+    }
+}
+
+/// Evaluate `$body` with `$kernel` bound to the [`PowerKernel`] of the [`PowerModel`] `$model`.
+/// `$body` is compiled once for each kind of model, with the power of a change inlined into its loops.
+macro_rules! with_power_kernel {
+    ($model:expr, $kernel:ident => $body:expr) => {{
+        let unknown_weight = $model.xz_policy.unknown_weight();
+        match $model.kind {
+            $crate::power_model::PowerModelKind::HammingDistance => {
+                let $kernel = $crate::power_model::HammingDistanceKernel { unknown_weight };
+                $body
+            }
+            $crate::power_model::PowerModelKind::HammingWeight => {
+                let $kernel = $crate::power_model::HammingWeightKernel;
+                $body
+            }
+            $crate::power_model::PowerModelKind::Mixed { hd, hw } => {
+                let $kernel = $crate::power_model::MixedKernel {
+                    hd,
+                    hw,
+                    unknown_weight,
+                };
+                $body
+            }
+        }
+    }};
+}
+pub(crate) use with_power_kernel;
+
+/// Weight of each loaded signal that has one. Signals without a weight have a weight of `1`.
+pub type SignalWeights = FxHashMap<wellen::SignalRef, f32>;
+
+#[derive(Clone, Debug, Default)]
+pub struct PowerModel {
+    pub kind: PowerModelKind,
+    pub xz_policy: XzPolicy,
+    /// patterns of full hierarchical names, and the weight of the signals matching each of them
+    weights: Option<(GlobSet, Vec<f32>)>,
+}
+
+impl PowerModel {
+    /// A power model of the given kind, with the signals matching each `(pattern, weight)` of `weights` scaled by
+    /// that weight. When several patterns match a variable, the one matching its innermost scope wins, and then
+    /// the last one given.
+    pub fn new(
+        kind: PowerModelKind,
+        xz_policy: XzPolicy,
+        weights: &[(String, f32)],
+    ) -> miette::Result<Self> {
+        let patterns = weights
+            .iter()
+            .map(|(pattern, _)| pattern.clone())
+            .collect::<Vec<_>>();
+        Ok(PowerModel {
+            kind,
+            xz_policy,
+            weights: build_glob_set(&patterns)?
+                .map(|set| (set, weights.iter().map(|&(_, weight)| weight).collect())),
+        })
+    }
+
+    /// Whether some signals are weighted.
+    pub fn has_weights(&self) -> bool {
+        self.weights.is_some()
+    }
+
+    /// Weight of the variable with the given full hierarchical name, if a pattern matches it.
+    pub fn weight_of(&self, full_name: &str) -> Option<f32> {
+        let (set, weights) = self.weights.as_ref()?;
+        scope_prefixes(full_name)
+            .find_map(|name| set.matches(name).into_iter().max())
+            .map(|i| weights[i])
+    }
+
+    /// Weights of the signals of `hierarchy`. An aliased signal takes the weight of its first weighted variable.
+    pub fn signal_weights(&self, hierarchy: &wellen::Hierarchy) -> SignalWeights {
+        let mut signal_weights = SignalWeights::default();
+        if self.has_weights() {
+            for var in hierarchy.iter_vars() {
+                if let Some(weight) = self.weight_of(&var.full_name(hierarchy)) {
+                    signal_weights.entry(var.signal_ref()).or_insert(weight);
+                }
+            }
+        }
+        signal_weights
+    }
+
+    /// Power of a single value change, without weight. Prefer [`with_power_kernel`] for loops over many changes.
+    #[inline(always)]
+    pub fn power<V: Hamming>(&self, prev_value: &V, new_value: &V) -> f32 {
+        with_power_kernel!(self, kernel => kernel.power(prev_value, new_value))
+    }
+}
+
+/// The level of a 1-bit value, or `None` for other values: `0`, `1` (including the weak `l` and `h` of 9-state
+/// values), or `2` and `3` for the unknown `x` and `z` (`u`, `w` and `-` are `x`).
+#[inline(always)]
+pub fn bit_level(value: &wellen::SignalValue) -> Option<u8> {
+    match value {
+        wellen::SignalValue::Binary(data, 1) => Some(data[0] & 0x1),
+        wellen::SignalValue::FourValue(data, 1) => Some(data[0] & 0x3),
+        wellen::SignalValue::NineValue(data, 1) => {
+            Some(popcount::NINE_STATE_LEVELS[(data[0] & 0xf) as usize])
+        }
+        _ => None,
+    }
 }
 
 impl<'a> Hamming for wellen::SignalValue<'a> {
@@ -20,13 +324,15 @@ impl<'a> Hamming for wellen::SignalValue<'a> {
                 if *bits == 0 {
                     panic!("Cannot compute hamming weight of empty signal!");
                 }
-                data.iter().map(|&x| x.count_ones()).sum()
+                popcount::popcount(data)
             }
+            wellen::SignalValue::FourValue(data, _) => popcount::four_state_ones(data),
+            wellen::SignalValue::NineValue(data, _) => popcount::nine_state_ones(data),
             _ => 0,
         }
     }
     #[inline(always)]
-    fn hamming_distance(&self, other: &Self) -> u32 {
+    fn transitions(&self, other: &Self) -> (u32, u32) {
         match (self, other) {
             (
                 wellen::SignalValue::Binary(self_data, self_bits),
@@ -35,13 +341,60 @@ impl<'a> Hamming for wellen::SignalValue<'a> {
                 if self_bits != other_bits {
                     panic!("Cannot compare different bit widths!");
                 }
-                self_data
-                    .iter()
-                    .zip(other_data.iter())
-                    .map(|(a, b)| (a ^ b).count_ones())
-                    .sum()
+                (popcount::xor_popcount(self_data, other_data), 0)
             }
-            _ => 0,
+            (
+                wellen::SignalValue::FourValue(self_data, self_bits),
+                wellen::SignalValue::FourValue(other_data, other_bits),
+            ) => {
+                if self_bits != other_bits {
+                    panic!("Cannot compare different bit widths!");
+                }
+                popcount::four_state_transitions(self_data, other_data)
+            }
+            (
+                wellen::SignalValue::NineValue(self_data, self_bits),
+                wellen::SignalValue::NineValue(other_data, other_bits),
+            ) => {
+                if self_bits != other_bits {
+                    panic!("Cannot compare different bit widths!");
+                }
+                popcount::nine_state_transitions(self_data, other_data)
+            }
+            // mixed encodings, e.g. a binary value followed by one with an `x`: widen the narrower value
+            _ => match (packed_digits(self), packed_digits(other)) {
+                (
+                    Some((self_data, self_bits, self_packing)),
+                    Some((other_data, other_bits, other_packing)),
+                ) => {
+                    if self_bits != other_bits {
+                        panic!("Cannot compare different bit widths!");
+                    }
+                    let packing = self_packing.max(other_packing);
+                    let self_data =
+                        popcount::widen_digits(self_data, self_bits, self_packing, packing);
+                    let other_data =
+                        popcount::widen_digits(other_data, other_bits, other_packing, packing);
+                    if packing == 2 {
+                        popcount::four_state_transitions(&self_data, &other_data)
+                    } else {
+                        popcount::nine_state_transitions(&self_data, &other_data)
+                    }
+                }
+                _ => (0, 0),
+            },
         }
     }
 }
+
+/// The packed digits of a value, its number of digits and the number of bits per digit, or `None` for strings and
+/// reals.
+#[inline(always)]
+fn packed_digits<'b>(value: &'b wellen::SignalValue) -> Option<(&'b [u8], u32, u32)> {
+    match value {
+        wellen::SignalValue::Binary(data, bits) => Some((data, *bits, 1)),
+        wellen::SignalValue::FourValue(data, bits) => Some((data, *bits, 2)),
+        wellen::SignalValue::NineValue(data, bits) => Some((data, *bits, 4)),
+        _ => None,
+    }
+}
@@ -0,0 +1,136 @@
+//! Selection of the waveform signals that contribute to the power trace.
+//!
+//! Variables are matched by their full hierarchical name (e.g. `tb.dut.core.state`) against include and exclude
+//! glob patterns. A pattern also matches all the variables below a matching scope, so `tb.dut.core` selects the
+//! whole core, and `*clk*` drops every clock. Aliased variables, which share a signal, are loaded only once.
+//! The selection can also be restricted to the variables declared as registers (`reg`).
+
+use globset::{Glob, GlobSet, GlobSetBuilder};
+use itertools::Itertools;
+use log::info;
+use miette::{Context, IntoDiagnostic};
+use num_format::{Locale, ToFormattedString};
+use rustc_hash::FxHashSet;
+
+#[derive(Clone, Debug, Default)]
+pub struct SignalSelection {
+    /// variables to include, all of them if `None`
+    include: Option<GlobSet>,
+    /// variables to exclude, applied after `include`
+    exclude: Option<GlobSet>,
+    /// drop the signals that never change after their initial value
+    pub drop_constant: bool,
+    /// select only the variables declared as registers
+    pub registers_only: bool,
+}
+
+pub(crate) fn build_glob_set(patterns: &[String]) -> miette::Result<Option<GlobSet>> {
+    if patterns.is_empty() {
+        return Ok(None);
+    }
+    let mut builder = GlobSetBuilder::new();
+    for pattern in patterns {
+        builder.add(
+            Glob::new(pattern)
+                .into_diagnostic()
+                .wrap_err_with(|| format!("Invalid signal pattern '{pattern}'"))?,
+        );
+    }
+    builder.build().into_diagnostic().map(Some)
+}
+
+/// The full name followed by the names of its enclosing scopes, innermost first.
+pub(crate) fn scope_prefixes(full_name: &str) -> impl Iterator<Item = &str> {
+    std::iter::once(full_name).chain(
+        full_name
+            .rmatch_indices('.')
+            .map(move |(i, _)| &full_name[..i]),
+    )
+}
+
+impl SignalSelection {
+    pub fn new(
+        include: &[String],
+        exclude: &[String],
+        drop_constant: bool,
+        registers_only: bool,
+    ) -> miette::Result<Self> {
+        Ok(SignalSelection {
+            include: build_glob_set(include)?,
+            exclude: build_glob_set(exclude)?,
+            drop_constant,
+            registers_only,
+        })
+    }
+
+    /// Select all signals, including the constant ones.
+    pub fn all() -> Self {
+        Self::default()
+    }
+
+    /// The same selection, restricted to registers or not.
+    pub fn with_registers_only(&self, registers_only: bool) -> Self {
+        SignalSelection {
+            registers_only,
+            ..self.clone()
+        }
+    }
+
+    /// Whether every variable is selected.
+    pub fn selects_all(&self) -> bool {
+        self.include.is_none() && self.exclude.is_none() && !self.registers_only
+    }
+
+    /// Whether the variable with the given full hierarchical name is selected, `is_register` being whether it is
+    /// declared as a register.
+    pub fn is_selected(&self, full_name: &str, is_register: bool) -> bool {
+        let matches = |set: &GlobSet| scope_prefixes(full_name).any(|name| set.is_match(name));
+        (is_register || !self.registers_only)
+            && self.include.as_ref().is_none_or(matches)
+            && !self.exclude.as_ref().is_some_and(matches)
+    }
+
+    /// The signals of the selected variables of `hierarchy`, each one only once.
+    pub fn select_signal_refs(&self, hierarchy: &wellen::Hierarchy) -> Vec<wellen::SignalRef> {
+        let mut num_vars = 0;
+        let mut num_selected = 0;
+        let mut seen = FxHashSet::default();
+        let signal_refs = hierarchy
+            .iter_vars()
+            .filter(|var| {
+                num_vars += 1;
+                self.selects_all()
+                    || self.is_selected(
+                        &var.full_name(hierarchy),
+                        var.var_type() == wellen::VarType::Reg,
+                    )
+            })
+            .filter_map(|var| {
+                num_selected += 1;
+                let signal_ref = var.signal_ref();
+                seen.insert(signal_ref).then_some(signal_ref)
+            })
+            .collect_vec();
+        info!(
+            "Selected {} of {} variables, with {} distinct signals",
+            num_selected.to_formatted_string(&Locale::en),
+            num_vars.to_formatted_string(&Locale::en),
+            signal_refs.len().to_formatted_string(&Locale::en)
+        );
+        signal_refs
+    }
+
+    /// Drop the loaded signals that never change, if `drop_constant` is set. They contribute no switching power.
+    pub fn retain_changing(&self, signals: &mut Vec<(wellen::SignalRef, wellen::Signal)>) {
+        if self.drop_constant {
+            let num_signals = signals.len();
+            signals.retain(|(_, signal)| signal.iter_changes().nth(1).is_some());
+            if signals.len() < num_signals {
+                info!(
+                    "Dropped {} constant signals",
+                    (num_signals - signals.len()).to_formatted_string(&Locale::en)
+                );
+            }
+        }
+    }
+}
@@ -0,0 +1,535 @@
+//! Cache of the value changes of a run, so that its power trace can be regenerated without decoding the waveform.
+//!
+//! The cache holds, for every signal of the waveform, the changes that can contribute power under any power model:
+//! the time index of the change, the number of bits that toggled between known levels, the number of bits that
+//! changed from or to an unknown level, and the number of bits that are `1` after the change. The variables are
+//! kept with their full name and whether they are registers, so that power traces for another power model, signal
+//! selection or weights, time spans or cycle binning are computed from the cache alone, at memory speed.
+//!
+//! It is stored as a compressed NPZ file (`toggles.npz`) of columns. The changes of each signal are contiguous,
+//! delimited by `signal_offsets`, and their time indices are delta-encoded within each signal.
+
+use std::fs::File;
+use std::ops::Range;
+use std::path::Path;
+
+use itertools::{Itertools, izip};
+use log::info;
+use miette::{Context, IntoDiagnostic, miette};
+use ndarray::Array1;
+use ndarray_npz::{NpzReader, NpzWriter};
+use num_format::{Locale, ToFormattedString};
+use rustc_hash::FxHashMap;
+
+use crate::power_model::with_power_kernel;
+use crate::{
+    Attribution, FlaggedSamples, Hamming, PowerKernel, PowerModel, SignalSelection,
+    accumulate_in_chunks, open_waveform, spans_to_time_indices, time_bins, time_extent,
+};
+
+pub const TOGGLES_NPZ: &str = "toggles.npz";
+
+/// Number of signals loaded from the waveform at once while building the cache.
+const TOGGLE_CACHE_BATCH: usize = 1024;
+
+#[derive(Clone, Debug, Default)]
+pub struct ToggleCache {
+    time_table: Vec<u64>,
+    /// full hierarchical name of each variable
+    var_names: Vec<String>,
+    /// index of the signal of each variable; aliased variables share a signal
+    var_signals: Vec<u32>,
+    var_is_register: Vec<bool>,
+    /// the changes of signal `i` are `signal_offsets[i]..signal_offsets[i + 1]`
+    signal_offsets: Vec<u64>,
+    time_indices: Vec<u32>,
+    known: Vec<u32>,
+    unknown: Vec<u32>,
+    ones: Vec<u32>,
+}
+
+impl ToggleCache {
+    /// Build the cache of all the signals of a waveform file, loading them in batches.
+    pub fn from_waveform<P: AsRef<Path>>(
+        filename: P,
+        multi_thread: bool,
+        show_progress: bool,
+    ) -> Result<Self, wellen::WellenError> {
+        let (hierarchy, mut wave_source, time_table) =
+            open_waveform(filename, multi_thread, show_progress)?;
+
+        let mut cache = ToggleCache {
+            time_table,
+            signal_offsets: vec![0],
+            ..Default::default()
+        };
+        let mut signal_indices = FxHashMap::default();
+        let mut signal_refs = Vec::new();
+        for var in hierarchy.iter_vars() {
+            let signal_ref = var.signal_ref();
+            let signal_index = *signal_indices.entry(signal_ref).or_insert_with(|| {
+                signal_refs.push(signal_ref);
+                signal_refs.len() - 1
+            });
+            cache.var_names.push(var.full_name(&hierarchy));
+            cache.var_signals.push(signal_index as u32);
+            cache
+                .var_is_register
+                .push(var.var_type() == wellen::VarType::Reg);
+        }
+
+        info!(
+            "Caching the changes of {} signals..",
+            signal_refs.len().to_formatted_string(&Locale::en)
+        );
+        for batch in signal_refs.chunks(TOGGLE_CACHE_BATCH) {
+            let signals: FxHashMap<_, _> = wave_source
+                .load_signals(batch, &hierarchy, multi_thread)
+                .into_iter()
+                .collect();
+            for signal_ref in batch {
+                cache.push_signal(&signals[signal_ref]);
+            }
+        }
+        info!(
+            "Cached {} changes",
+            cache.num_changes().to_formatted_string(&Locale::en)
+        );
+        Ok(cache)
+    }
+
+    /// Append the changes of the next signal. Changes that toggle no bit and leave no bit at `1` are skipped, as they
+    /// contribute no power under any model.
+    fn push_signal(&mut self, signal: &wellen::Signal) {
+        let mut prev_value: Option<wellen::SignalValue> = None;
+        for (time_index, new_value) in signal.iter_changes() {
+            if let Some(prev_value) = &prev_value {
+                let (known, unknown) = new_value.transitions(prev_value);
+                let ones = new_value.hamming_weight();
+                if known + unknown + ones > 0 {
+                    self.time_indices.push(time_index);
+                    self.known.push(known);
+                    self.unknown.push(unknown);
+                    self.ones.push(ones);
+                }
+            }
+            prev_value = Some(new_value);
+        }
+        self.signal_offsets.push(self.time_indices.len() as u64);
+    }
+
+    pub fn time_table(&self) -> &[u64] {
+        &self.time_table
+    }
+
+    pub fn num_signals(&self) -> usize {
+        self.signal_offsets.len() - 1
+    }
+
+    pub fn num_changes(&self) -> usize {
+        self.time_indices.len()
+    }
+
+    fn changes(&self, signal: usize) -> Range<usize> {
+        self.signal_offsets[signal] as usize..self.signal_offsets[signal + 1] as usize
+    }
+
+    /// The ranges of time indices of the `time_spans`, or of the whole time table.
+    fn index_spans(&self, time_spans: Option<&[(u64, u64)]>) -> Vec<Range<usize>> {
+        match time_spans {
+            Some(time_spans) => spans_to_time_indices(time_spans, &self.time_table),
+            None => vec![0..self.time_table.len()],
+        }
+    }
+
+    /// The changes of `signal` within the `index_spans` (sorted and disjoint), in time order.
+    fn changes_in_spans<'a>(
+        &'a self,
+        signal: usize,
+        index_spans: &'a [Range<usize>],
+    ) -> impl Iterator<Item = usize> + 'a {
+        let mut span_cursor = 0;
+        self.changes(signal)
+            .map_while(move |change| {
+                let time_index = self.time_indices[change] as usize;
+                // changes are in time order, so the spans that ended before this change are never needed again
+                while span_cursor < index_spans.len() && index_spans[span_cursor].end <= time_index
+                {
+                    span_cursor += 1;
+                }
+                // past the last span
+                let span = index_spans.get(span_cursor)?;
+                Some((span.start <= time_index).then_some(change))
+            })
+            .flatten()
+    }
+
+    /// The signals with changes of the variables selected by `selection`, each one only once, with their weight
+    /// under `power_model` and their first selected variable. An aliased signal takes the weight of its first
+    /// weighted variable.
+    fn select_signals(
+        &self,
+        selection: &SignalSelection,
+        power_model: &PowerModel,
+    ) -> Vec<(usize, f32, usize)> {
+        let mut first_selected: Vec<Option<usize>> = vec![None; self.num_signals()];
+        let mut weights: Vec<Option<f32>> = vec![None; self.num_signals()];
+        let mut num_selected = 0;
+        for (var, (name, &signal, &is_register)) in
+            izip!(&self.var_names, &self.var_signals, &self.var_is_register).enumerate()
+        {
+            let signal = signal as usize;
+            if selection.selects_all() || selection.is_selected(name, is_register) {
+                first_selected[signal].get_or_insert(var);
+                num_selected += 1;
+            }
+            if power_model.has_weights() && weights[signal].is_none() {
+                weights[signal] = power_model.weight_of(name);
+            }
+        }
+        let signals = (0..self.num_signals())
+            .filter(|&signal| !self.changes(signal).is_empty())
+            .filter_map(|signal| {
+                first_selected[signal].map(|var| (signal, weights[signal].unwrap_or(1.0), var))
+            })
+            .filter(|&(_, weight, _)| weight != 0.0)
+            .collect_vec();
+        info!(
+            "Selected {} of {} variables, with {} changing signals",
+            num_selected.to_formatted_string(&Locale::en),
+            self.var_names.len().to_formatted_string(&Locale::en),
+            signals.len().to_formatted_string(&Locale::en)
+        );
+        signals
+    }
+
+    /// The power of the signals selected by `selection` under `power_model`, as [`crate::load_power_table_batched`]
+    /// computes it from the waveform: the time table and the (unfiltered) power table, or the start times of the bins
+    /// of `bin_width` and their power.
+    pub fn power_table(
+        &self,
+        selection: &SignalSelection,
+        power_model: &PowerModel,
+        time_spans: Option<&[(u64, u64)]>,
+        bin_width: Option<u64>,
+    ) -> (Vec<u64>, Vec<f32>) {
+        let signals = self.select_signals(selection, power_model);
+        let index_spans = self.index_spans(time_spans);
+        match bin_width {
+            Some(bin_width) => {
+                let (start_time, end_time) = time_extent(time_spans, &self.time_table);
+                let (bin_times, slots) =
+                    time_bins(&self.time_table, bin_width, start_time, end_time);
+                let mut bin_power = vec![0f32; bin_times.len()];
+                self.accumulate_power(
+                    &signals,
+                    power_model,
+                    &mut bin_power,
+                    &index_spans,
+                    |time_index| slots[time_index] as usize,
+                );
+                (bin_times, bin_power)
+            }
+            None => {
+                let mut power_table = vec![0f32; self.time_table.len()];
+                self.accumulate_power(
+                    &signals,
+                    power_model,
+                    &mut power_table,
+                    &index_spans,
+                    |time_index| time_index,
+                );
+                (self.time_table.clone(), power_table)
+            }
+        }
+    }
+
+    fn accumulate_power<S: Fn(usize) -> usize + Sync>(
+        &self,
+        signals: &[(usize, f32, usize)],
+        power_model: &PowerModel,
+        power_table: &mut [f32],
+        index_spans: &[Range<usize>],
+        slot_of: S,
+    ) {
+        accumulate_in_chunks(signals, power_table, |chunk, partial| {
+            with_power_kernel!(power_model, kernel => self.accumulate_power_serial(
+                chunk,
+                kernel,
+                partial,
+                index_spans,
+                &slot_of,
+            ))
+        });
+    }
+
+    fn accumulate_power_serial<K: PowerKernel, S: Fn(usize) -> usize>(
+        &self,
+        signals: &[(usize, f32, usize)],
+        kernel: K,
+        power_table: &mut [f32],
+        index_spans: &[Range<usize>],
+        slot_of: &S,
+    ) {
+        for &(signal, weight, _) in signals {
+            for change in self.changes_in_spans(signal, index_spans) {
+                let time_index = self.time_indices[change] as usize;
+                if let Some(power) = power_table.get_mut(slot_of(time_index)) {
+                    *power += weight
+                        * kernel.transition_power(
+                            self.known[change],
+                            self.unknown[change],
+                            self.ones[change],
+                        );
+                }
+            }
+        }
+    }
+
+    /// Accumulate the power of the signals selected by `selection` under `power_model` at the `flagged` samples into
+    /// `attribution`, attributing each signal to the unit of its first selected variable. Like in
+    /// [`power_table`](Self::power_table), only the changes within the `time_spans` are counted.
+    pub fn attribute(
+        &self,
+        attribution: &mut Attribution,
+        flagged: &FlaggedSamples,
+        selection: &SignalSelection,
+        power_model: &PowerModel,
+        time_spans: Option<&[(u64, u64)]>,
+    ) {
+        let signals = self.select_signals(selection, power_model);
+        let index_spans = self.index_spans(time_spans);
+        let unit = attribution.unit();
+        with_power_kernel!(power_model, kernel => attribution.add_run(
+            flagged,
+            &signals,
+            |&(_, _, var)| unit.name_of(&self.var_names[var]),
+            |&(signal, weight, _), on_power| {
+                for change in self.changes_in_spans(signal, &index_spans) {
+                    on_power(
+                        self.time_table[self.time_indices[change] as usize],
+                        weight
+                            * kernel.transition_power(
+                                self.known[change],
+                                self.unknown[change],
+                                self.ones[change],
+                            ),
+                    );
+                }
+            },
+        ));
+    }
+
+    /// Save the cache as a compressed NPZ file, written under a temporary name and then renamed.
+    pub fn save<P: AsRef<Path>>(&self, path: P) -> miette::Result<()> {
+        let path = path.as_ref();
+        let tmp_path = path.with_extension("npz.tmp");
+        let file = File::create(&tmp_path)
+            .into_diagnostic()
+            .wrap_err_with(|| format!("Failed to create {}", tmp_path.display()))?;
+        // delta-encode the time indices of each signal, which compress much better than the absolute ones
+        let mut time_deltas = self.time_indices.clone();
+        for signal in 0..self.num_signals() {
+            let changes = self.changes(signal);
+            for change in (changes.start + 1..changes.end).rev() {
+                time_deltas[change] -= time_deltas[change - 1];
+            }
+        }
+        let mut npz = NpzWriter::new_compressed(file);
+        npz.add_array("time_table", &Array1::from_vec(self.time_table.clone()))
+            .into_diagnostic()?;
+        npz.add_array(
+            "var_names",
+            &Array1::from_vec(self.var_names.join("\n").into_bytes()),
+        )
+        .into_diagnostic()?;
+        npz.add_array("var_signals", &Array1::from_vec(self.var_signals.clone()))
+            .into_diagnostic()?;
+        npz.add_array(
+            "var_is_register",
+            &Array1::from_iter(
+                self.var_is_register
+                    .iter()
+                    .map(|&is_register| is_register as u8),
+            ),
+        )
+        .into_diagnostic()?;
+        npz.add_array(
+            "signal_offsets",
+            &Array1::from_vec(self.signal_offsets.clone()),
+        )
+        .into_diagnostic()?;
+        npz.add_array("time_deltas", &Array1::from_vec(time_deltas))
+            .into_diagnostic()?;
+        npz.add_array("known", &Array1::from_vec(self.known.clone()))
+            .into_diagnostic()?;
+        npz.add_array("unknown", &Array1::from_vec(self.unknown.clone()))
+            .into_diagnostic()?;
+        npz.add_array("ones", &Array1::from_vec(self.ones.clone()))
+            .into_diagnostic()?;
+        npz.finish()
+            .into_diagnostic()
+            .wrap_err_with(|| format!("Failed to write {}", tmp_path.display()))?;
+        std::fs::rename(&tmp_path, path).into_diagnostic()
+    }
+
+    /// Load a cache saved with [`ToggleCache::save`].
+    pub fn load<P: AsRef<Path>>(path: P) -> miette::Result<Self> {
+        let path = path.as_ref();
+        let file = File::open(path)
+            .into_diagnostic()
+            .wrap_err_with(|| format!("Failed to open {}", path.display()))?;
+        let mut npz = NpzReader::new(std::io::BufReader::new(file)).into_diagnostic()?;
+        let time_table: Array1<u64> = npz
+            .by_name("time_table")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'time_table' in NPZ file")?;
+        let var_names: Array1<u8> = npz
+            .by_name("var_names")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'var_names' in NPZ file")?;
+        let var_signals: Array1<u32> = npz
+            .by_name("var_signals")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'var_signals' in NPZ file")?;
+        let var_is_register: Array1<u8> = npz
+            .by_name("var_is_register")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'var_is_register' in NPZ file")?;
+        let signal_offsets: Array1<u64> = npz
+            .by_name("signal_offsets")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'signal_offsets' in NPZ file")?;
+        let mut time_indices: Array1<u32> = npz
+            .by_name("time_deltas")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'time_deltas' in NPZ file")?;
+        let known: Array1<u32> = npz
+            .by_name("known")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'known' in NPZ file")?;
+        let unknown: Array1<u32> = npz
+            .by_name("unknown")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'unknown' in NPZ file")?;
+        let ones: Array1<u32> = npz
+            .by_name("ones")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'ones' in NPZ file")?;
+
+        let var_names = if var_names.is_empty() {
+            Vec::new()
+        } else {
+            String::from_utf8(var_names.to_vec())
+                .into_diagnostic()
+                .wrap_err("Invalid variable names")?
+                .split('\n')
+                .map(str::to_string)
+                .collect_vec()
+        };
+        let num_signals = signal_offsets.len().saturating_sub(1);
+        let num_changes = time_indices.len();
+        if signal_offsets.is_empty()
+            || var_signals.len() != var_names.len()
+            || var_is_register.len() != var_names.len()
+            || var_signals
+                .iter()
+                .any(|&signal| signal as usize >= num_signals)
+            || signal_offsets[0] != 0
+            || signal_offsets.windows(2).into_iter().any(|w| w[0] > w[1])
+            || signal_offsets[num_signals] as usize != num_changes
+            || known.len() != num_changes
+            || unknown.len() != num_changes
+            || ones.len() != num_changes
+        {
+            return Err(miette!(
+                "Inconsistent toggle cache in {}: {} variables, {} signals, {} changes",
+                path.display(),
+                var_names.len(),
+                num_signals,
+                num_changes
+            ));
+        }
+        for signal in 0..num_signals {
+            let changes = signal_offsets[signal] as usize..signal_offsets[signal + 1] as usize;
+            for change in changes.start + 1..changes.end {
+                time_indices[change] += time_indices[change - 1];
+            }
+        }
+        if time_indices
+            .iter()
+            .any(|&time_index| time_index as usize >= time_table.len())
+        {
+            return Err(miette!(
+                "Toggle cache in {} has changes past the end of its time table",
+                path.display()
+            ));
+        }
+
+        Ok(ToggleCache {
+            time_table: time_table.to_vec(),
+            var_names,
+            var_signals: var_signals.to_vec(),
+            var_is_register: var_is_register.iter().map(|&flag| flag != 0).collect(),
+            signal_offsets: signal_offsets.to_vec(),
+            time_indices: time_indices.to_vec(),
+            known: known.to_vec(),
+            unknown: unknown.to_vec(),
+            ones: ones.to_vec(),
+        })
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use crate::AttributionUnit;
+
+    #[test]
+    fn attribution_skips_changes_outside_the_spans() {
+        // four traces of 10 time units every 20, with a change within each trace and one just after it, in the
+        // same bin of 4 time units
+        let in_span = [1, 2, 3, 6];
+        let toggle_cache = ToggleCache {
+            time_table: (0..4).flat_map(|k| [20 * k + 9, 20 * k + 11]).collect(),
+            var_names: vec!["tb.a".to_string()],
+            var_signals: vec![0],
+            var_is_register: vec![false],
+            signal_offsets: vec![0, 8],
+            time_indices: (0..8).collect(),
+            known: in_span.iter().flat_map(|&known| [known, 100]).collect(),
+            unknown: vec![0; 8],
+            ones: vec![0; 8],
+        };
+        let meta_markers = (0..4u64)
+            .map(|k| (20 * k, 20 * k + 10, (k % 2) as u16))
+            .collect_vec();
+        let time_spans = meta_markers
+            .iter()
+            .map(|&(start, end, _)| (start, end))
+            .collect_vec();
+        let selection = SignalSelection::new(&[], &[], false, false).unwrap();
+        let power_model = PowerModel::default();
+
+        let (bin_times, bin_power) =
+            toggle_cache.power_table(&selection, &power_model, Some(&time_spans), Some(4));
+        let flagged = FlaggedSamples::new(&[2], &bin_times, &meta_markers, Some(4), None);
+        for (k, &known) in in_span.iter().enumerate() {
+            assert_eq!(bin_times[5 * k + 2], 20 * k as u64 + 8);
+            assert_eq!(bin_power[5 * k + 2], known as f32);
+        }
+
+        let mut attribution = Attribution::new(AttributionUnit::Signal, vec![2]);
+        toggle_cache.attribute(
+            &mut attribution,
+            &flagged,
+            &selection,
+            &power_model,
+            Some(&time_spans),
+        );
+        let ranking = attribution.ranking();
+        assert_eq!(ranking.len(), 1);
+        assert_eq!(ranking[0].unit, "tb.a");
+        assert_eq!(ranking[0].mean, [2.0, 4.0]);
+    }
+}
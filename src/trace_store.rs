@@ -0,0 +1,185 @@
+//! Storage of the power traces of a single simulation run.
+//!
+//! Traces are stored as one contiguous `num_traces x samples_per_trace` array in `traces.npy`, with the labels in
+//! `labels.npy`. Both files are memory-mapped on load, so the traces are read without copying.
+//! The per-trace `traces.npz` written by earlier versions is still readable.
+
+use std::fs::File;
+use std::path::{Path, PathBuf};
+
+use itertools::Itertools;
+use memmap2::Mmap;
+use miette::{Context, IntoDiagnostic, miette};
+use ndarray::{Array1, Array2, ArrayView1, ArrayView2};
+use ndarray_npy::{ViewNpyExt, WriteNpyExt, write_npy};
+use ndarray_npz::NpzReader;
+
+pub const TRACES_NPY: &str = "traces.npy";
+pub const LABELS_NPY: &str = "labels.npy";
+/// Per-trace arrays `trace_{i}` and `labels`, written by earlier versions.
+pub const LEGACY_TRACES_NPZ: &str = "traces.npz";
+
+/// The traces file stored in `dir`, if any, preferring the contiguous store over the legacy NPZ.
+pub fn stored_traces_path<P: AsRef<Path>>(dir: P) -> Option<PathBuf> {
+    [TRACES_NPY, LEGACY_TRACES_NPZ]
+        .into_iter()
+        .map(|name| dir.as_ref().join(name))
+        .find(|path| path.exists())
+}
+
+/// Save traces and labels of a run to `dir`.
+/// The files are written under temporary names and then renamed, so readers never see partial files.
+pub fn save_traces<P: AsRef<Path>>(
+    dir: P,
+    traces: ArrayView2<f32>,
+    labels: ArrayView1<u16>,
+) -> miette::Result<()> {
+    let dir = dir.as_ref();
+    assert_eq!(
+        traces.nrows(),
+        labels.len(),
+        "Number of trace labels does not match number of traces"
+    );
+    // labels first: the traces file marks a complete store
+    write_npy_atomic(dir.join(LABELS_NPY), &labels)?;
+    write_npy_atomic(dir.join(TRACES_NPY), &traces)?;
+    Ok(())
+}
+
+fn write_npy_atomic<T: WriteNpyExt>(path: PathBuf, array: &T) -> miette::Result<()> {
+    let tmp_path = path.with_extension("npy.tmp");
+    write_npy(&tmp_path, array)
+        .into_diagnostic()
+        .wrap_err_with(|| format!("Failed to write {}", tmp_path.display()))?;
+    std::fs::rename(&tmp_path, &path).into_diagnostic()
+}
+
+fn map_file(path: &Path) -> miette::Result<Mmap> {
+    let file = File::open(path)
+        .into_diagnostic()
+        .wrap_err_with(|| format!("Failed to open {}", path.display()))?;
+    // Safety: trace stores are written once under a temporary name and renamed, and never modified in place.
+    unsafe { Mmap::map(&file) }
+        .into_diagnostic()
+        .wrap_err_with(|| format!("Failed to map {}", path.display()))
+}
+
+/// The traces and labels of a run, either memory-mapped from the contiguous store or owned.
+pub enum RunTraces {
+    Mapped {
+        traces: Mmap,
+        labels: Mmap,
+    },
+    Owned {
+        traces: Array2<f32>,
+        labels: Array1<u16>,
+    },
+}
+
+impl RunTraces {
+    /// Open the traces stored in the run directory `dir`.
+    pub fn open<P: AsRef<Path>>(dir: P) -> miette::Result<Self> {
+        let dir = dir.as_ref();
+        if dir.join(TRACES_NPY).exists() {
+            let run_traces = RunTraces::Mapped {
+                traces: map_file(&dir.join(TRACES_NPY))?,
+                labels: map_file(&dir.join(LABELS_NPY))?,
+            };
+            run_traces.validate()?;
+            Ok(run_traces)
+        } else {
+            Self::open_npz(dir.join(LEGACY_TRACES_NPZ))
+        }
+    }
+
+    /// Open a run directory, a `traces.npy` file (with `labels.npy` next to it) or a legacy NPZ file.
+    pub fn open_path<P: AsRef<Path>>(path: P) -> miette::Result<Self> {
+        let path = path.as_ref();
+        match path.extension().and_then(|ext| ext.to_str()) {
+            _ if path.is_dir() => Self::open(path),
+            Some("npz") => Self::open_npz(path),
+            Some("npy") => Self::open(path.parent().unwrap_or(Path::new("."))),
+            _ => Err(miette!(
+                "Unsupported traces path '{}': expected a run directory, a .npy or a .npz file",
+                path.display()
+            )),
+        }
+    }
+
+    /// Load the legacy NPZ file with one `trace_{i}` array per trace.
+    pub fn open_npz<P: AsRef<Path>>(path: P) -> miette::Result<Self> {
+        let path = path.as_ref();
+        let file = File::open(path)
+            .into_diagnostic()
+            .wrap_err_with(|| format!("Failed to open {}", path.display()))?;
+        let mut npz_reader = NpzReader::new(std::io::BufReader::new(file)).into_diagnostic()?;
+        let labels: Array1<u16> = npz_reader
+            .by_name("labels")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'labels' in NPZ file")?;
+        let names = npz_reader.names().into_diagnostic()?;
+        // trace_{i} entries, in trace order
+        let trace_names = names
+            .iter()
+            .filter_map(|name| {
+                let index = name
+                    .strip_prefix("trace_")?
+                    .trim_end_matches(".npy")
+                    .parse::<usize>()
+                    .ok()?;
+                Some((index, name))
+            })
+            .sorted()
+            .collect_vec();
+        let traces: Vec<Array1<f32>> = trace_names
+            .iter()
+            .map(|(_, name)| {
+                npz_reader
+                    .by_name(name.as_str())
+                    .into_diagnostic()
+                    .wrap_err_with(|| format!("Failed to find '{}' in NPZ file", name))
+            })
+            .try_collect()?;
+        let samples_per_trace = traces.first().map_or(0, |t| t.len());
+        let traces = Array2::from_shape_vec(
+            (traces.len(), samples_per_trace),
+            traces.into_iter().flatten().collect(),
+        )
+        .into_diagnostic()
+        .wrap_err("Failed to create traces array")?;
+        Ok(RunTraces::Owned { traces, labels })
+    }
+
+    fn validate(&self) -> miette::Result<()> {
+        if let RunTraces::Mapped { traces, labels } = self {
+            let traces = ArrayView2::<f32>::view_npy(traces).into_diagnostic()?;
+            let labels = ArrayView1::<u16>::view_npy(labels).into_diagnostic()?;
+            if traces.nrows() != labels.len() {
+                return Err(miette!(
+                    "Number of trace labels ({}) does not match number of traces ({})",
+                    labels.len(),
+                    traces.nrows()
+                ));
+            }
+        }
+        Ok(())
+    }
+
+    pub fn traces(&self) -> ArrayView2<'_, f32> {
+        match self {
+            RunTraces::Mapped { traces, .. } => {
+                ArrayView2::view_npy(traces).expect("traces were validated on open")
+            }
+            RunTraces::Owned { traces, .. } => traces.view(),
+        }
+    }
+
+    pub fn labels(&self) -> ArrayView1<'_, u16> {
+        match self {
+            RunTraces::Mapped { labels, .. } => {
+                ArrayView1::view_npy(labels).expect("labels were validated on open")
+            }
+            RunTraces::Owned { labels, .. } => labels.view(),
+        }
+    }
+}
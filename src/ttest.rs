@@ -0,0 +1,497 @@
+//! Univariate higher-order Welch t-test with mergeable accumulators.
+//!
+//! For each class and sample, the accumulator keeps the number of traces, the mean and the central moment sums
+//! `M_p = sum (x - mean)^p` for `p = 2..=2d`. Batches of traces are reduced to these moments and combined with
+//! the pairwise update formulas of Pébay (2008), so accumulators built from different runs (or on different
+//! threads) can be merged in any grouping with the same result, up to rounding.
+//!
+//! The t-statistics follow the usual higher-order TVLA formulation: order 1 compares means, order 2 compares
+//! variances, and order `d > 2` compares the standardized moments `CM_d / CM_2^(d/2)`.
+//!
+//! Accumulators are saved as NPZ files with the arrays `num_traces`, `mean` and `moments`, so that the moments of
+//! each run (or of a whole shard of a campaign) can be merged later without reading their traces again.
+
+use std::fs::File;
+use std::path::Path;
+
+use miette::{Context, IntoDiagnostic, miette};
+use ndarray::{Array1, Array2, Array3, ArrayView1, ArrayView2, Axis, s};
+use ndarray_npz::{NpzReader, NpzWriter};
+use rayon::prelude::*;
+
+/// Number of samples per block when computing the moments of a batch of traces in parallel.
+const SAMPLES_BLOCK: usize = 256;
+
+/// Number of classes of a t-test.
+pub const NUM_CLASSES: usize = 2;
+
+/// Moments sidecar saved next to the traces of each run.
+pub const MOMENTS_NPZ: &str = "moments.npz";
+/// Moments of all the runs of a campaign (or of a shard of it), saved next to its t-test results.
+pub const CAMPAIGN_MOMENTS_NPZ: &str = "campaign_moments.npz";
+
+#[derive(Clone, Debug, PartialEq)]
+pub struct Ttest {
+    /// number of samples per trace
+    ns: usize,
+    /// highest order of the test
+    d: usize,
+    /// number of traces of each class
+    n: [u64; NUM_CLASSES],
+    /// mean of each class and sample: shape (NUM_CLASSES, ns)
+    mean: Array2<f64>,
+    /// central moment sums of each class, for p = 2..=2d (index p - 2), and sample: shape (NUM_CLASSES, 2d - 1, ns)
+    cs: Array3<f64>,
+}
+
+fn binomial(n: usize, k: usize) -> f64 {
+    (0..k).fold(1.0, |acc, i| acc * (n - i) as f64 / (i + 1) as f64)
+}
+
+impl Ttest {
+    pub fn new(ns: usize, d: usize) -> Self {
+        assert!(d > 0, "Order must be greater than 0");
+        Ttest {
+            ns,
+            d,
+            n: [0; NUM_CLASSES],
+            mean: Array2::zeros((NUM_CLASSES, ns)),
+            cs: Array3::zeros((NUM_CLASSES, 2 * d - 1, ns)),
+        }
+    }
+
+    /// Number of samples per trace.
+    pub fn ns(&self) -> usize {
+        self.ns
+    }
+
+    /// Highest order of the test.
+    pub fn order(&self) -> usize {
+        self.d
+    }
+
+    /// Number of traces accumulated in each class.
+    pub fn num_traces(&self) -> [u64; NUM_CLASSES] {
+        self.n
+    }
+
+    /// Accumulate a batch of traces (one per row) with their class labels (0 or 1).
+    pub fn update(&mut self, traces: ArrayView2<f32>, labels: ArrayView1<u16>) {
+        assert_eq!(
+            traces.nrows(),
+            labels.len(),
+            "Number of trace labels does not match number of traces"
+        );
+        assert!(
+            labels.iter().all(|&label| (label as usize) < NUM_CLASSES),
+            "Trace labels must be 0 or 1"
+        );
+        let rows: [Vec<usize>; NUM_CLASSES] = std::array::from_fn(|class| {
+            labels
+                .iter()
+                .enumerate()
+                .filter_map(|(i, &label)| (label as usize == class).then_some(i))
+                .collect()
+        });
+        self.update_rows(traces, &rows);
+    }
+
+    /// Accumulate the given rows of a batch of traces (one per row) into each class. The other rows are left out.
+    pub fn update_rows(&mut self, traces: ArrayView2<f32>, rows: &[Vec<usize>; NUM_CLASSES]) {
+        assert_eq!(
+            traces.ncols(),
+            self.ns,
+            "Number of samples of the traces does not match the accumulator"
+        );
+        for (class, rows) in rows.iter().enumerate() {
+            if rows.is_empty() {
+                continue;
+            }
+            let batch = Self::batch_moments(traces, rows, self.d);
+            self.combine_class(class, &batch, 0);
+        }
+    }
+
+    /// Moments of the given rows of `traces`, as a single-class accumulator (class 0).
+    fn batch_moments(traces: ArrayView2<f32>, rows: &[usize], d: usize) -> Ttest {
+        let ns = traces.ncols();
+        let mut batch = Ttest::new(ns, d);
+        batch.n[0] = rows.len() as u64;
+        let num_moments = 2 * d - 1;
+        let mut mean = batch.mean.row_mut(0);
+        let mut cs = batch.cs.index_axis_mut(Axis(0), 0);
+        // each block of samples is reduced independently: first the mean, then the central moment sums
+        mean.axis_chunks_iter_mut(Axis(0), SAMPLES_BLOCK)
+            .into_par_iter()
+            .zip(cs.axis_chunks_iter_mut(Axis(1), SAMPLES_BLOCK))
+            .enumerate()
+            .for_each(|(block, (mut mean, mut cs))| {
+                let offset = block * SAMPLES_BLOCK;
+                let block_traces = traces.slice(s![.., offset..offset + mean.len()]);
+                for &row in rows {
+                    mean.zip_mut_with(&block_traces.row(row), |m, &x| *m += x as f64);
+                }
+                mean /= rows.len() as f64;
+                let mut delta = vec![0f64; mean.len()];
+                let mut power = vec![0f64; mean.len()];
+                for &row in rows {
+                    delta
+                        .iter_mut()
+                        .zip(block_traces.row(row))
+                        .zip(mean.iter())
+                        .for_each(|((delta, &x), &m)| *delta = x as f64 - m);
+                    power.copy_from_slice(&delta);
+                    for p in 0..num_moments {
+                        power
+                            .iter_mut()
+                            .zip(&delta)
+                            .for_each(|(power, delta)| *power *= delta);
+                        cs.row_mut(p)
+                            .iter_mut()
+                            .zip(&power)
+                            .for_each(|(c, power)| *c += power);
+                    }
+                }
+            });
+        batch
+    }
+
+    /// Combine class `other_class` of `other` into class `class` of `self`.
+    fn combine_class(&mut self, class: usize, other: &Ttest, other_class: usize) {
+        let (na, nb) = (self.n[class], other.n[other_class]);
+        if nb == 0 {
+            return;
+        }
+        if na == 0 {
+            self.n[class] = nb;
+            self.mean
+                .row_mut(class)
+                .assign(&other.mean.row(other_class));
+            self.cs
+                .index_axis_mut(Axis(0), class)
+                .assign(&other.cs.index_axis(Axis(0), other_class));
+            return;
+        }
+        let (na_f, nb_f) = (na as f64, nb as f64);
+        let n_f = na_f + nb_f;
+        let max_p = 2 * self.d;
+        let mut mean_a = self.mean.row_mut(class);
+        let mut cs_a = self.cs.index_axis_mut(Axis(0), class);
+        let mean_b = other.mean.row(other_class);
+        let cs_b = other.cs.index_axis(Axis(0), other_class);
+        for j in 0..self.ns {
+            let delta = mean_b[j] - mean_a[j];
+            // central moment sum of order q of each side, with M_0 = n and M_1 = 0
+            let moment = |cs: &ArrayView2<f64>, n: f64, q: usize| match q {
+                0 => n,
+                1 => 0.0,
+                _ => cs[[q - 2, j]],
+            };
+            // update the highest order first, as it depends on the lower orders of both sides
+            for p in (2..=max_p).rev() {
+                let mut m = cs_a[[p - 2, j]] + cs_b[[p - 2, j]];
+                for k in 1..=p - 2 {
+                    m += binomial(p, k)
+                        * delta.powi(k as i32)
+                        * ((-nb_f / n_f).powi(k as i32) * moment(&cs_a.view(), na_f, p - k)
+                            + (na_f / n_f).powi(k as i32) * moment(&cs_b, nb_f, p - k));
+                }
+                m += (na_f * nb_f * delta / n_f).powi(p as i32)
+                    * (1.0 / nb_f.powi(p as i32 - 1) - (-1.0 / na_f).powi(p as i32 - 1));
+                cs_a[[p - 2, j]] = m;
+            }
+            mean_a[j] += delta * nb_f / n_f;
+        }
+        self.n[class] = na + nb;
+    }
+
+    /// Merge the traces accumulated by `other` into `self`.
+    pub fn merge(&mut self, other: &Ttest) {
+        assert_eq!(
+            (self.ns, self.d),
+            (other.ns, other.d),
+            "Cannot merge t-test accumulators of different shapes"
+        );
+        for class in 0..NUM_CLASSES {
+            self.combine_class(class, other, class);
+        }
+    }
+
+    /// Change the number of samples per trace: extra samples are dropped, and missing samples are accumulated
+    /// as if every trace was zero-padded.
+    pub fn resize(&mut self, ns: usize) {
+        if ns == self.ns {
+            return;
+        }
+        let keep = ns.min(self.ns);
+        let mut mean = Array2::zeros((NUM_CLASSES, ns));
+        mean.slice_mut(s![.., ..keep])
+            .assign(&self.mean.slice(s![.., ..keep]));
+        let mut cs = Array3::zeros((NUM_CLASSES, 2 * self.d - 1, ns));
+        cs.slice_mut(s![.., .., ..keep])
+            .assign(&self.cs.slice(s![.., .., ..keep]));
+        // a sample that is zero in every trace has mean 0 and central moments 0
+        self.mean = mean;
+        self.cs = cs;
+        self.ns = ns;
+    }
+
+    /// The t-statistics of each order (rows, from 1 to d) and sample (columns).
+    pub fn get_ttest(&self) -> Array2<f64> {
+        let mut t_values = Array2::zeros((self.d, self.ns));
+        for (order, mut t_row) in t_values.outer_iter_mut().enumerate() {
+            let order = order + 1;
+            for j in 0..self.ns {
+                let mut u = [0f64; NUM_CLASSES];
+                let mut v = [0f64; NUM_CLASSES];
+                for class in 0..NUM_CLASSES {
+                    let n = self.n[class] as f64;
+                    // central moment of order q
+                    let cm = |q: usize| self.cs[[class, q - 2, j]] / n;
+                    (u[class], v[class]) = match order {
+                        1 => (self.mean[[class, j]], cm(2)),
+                        2 => (cm(2), cm(4) - cm(2).powi(2)),
+                        _ => {
+                            let var = cm(2);
+                            (
+                                cm(order) / var.powf(order as f64 / 2.0),
+                                (cm(2 * order) - cm(order).powi(2)) / var.powi(order as i32),
+                            )
+                        }
+                    };
+                }
+                t_row[j] =
+                    (u[0] - u[1]) / (v[0] / self.n[0] as f64 + v[1] / self.n[1] as f64).sqrt();
+            }
+        }
+        t_values
+    }
+
+    /// The same accumulator restricted to the orders up to `d`.
+    pub fn with_order(mut self, d: usize) -> Self {
+        assert!(
+            d > 0 && d <= self.d,
+            "Cannot derive a t-test of order {} from moments of order {}",
+            d,
+            self.d
+        );
+        self.cs = self.cs.slice(s![.., ..2 * d - 1, ..]).to_owned();
+        self.d = d;
+        self
+    }
+
+    /// Save the accumulator to an NPZ file.
+    /// The file is written under a temporary name and then renamed, so readers never see partial files.
+    pub fn save<P: AsRef<Path>>(&self, path: P) -> miette::Result<()> {
+        let path = path.as_ref();
+        let tmp_path = path.with_extension("npz.tmp");
+        let file = File::create(&tmp_path)
+            .into_diagnostic()
+            .wrap_err_with(|| format!("Failed to create {}", tmp_path.display()))?;
+        let mut npz = NpzWriter::new_compressed(file);
+        npz.add_array("num_traces", &Array1::from_iter(self.n))
+            .into_diagnostic()?;
+        npz.add_array("mean", &self.mean).into_diagnostic()?;
+        npz.add_array("moments", &self.cs).into_diagnostic()?;
+        npz.finish()
+            .into_diagnostic()
+            .wrap_err_with(|| format!("Failed to write {}", tmp_path.display()))?;
+        std::fs::rename(&tmp_path, path).into_diagnostic()
+    }
+
+    /// Load an accumulator saved with [`Ttest::save`].
+    pub fn load<P: AsRef<Path>>(path: P) -> miette::Result<Self> {
+        let path = path.as_ref();
+        let file = File::open(path)
+            .into_diagnostic()
+            .wrap_err_with(|| format!("Failed to open {}", path.display()))?;
+        let mut npz = NpzReader::new(std::io::BufReader::new(file)).into_diagnostic()?;
+        let n: Array1<u64> = npz
+            .by_name("num_traces")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'num_traces' in NPZ file")?;
+        let mean: Array2<f64> = npz
+            .by_name("mean")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'mean' in NPZ file")?;
+        let cs: Array3<f64> = npz
+            .by_name("moments")
+            .into_diagnostic()
+            .wrap_err("Failed to find 'moments' in NPZ file")?;
+        let (num_classes, num_moments, ns) = cs.dim();
+        if n.len() != NUM_CLASSES
+            || num_classes != NUM_CLASSES
+            || num_moments % 2 == 0
+            || mean.dim() != (NUM_CLASSES, ns)
+        {
+            return Err(miette!(
+                "Inconsistent t-test moments in {}: {} classes, mean of shape {:?}, moments of shape {:?}",
+                path.display(),
+                n.len(),
+                mean.dim(),
+                cs.dim()
+            ));
+        }
+        Ok(Ttest {
+            ns,
+            d: (num_moments + 1) / 2,
+            n: [n[0], n[1]],
+            mean,
+            cs,
+        })
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use approx::assert_relative_eq;
+
+    /// Deterministic pseudo-random traces, with class 1 shifted and scaled so that every order has a signal.
+    fn test_traces(num_traces: usize, ns: usize) -> (Array2<f32>, Array1<u16>) {
+        let labels = Array1::from_shape_fn(num_traces, |i| ((i * 7 + i / 3) % 2) as u16);
+        let traces = Array2::from_shape_fn((num_traces, ns), |(i, j)| {
+            let noise = ((i as f32 * 12.9898 + j as f32 * 78.233).sin() * 43758.547).fract();
+            match labels[i] {
+                0 => noise,
+                _ => 0.1 * j as f32 + 1.5 * noise * noise,
+            }
+        });
+        (traces, labels)
+    }
+
+    /// The t-statistics of each order up to `d`, from the moments of each class computed directly in two passes.
+    fn two_pass_ttest(traces: ArrayView2<f32>, labels: ArrayView1<u16>, d: usize) -> Array2<f64> {
+        Array2::from_shape_fn((d, traces.ncols()), |(order, j)| {
+            let order = order + 1;
+            let mut u = [0f64; NUM_CLASSES];
+            let mut v = [0f64; NUM_CLASSES];
+            let mut n = [0f64; NUM_CLASSES];
+            for class in 0..NUM_CLASSES {
+                let xs = traces
+                    .column(j)
+                    .iter()
+                    .zip(labels)
+                    .filter(|&(_, &label)| label as usize == class)
+                    .map(|(&x, _)| x as f64)
+                    .collect::<Vec<_>>();
+                n[class] = xs.len() as f64;
+                let mean = xs.iter().sum::<f64>() / n[class];
+                let cm = |q: i32| xs.iter().map(|x| (x - mean).powi(q)).sum::<f64>() / n[class];
+                (u[class], v[class]) = match order {
+                    1 => (mean, cm(2)),
+                    2 => (cm(2), cm(4) - cm(2).powi(2)),
+                    _ => {
+                        let o = order as i32;
+                        (
+                            cm(o) / cm(2).powf(order as f64 / 2.0),
+                            (cm(2 * o) - cm(o).powi(2)) / cm(2).powi(o),
+                        )
+                    }
+                };
+            }
+            (u[0] - u[1]) / (v[0] / n[0] + v[1] / n[1]).sqrt()
+        })
+    }
+
+    #[test]
+    fn merge_matches_single_update() {
+        let (traces, labels) = test_traces(301, 5);
+        let mut all = Ttest::new(5, 3);
+        all.update(traces.view(), labels.view());
+        for split in [1, 2, 120, 300] {
+            let mut merged = Ttest::new(5, 3);
+            merged.update(traces.slice(s![..split, ..]), labels.slice(s![..split]));
+            let mut other = Ttest::new(5, 3);
+            other.update(traces.slice(s![split.., ..]), labels.slice(s![split..]));
+            merged.merge(&other);
+            assert_eq!(merged.num_traces(), all.num_traces());
+            assert_relative_eq!(merged.mean, all.mean, epsilon = 1e-12, max_relative = 1e-9);
+            assert_relative_eq!(merged.cs, all.cs, epsilon = 1e-12, max_relative = 1e-9);
+        }
+    }
+
+    #[test]
+    fn ttest_matches_two_pass_reference() {
+        let (traces, labels) = test_traces(500, 7);
+        for d in 1..=3 {
+            let mut ttacc = Ttest::new(7, d);
+            // several batches, merged into the accumulator
+            for (batch, batch_labels) in traces
+                .axis_chunks_iter(Axis(0), 64)
+                .zip(labels.axis_chunks_iter(Axis(0), 64))
+            {
+                ttacc.update(batch, batch_labels);
+            }
+            assert_eq!(ttacc.num_traces().iter().sum::<u64>(), 500);
+            assert_relative_eq!(
+                ttacc.get_ttest(),
+                two_pass_ttest(traces.view(), labels.view(), d),
+                epsilon = 1e-9,
+                max_relative = 1e-6
+            );
+        }
+    }
+
+    #[test]
+    fn update_rows_leaves_out_other_rows() {
+        let (traces, _) = test_traces(100, 4);
+        let mut ttacc = Ttest::new(4, 2);
+        ttacc.update_rows(traces.view(), &[vec![0, 2, 4, 6], vec![1, 3]]);
+        let mut expected = Ttest::new(4, 2);
+        expected.update(
+            traces.select(Axis(0), &[0, 2, 4, 6, 1, 3]).view(),
+            Array1::from(vec![0u16, 0, 0, 0, 1, 1]).view(),
+        );
+        assert_eq!(ttacc, expected);
+    }
+
+    #[test]
+    fn resize_matches_zero_padded_traces() {
+        let (traces, labels) = test_traces(50, 4);
+        let mut padded = Array2::<f32>::zeros((50, 6));
+        padded.slice_mut(s![.., ..4]).assign(&traces);
+        let mut expected = Ttest::new(6, 2);
+        expected.update(padded.view(), labels.view());
+        let mut ttacc = Ttest::new(4, 2);
+        ttacc.update(traces.view(), labels.view());
+        ttacc.resize(6);
+        assert_eq!(ttacc, expected);
+
+        let mut expected = Ttest::new(3, 2);
+        expected.update(traces.slice(s![.., ..3]), labels.view());
+        ttacc.resize(3);
+        assert_eq!(ttacc, expected);
+    }
+
+    #[test]
+    fn save_and_load() {
+        let (traces, labels) = test_traces(40, 3);
+        let mut ttacc = Ttest::new(3, 3);
+        ttacc.update(traces.view(), labels.view());
+        let path = std::env::temp_dir().join(format!("scasim_ttest_{}.npz", std::process::id()));
+        ttacc.save(&path).unwrap();
+        let loaded = Ttest::load(&path).unwrap();
+        std::fs::remove_file(&path).unwrap();
+        assert_eq!(loaded, ttacc);
+        assert_eq!(loaded.with_order(2), ttacc.clone().with_order(2));
+    }
+
+    #[test]
+    fn update_accumulates_both_classes() {
+        let traces = Array2::from_shape_fn((6, 3), |(i, j)| (i * (j + 1)) as f32);
+        let labels = Array1::from(vec![0u16, 1, 0, 1, 1, 0]);
+        let mut ttacc = Ttest::new(3, 2);
+        ttacc.update(traces.view(), labels.view());
+        assert_eq!(ttacc.num_traces(), [3, 3]);
+        for (class, rows) in [[0, 2, 5], [1, 3, 4]].iter().enumerate() {
+            let expected = traces.select(Axis(0), rows).mean_axis(Axis(0)).unwrap();
+            assert_relative_eq!(
+                ttacc.mean.row(class).to_owned(),
+                expected.mapv(|x| x as f64),
+                max_relative = 1e-12
+            );
+        }
+        assert!(ttacc.get_ttest().iter().all(|t| t.is_finite()));
+    }
+}
@@ -0,0 +1,219 @@
+//! Campaign-level trace store in Zarr format.
+//!
+//! All traces of a campaign live in one 2-D `traces` array (traces x samples), chunked along both dimensions,
+//! with their labels in a 1-D `labels` array. Runs are appended as they arrive, so extending a campaign only
+//! writes new chunks, and readers can fetch any block of traces and samples without loading whole runs.
+//! Chunks are compressed in parallel by zarrs.
+
+use std::ops::Range;
+use std::path::Path;
+use std::sync::Arc;
+
+use miette::{Context, IntoDiagnostic, miette};
+use ndarray::{Array1, Array2, ArrayView1, ArrayView2};
+use zarrs::array::codec::{BytesToBytesCodecTraits, GzipCodec};
+use zarrs::array::{Array, ArrayBuilder, DataType, FillValue};
+use zarrs::array_subset::ArraySubset;
+use zarrs::filesystem::FilesystemStore;
+use zarrs::group::GroupBuilder;
+
+pub const TRACES_ARRAY: &str = "/traces";
+pub const LABELS_ARRAY: &str = "/labels";
+/// Attribute of the labels array listing the runs stored in the campaign.
+const RUNS_ATTRIBUTE: &str = "runs";
+
+/// Number of traces per chunk.
+pub const TRACES_PER_CHUNK: u64 = 4096;
+/// Number of samples per chunk.
+pub const SAMPLES_PER_CHUNK: u64 = 1024;
+
+const GZIP_LEVEL: u32 = 5;
+
+fn gzip_codecs() -> miette::Result<Vec<Arc<dyn BytesToBytesCodecTraits>>> {
+    let gzip: Arc<dyn BytesToBytesCodecTraits> =
+        Arc::new(GzipCodec::new(GZIP_LEVEL).into_diagnostic()?);
+    Ok(vec![gzip])
+}
+
+pub struct CampaignStore {
+    traces: Array<FilesystemStore>,
+    labels: Array<FilesystemStore>,
+}
+
+impl CampaignStore {
+    /// Open the campaign store at `path`.
+    pub fn open<P: AsRef<Path>>(path: P) -> miette::Result<Self> {
+        let store = Arc::new(FilesystemStore::new(path.as_ref()).into_diagnostic()?);
+        let traces = Array::open(store.clone(), TRACES_ARRAY)
+            .into_diagnostic()
+            .wrap_err_with(|| {
+                format!("Failed to open the traces of {}", path.as_ref().display())
+            })?;
+        let labels = Array::open(store, LABELS_ARRAY)
+            .into_diagnostic()
+            .wrap_err_with(|| {
+                format!("Failed to open the labels of {}", path.as_ref().display())
+            })?;
+        if traces.shape()[0] != labels.shape()[0] {
+            return Err(miette!(
+                "Campaign store {} is inconsistent: {} traces but {} labels",
+                path.as_ref().display(),
+                traces.shape()[0],
+                labels.shape()[0]
+            ));
+        }
+        Ok(CampaignStore { traces, labels })
+    }
+
+    /// Create an empty campaign store at `path` for traces of `samples_per_trace` samples.
+    pub fn create<P: AsRef<Path>>(path: P, samples_per_trace: usize) -> miette::Result<Self> {
+        std::fs::create_dir_all(&path).into_diagnostic()?;
+        let store = Arc::new(FilesystemStore::new(path.as_ref()).into_diagnostic()?);
+        GroupBuilder::new()
+            .build(store.clone(), "/")
+            .into_diagnostic()?
+            .store_metadata()
+            .into_diagnostic()?;
+        let traces = ArrayBuilder::new(
+            vec![0, samples_per_trace as u64],
+            DataType::Float32,
+            vec![
+                TRACES_PER_CHUNK,
+                SAMPLES_PER_CHUNK.min(samples_per_trace.max(1) as u64),
+            ]
+            .try_into()
+            .into_diagnostic()?,
+            FillValue::from(0f32),
+        )
+        .bytes_to_bytes_codecs(gzip_codecs()?)
+        .dimension_names(["trace", "sample"].into())
+        .build(store.clone(), TRACES_ARRAY)
+        .into_diagnostic()?;
+        traces.store_metadata().into_diagnostic()?;
+        let labels = ArrayBuilder::new(
+            vec![0],
+            DataType::UInt16,
+            vec![TRACES_PER_CHUNK].try_into().into_diagnostic()?,
+            FillValue::from(0u16),
+        )
+        .bytes_to_bytes_codecs(gzip_codecs()?)
+        .dimension_names(["trace"].into())
+        .build(store, LABELS_ARRAY)
+        .into_diagnostic()?;
+        labels.store_metadata().into_diagnostic()?;
+        Ok(CampaignStore { traces, labels })
+    }
+
+    /// Whether a campaign store has been created at `path`.
+    pub fn exists<P: AsRef<Path>>(path: P) -> bool {
+        path.as_ref().join("zarr.json").exists()
+    }
+
+    pub fn num_traces(&self) -> u64 {
+        self.traces.shape()[0]
+    }
+
+    pub fn samples_per_trace(&self) -> usize {
+        self.traces.shape()[1] as usize
+    }
+
+    /// Identifiers of the runs appended so far.
+    pub fn runs(&self) -> Vec<String> {
+        self.labels
+            .attributes()
+            .get(RUNS_ATTRIBUTE)
+            .and_then(|runs| runs.as_array())
+            .map(|runs| {
+                runs.iter()
+                    .filter_map(|run| run.as_str().map(str::to_owned))
+                    .collect()
+            })
+            .unwrap_or_default()
+    }
+
+    pub fn contains_run(&self, run_id: &str) -> bool {
+        self.runs().iter().any(|run| run == run_id)
+    }
+
+    /// Append the traces and labels of a run. Only the chunks covering the new traces are written.
+    pub fn append(
+        &mut self,
+        run_id: &str,
+        traces: ArrayView2<f32>,
+        labels: ArrayView1<u16>,
+    ) -> miette::Result<()> {
+        let (num_traces, samples_per_trace) = traces.dim();
+        if samples_per_trace != self.samples_per_trace() {
+            return Err(miette!(
+                "Cannot append traces with {} samples to a campaign with {} samples per trace",
+                samples_per_trace,
+                self.samples_per_trace()
+            ));
+        }
+        assert_eq!(
+            num_traces,
+            labels.len(),
+            "Number of trace labels does not match number of traces"
+        );
+        let start = self.num_traces();
+        let end = start + num_traces as u64;
+
+        self.traces.set_shape(vec![end, samples_per_trace as u64]);
+        self.labels.set_shape(vec![end]);
+
+        let traces = traces.as_standard_layout();
+        self.traces
+            .store_array_subset_elements::<f32>(
+                &ArraySubset::new_with_ranges(&[start..end, 0..samples_per_trace as u64]),
+                traces.as_slice().expect("standard layout is contiguous"),
+            )
+            .into_diagnostic()
+            .wrap_err("Failed to store traces")?;
+        self.labels
+            .store_array_subset_elements::<u16>(
+                &ArraySubset::new_with_ranges(&[start..end]),
+                &labels.to_vec(),
+            )
+            .into_diagnostic()
+            .wrap_err("Failed to store labels")?;
+
+        let mut runs = self.runs();
+        runs.push(run_id.to_owned());
+        self.labels
+            .attributes_mut()
+            .insert(RUNS_ATTRIBUTE.to_owned(), runs.into());
+        // the metadata (with the new shape) is written last, so readers never see unwritten traces
+        self.traces.store_metadata().into_diagnostic()?;
+        self.labels.store_metadata().into_diagnostic()?;
+        Ok(())
+    }
+
+    /// Read a block of traces and samples, with the labels of the traces.
+    pub fn read_block(
+        &self,
+        traces: Range<u64>,
+        samples: Range<u64>,
+    ) -> miette::Result<(Array2<f32>, Array1<u16>)> {
+        let shape = (
+            (traces.end - traces.start) as usize,
+            (samples.end - samples.start) as usize,
+        );
+        let trace_data = self
+            .traces
+            .retrieve_array_subset_elements::<f32>(&ArraySubset::new_with_ranges(&[
+                traces.clone(),
+                samples,
+            ]))
+            .into_diagnostic()
+            .wrap_err("Failed to read traces")?;
+        let label_data = self
+            .labels
+            .retrieve_array_subset_elements::<u16>(&ArraySubset::new_with_ranges(&[traces]))
+            .into_diagnostic()
+            .wrap_err("Failed to read labels")?;
+        Ok((
+            Array2::from_shape_vec(shape, trace_data).into_diagnostic()?,
+            Array1::from_vec(label_data),
+        ))
+    }
+}